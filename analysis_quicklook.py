@@ -4,12 +4,11 @@ Author: Daniel Walker
 
 Run this code inside a CASA session.
 Please ensure that you have the following packaged installed inside your CASA environment:
-    spectral-cube
     pyspeckit
     astropy
     regions
 
-To install, simply run "pip install spectral-cube pyspeckit astropy regions" inside your CASA session.
+To install, simply run "pip install pyspeckit astropy regions" inside your CASA session.
     
 Basic analysis of ALMA data
 
@@ -23,228 +22,187 @@ In this short hands-on session we will look at some very basic analysis tools to
 """
 
 import os
-import shutil
 import pyspeckit
 import numpy as np
-from astropy.io import fits
-from astropy.wcs import WCS
-import matplotlib.pyplot as plt
-from spectral_cube import SpectralCube
 from regions import CirclePixelRegion, PixCoord
-
-# Create output directory for plots if it doesn't exist
+from cube_handle import Cube
+from cube_spectra import region_spectra
+from cube_fit import fit_spectra, fit_cube, spectral_params
+from cube_moments import cube_moments
+from cube_pv import pv_slice, pv_slices, fan_paths
+from plot_pipeline import PlotPipeline, render_image, render_panels, render_spectrum
+
+# Output directory for plots (created if it doesn't exist)
 output_dir = 'plots'
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
+
+# The figures are rendered in parallel, in the background, as the script goes. A figure is only
+# redrawn if what it shows has changed since the last run. Set preview=True for quick low-resolution
+# versions ('*_preview.png') while exploring parameters
+plots = PlotPipeline(output_dir, dpi=300, preview=False)
 
 # Update the filename and mask_file variables to match your data
 filename = 'PN_Hb_5.spw_0.image.fits'
 mask_file = 'region.crtf'
 
+# Open the cube once: every step below reads it through this memory-mapped handle, which also
+# keeps the header, WCS, spectral axis and statistics once they have been computed
+cube = Cube(filename)
+
 """
 Plot a single channel in the cube and calculate some statistics of this channel and of the full cube
 Feel free to change this channel number and to explore different stats that you get from 
 imstat: https://casadocs.readthedocs.io/en/latest/api/tt/casatasks.information.imstat.html
+The statistics of every channel and of the full cube are computed (by cube_stats) in a single
+pass over the (memory-mapped) cube, reading a few channels at a time, so that it also works on
+cubes larger than the memory
 """
 
 channel = 522
-with fits.open(filename) as hdul:
-    data = hdul[0].data[channel, :, :]
+data = cube.channel(channel)
 
-plt.figure()
-plt.imshow(data, origin='lower', cmap='inferno')
-plt.colorbar(label='Intensity (Jy/beam)')
-plt.title(f'Channel {channel} of {os.path.basename(filename)}')
-plt.savefig(os.path.join(output_dir, 'single_channel.png'), bbox_inches='tight', dpi=300)
-plt.close()
+plots.submit('single_channel.png', render_image, data=data, cbar_label='Intensity (Jy/beam)',
+             title=f'Channel {channel} of {os.path.basename(filename)}', figsize=(6.4, 4.8))
 
 print('\n')
 
-stats_chan = imstat(filename, chans=str(channel))
-min_val_chan = stats_chan['min'][0]
-max_val_chan = stats_chan['max'][0]
-rms_val_chan = stats_chan['rms'][0]
+stats = cube.stats
+min_val_chan = stats['min'][channel]
+max_val_chan = stats['max'][channel]
+rms_val_chan = stats['rms'][channel]
 print(f"Channel {channel}: Min: {min_val_chan * 1e3:.2f} mJy/beam, Max: {max_val_chan * 1e3:.2f} mJy/beam, RMS: {rms_val_chan * 1e3:.2f} mJy/beam")
 
-stats_full_cube = imstat(filename)
-min_val_cube = stats_full_cube['min'][0]
-max_val_cube = stats_full_cube['max'][0]
-rms_val_cube = stats_full_cube['rms'][0]
+min_val_cube = stats['cube']['min']
+max_val_cube = stats['cube']['max']
+rms_val_cube = stats['cube']['rms']
 print(f"Full Cube: Min: {min_val_cube * 1e3:.2f} mJy/beam, Max: {max_val_cube * 1e3:.2f} mJy/beam, RMS: {rms_val_cube * 1e3:.2f} mJy/beam")
+print(f"Blanked (NaN) pixels: {stats['cube']['nnan']}")
 
 """
-Extract a mean spectrum with [spectral-cube](https://spectral-cube.readthedocs.io/en/latest/), 
-then plot it with [pyspeckit](https://pyspeckit.readthedocs.io/en/latest/index.html)
+Plot the mean spectrum of the cube
+* The per-channel means were already computed with the statistics above, so the cube is not read again
 """
 
-cube = SpectralCube.read(filename)
-cube.allow_huge_operations=True
-mean_spectrum = cube.mean(axis=(1, 2))
+freqs = cube.spectral_axis
 
-sp = pyspeckit.Spectrum(data=mean_spectrum.value, xarr=mean_spectrum.spectral_axis.value)
-fig = plt.figure(figsize=(8, 7))
-sp.plotter(figure=fig)
-sp.plotter.axis.set_xlabel('Frequency (Hz)')
-sp.plotter.axis.set_ylabel('Intensity (Jy/beam)')
-plt.savefig(os.path.join(output_dir, 'mean_spectrum.png'), bbox_inches='tight', dpi=300)
-plt.close()
+plots.submit('mean_spectrum.png', render_spectrum, x=freqs, y=stats['mean'])
 
 """
 Repeat for a circular region (roughly) centred on the source
+* region_spectra takes a list of regions (or a region file such as mask_file) and gets the mean,
+  sum and max spectra of all of them in a single pass over the cube, so adding more apertures
+  to the list costs almost nothing
 """
 
 ny, nx = cube.shape[1:]
 centre = PixCoord(x=nx/2, y=ny/2)
 region = CirclePixelRegion(center=centre, radius=10)
-channel_55 = cube[54].value
+channel_55 = cube.channel(54)
 
-subcube = cube.subcube_from_regions([region])
-mean_spectrum = subcube.mean(axis=(1, 2))
+spectra = region_spectra(cube, [region])
+mean_spectrum = spectra['mean'][0]
 
-sp = pyspeckit.Spectrum(data=mean_spectrum.value, xarr=mean_spectrum.spectral_axis.value)
-fig = plt.figure(figsize=(8, 7))
-sp.plotter(figure=fig)
-sp.plotter.axis.set_xlabel('Frequency (Hz)')
-sp.plotter.axis.set_ylabel('Intensity (Jy/beam)')
-plt.savefig(os.path.join(output_dir, 'circular_region_spectrum.png'), bbox_inches='tight', dpi=300)
-plt.close()
+plots.submit('circular_region_spectrum.png', render_spectrum, x=freqs, y=mean_spectrum)
 
 """
-Fit multiple Gaussian components to the spectrum
-* The guesses are initialised with amplitude, centroid, and FWHM
+Fit multiple Gaussian components to the spectrum with [pyspeckit](https://pyspeckit.readthedocs.io/en/latest/index.html)
+* The guesses are initialised with amplitude, centroid, and width (sigma)
 * Guesses can be quite crude and the fitter will usually do a good job
-* Guessed don't have to be hard-coded ([see example](https://pyspeckit.readthedocs.io/en/latest/example_fromscratch.html) using moments to initialise guesses)
+* Guesses don't have to be hard-coded: here they come from cube_fit, which takes moment-based
+  guesses from the spectrum itself and fits it (in channel units), converted to frequency
 
 **The fit shown in this example is not necesarrily a good fit. This is just illustrative.**
 """
 
-guesses = [0.005, 2.2635e11, 5e9,
-           0.05, 2.267e11, 5e9,
-           0.1, 2.269e11, 5e9]
+fit = fit_spectra(mean_spectrum, ncomp=3)
+guesses = list(spectral_params(fit['params'][0], cube.header, cube.nchan, axis=freqs))
 
-sp = pyspeckit.Spectrum(data=mean_spectrum.value, xarr=mean_spectrum.spectral_axis.value)
-fig = plt.figure(figsize=(8, 7))
-sp.plotter(figure=fig)
-sp.plotter.axis.set_xlabel('Frequency (Hz)')
-sp.plotter.axis.set_ylabel('Intensity (Jy/beam)')
+sp = pyspeckit.Spectrum(data=mean_spectrum, xarr=freqs)
 sp.specfit(fittype='gaussian', guesses=guesses)
-plt.savefig(os.path.join(output_dir, 'gaussian_fit.png'), bbox_inches='tight', dpi=300)
-plt.close()
+print('Fitted parameters:', sp.specfit.parinfo.values)
+plots.submit('gaussian_fit.png', render_spectrum, x=freqs, y=mean_spectrum,
+             model=np.asarray(sp.specfit.get_full_model()))
+
+"""
+Fit a Gaussian to every pixel of the cube
+* fit_cube fits blocks of spectra together (vectorised Levenberg-Marquardt), optionally spread over
+  several processes with max_workers, and returns maps of the parameters and their uncertainties
+* Only the line channels are used, and only pixels whose peak is above min_peak are fitted
+"""
+
+maps = fit_cube(cube, ncomp=1, chans=(420, 630), min_peak=0.03, max_workers=4)
+centre_map = spectral_params(maps['params'], cube.header, cube.nchan, axis=freqs)[1]
+
+plots.submit('gaussian_fit_maps.png', render_panels, figsize=(18, 5),
+             panels=[dict(data=data, title=title) for data, title in
+                     zip([maps['params'][0], centre_map, maps['errors'][1]],
+                         ['Amplitude (Jy/beam)', 'Centre (Hz)', 'Centre uncertainty (channels)'])])
 
 """
 Create a position-velocity plot across the source
-* This example is using CASA's [impv](https://casadocs.readthedocs.io/en/stable/api/tt/casatasks.analysis.impv.html) task
+* This example uses cube_pv, which interpolates the cube along the slice directly (no CASA image to
+  export and no header to fix); CASA's [impv](https://casadocs.readthedocs.io/en/stable/api/tt/casatasks.analysis.impv.html) task does the same
      * Also see [pvextractor](https://pvextractor.readthedocs.io/en/latest/#) for a standalone Python package
 * The slice is defined by the start and end pixel coordinates
-     * Feel free to play with these, and the position angle, to see how the PV plot changes
+     * Feel free to play with these, and the width (pixels averaged across the slice), to see how the PV plot changes
 """
 
 channel = 522
 start = [148,122]
 end = [175,175]
-pv_output = filename.replace('.fits', '.pv')
-
-# Create the PV diagram using CASA
-impv(imagename=filename,
-     outfile=pv_output,
-     mode='coords',
-     start=start,
-     end=end,
-     overwrite=True)
-
-pv_fits = pv_output + '.fits'
-exportfits(imagename=pv_output,
-           fitsimage=pv_fits,
-           overwrite=True)
-
-# Fix the WCS header before creating the plot
-# Sometimes it complains about the time keywords and demands them to be lowercase, for some reason ...
-def fix_wcs_header(header):
-    time_keys = ['TIMESYS']
-    for key in time_keys:
-        if key in header and isinstance(header[key], str):
-            header[key] = header[key].lower()
-    return header
-
-# Create the plot with the fixed header
-fig = plt.figure(figsize=(20, 8))
-
-with fits.open(filename) as hdul:
-    channel_data = hdul[0].data[channel, :, :]
-    header = hdul[0].header
-
-ax1 = fig.add_subplot(1, 2, 1)
-im1 = ax1.imshow(channel_data, origin='lower', cmap='inferno', aspect='auto')
-cbar1 = plt.colorbar(im1, ax=ax1)
-ax1.set_title('Channel ' + str(channel))
-ax1.plot([start[0], end[0]], [start[1], end[1]], color='white', linestyle='--')
-
-with fits.open(pv_fits) as hdul:
-    pv_data = hdul[0].data
-    pv_header = hdul[0].header
-    pv_header = fix_wcs_header(pv_header)
-    wcs_pv = WCS(pv_header)
-
-ax2 = fig.add_subplot(1, 2, 2, projection=wcs_pv)
-im2 = ax2.imshow(pv_data, origin='lower', cmap='inferno', aspect='auto')
-cbar2 = plt.colorbar(im2, ax=ax2, label='Intensity (Jy/beam)')
-ax2.set_title('Position-Velocity Diagram')
-ax2.coords[0].set_axislabel('Position (arcsec)')
-ax2.coords[1].set_axislabel('Velocity (km/s)')
-
-plt.savefig(os.path.join(output_dir, 'position_velocity.png'), bbox_inches='tight', dpi=300)
-plt.close()
+
+# Create the PV diagram; it comes with its WCS (offset in arcsec, velocity in km/s)
+pv_data, pv_header = pv_slice(cube, start, end, width=1)
+
+channel_data = cube.channel(channel)
+
+plots.submit('position_velocity.png', render_panels, figsize=(20, 8), panels=[
+    dict(data=channel_data, title='Channel ' + str(channel), aspect='auto',
+         lines=[([start[0], end[0]], [start[1], end[1]])]),
+    dict(data=pv_data, header=pv_header, title='Position-Velocity Diagram', aspect='auto',
+         cbar_label='Intensity (Jy/beam)', xlabel='Position (arcsec)', ylabel='Velocity (km/s)',
+         format_unit='km/s')])
 
 """
-Create and plot moment maps
-* Use CASA's [immoments](https://casadocs.readthedocs.io/en/stable/api/tt/casatasks.analysis.immoments.html) task to create moment maps
-* In this example we have moment 0 (integrated intensity), moment 1 (intensity weighted coordinate / velocity field), and moment 8 (peak intensity).
-     * Feel free to try different moments. You can find the explanations at the above link for the task documentation.
-* Notice that the chans, includepix, and region parameters are commented out
-     * I'd encourage you to re-run the below blocks, each time un-commenting one of these lines. How does this change the resulting plots, and why?
-* Note that you can also use other tools to create moment maps, such as [spectral-cube](https://spectral-cube.readthedocs.io/en/latest/)
+Many slices at once: a fan of position angles through the centre of the slice above
+* All the slices are extracted in a single pass over the cube
 """
 
-moment_files = [filename.replace('.fits', '.moment.integrated'),
-                filename.replace('.fits', '.moment.maximum'),
-                filename.replace('.fits', '.moment.weighted_coord')]
+centre = [(start[0] + end[0])/2, (start[1] + end[1])/2]
+angles = range(0, 180, 30)
+slices = pv_slices(cube, fan_paths(centre, 60, angles, cube.header), width=3)
 
-for fn in moment_files:
-    if os.path.exists(fn):
-        shutil.rmtree(fn)
-        print(f"Removed existing directory: {fn}")
+plots.submit('position_velocity_fan.png', render_panels, figsize=(20, 10), ncols=3,
+             panels=[dict(data=pv, header=hdr, title=f'PA = {pa} deg', aspect='auto', format_unit='km/s')
+                     for pa, (pv, hdr) in zip(angles, slices)])
 
-immoments(imagename=filename,
-          moments=[0, 1, 8],
-          chans='420~630',
-          includepix=[0.03, 100],
-          region=mask_file,
-          outfile=filename.replace('.fits', '.moment'))
+"""
+Create and plot moment maps
+* cube_moments makes the same moment maps as CASA's [immoments](https://casadocs.readthedocs.io/en/stable/api/tt/casatasks.analysis.immoments.html) task,
+  with the same chans, includepix and region selections, directly from the FITS cube
+* In this example we have moment 0 (integrated intensity), moment 1 (intensity weighted coordinate / velocity field), and moment 8 (peak intensity).
+     * Moment 2 (velocity dispersion) is computed in the same pass. You can find the explanations of the moments at the above link for the task documentation.
+* Try removing the chans, includepix, and region parameters, one at a time
+     * How does this change the resulting plots, and why?
+* The maps are kept in memory; give e.g. outfile=filename.replace('.fits', '.moment') to also write them as FITS files
+* Note that you can also use other tools to create moment maps, such as [spectral-cube](https://spectral-cube.readthedocs.io/en/latest/)
+"""
 
-# CASA alyways outputs images in CASA image format
-# Use task exportfits to make them in FITS files
-for mom in moment_files:
-    exportfits(imagename=mom,
-               fitsimage=mom + '.fits',
-               dropdeg=True,
-               overwrite=True)
+moments = cube_moments(cube,
+                       moments=[0, 1, 2, 8],
+                       chans='420~630',
+                       includepix=[0.03, 100],
+                       region=mask_file)
 
 # Plot the moments
-fig, axes = plt.subplots(1, 3, figsize=(12, 18))
-
 titles = ['Moment 0 (Integrated intensity)',
           'Moment 8 (Maximum intensity)',
           'Moment 1 (Weighted velocity)']
 
 colourmaps = ['inferno', 'inferno', 'seismic']
 
-for i, (mom_fits, ax, cmap) in enumerate(zip(moment_files, axes, colourmaps)):
-    with fits.open(mom_fits + '.fits') as hdul:
-        data = hdul[0].data
-        im = ax.imshow(data, origin='lower', cmap=cmap)
-        ax.set_title(titles[i])
-        fig.colorbar(im, ax=ax, orientation='vertical', fraction=0.046, pad=0.04)
+plots.submit('moment_maps.png', render_panels, figsize=(12, 4),
+             panels=[dict(data=moments[mom], title=title, cmap=cmap)
+                     for mom, title, cmap in zip([0, 8, 1], titles, colourmaps)])
 
-plt.tight_layout()
-plt.savefig(os.path.join(output_dir, 'moment_maps.png'), bbox_inches='tight', dpi=300)
-plt.close()
\ No newline at end of file
+# Wait for the figures still being rendered
+plots.close()
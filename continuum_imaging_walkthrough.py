@@ -1,4 +1,5 @@
 import os
+from ms_index import choose_gridder, data_column
 
 # File and target configuration
 vis_file = 'uid___A002_X1003af4_Xa540.ms'  # Change name if necessary
@@ -29,7 +30,7 @@ tclean_params = {
     'imsize': [320, 300],
     'cell': ['0.22arcsec'],
     'phasecenter': 'ICRS 17:47:56.2008 -029.59.39.588',
-    'gridder': 'mosaic',
+    'gridder': 'mosaic',  # replaced below by the choice for split_vis
     'deconvolver': 'hogbom',
     'robust': ROBUST,
     'pbcor': True,
@@ -49,10 +50,7 @@ tclean_params = {
 if not os.path.isdir(split_vis):
     print(f"Splitting {vis_file} to {split_vis}")
     
-    tb.open(vis_file)
-    colnames = tb.colnames()
-    tb.close()
-    column = 'corrected' if 'CORRECTED_DATA' in colnames else 'data'
+    column = data_column(vis_file)
     print(f"Using {column.upper()} column for split")
 
     split(vis=vis_file,
@@ -61,6 +59,10 @@ if not os.path.isdir(split_vis):
           spw=target_spw,
           datacolumn=column)
 
+# 'mosaic' only if the target has more than one phase centre (cached in <split_vis>.index.json)
+tclean_params['gridder'] = choose_gridder(split_vis)
+print(f"Gridder selected: {tclean_params['gridder']}")
+
 ## 2. Make continuum images
 
 # 2.1 Make dirty continuum image
@@ -71,10 +73,7 @@ dirty_continuum_name = f"{continuum_name}.dirty"
 if not os.path.isdir(f"{dirty_continuum_name}.image"):
     print(f"Creating dirty continuum image: {dirty_continuum_name}")
     
-    tb.open(split_vis)
-    colnames = tb.colnames()
-    tb.close()
-    column = 'corrected' if 'CORRECTED_DATA' in colnames else 'data'
+    column = data_column(split_vis)
     print(f"Using {column.upper()} column for tclean")
     
     # Create a modified parameter dict for dirty image to override clean parameters
@@ -97,10 +96,7 @@ if not os.path.isdir(f"{dirty_continuum_name}.image"):
 if not os.path.isdir(f"{continuum_name}.image"):
     print(f"Creating clean continuum image: {continuum_name}")
     
-    tb.open(split_vis)
-    colnames = tb.colnames()
-    tb.close()
-    column = 'corrected' if 'CORRECTED_DATA' in colnames else 'data'
+    column = data_column(split_vis)
     print(f"Using {column.upper()} column for tclean")
 
     tclean(vis=split_vis,
@@ -0,0 +1,226 @@
+"""
+Continuum subtraction in place, with the fits cached per spectral window
+
+Replaces uvcontsub(fitspec=CONT_CHANNELS, fitorder=...) writing a new MS:
+the fitspec is parsed once into a boolean channel mask per spectral
+window, DATA is read in blocks of rows, and a polynomial is fitted to the
+continuum channels of every row and correlation at once by least squares:
+rows with the same flags on the continuum channels share one pseudo-inverse
+(usually a single one for the whole block). DATA minus the fitted continuum
+goes into CORRECTED_DATA of the same MS (created if needed), so DATA is
+kept and subtracting again with other settings needs no new split.
+
+The coefficients of each spectral window are saved in
+'<vis>.contsub_cache/', keyed on the fit order, the channel mask, the row
+count, a digest of a few DATA rows (so a re-split MS of the same name is
+refitted) and a digest of the flags on the continuum channels (so is a
+reflagged one); changing the fit of one spw (or going back to earlier
+settings) does not refit the others.
+
+    contsub(split_vis, CONT_CHANNELS, fitorder=0)
+    tclean(vis=split_vis, datacolumn='corrected', ...)
+"""
+
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from casatools import table
+
+tb = table()
+
+freq_units = {'hz': 1.0, 'khz': 1e3, 'mhz': 1e6, 'ghz': 1e9}
+
+
+def spw_frequencies(vis):
+    # Channel frequencies (Hz) of every spectral window
+    tb.open(os.path.join(vis, 'SPECTRAL_WINDOW'))
+    try:
+        var = tb.getvarcol('CHAN_FREQ')
+    finally:
+        tb.close()
+    return [np.ravel(var['r{0}'.format(i + 1)]) for i in range(len(var))]
+
+
+def parse_fitspec(fitspec, freqs):
+    """
+    Continuum channel mask of every spw from a CASA selection such as
+    '0:229.03~229.14GHz;229.57~230.24GHz,1:10~200'. Frequency ranges select
+    the channels whose centres fall inside them. Spectral windows that are not
+    mentioned are continuum over all their channels. A selection with no
+    channel in its spw raises ValueError (nothing could be fitted).
+    """
+    masks = dict((spw, np.ones(len(f), dtype=bool)) for spw, f in enumerate(freqs))
+    for part in [p for p in fitspec.split(',') if p.strip()]:
+        spw, _, ranges = part.partition(':')
+        spws = range(len(freqs)) if spw.strip() in ('*', '') else [int(spw)]
+        for s in spws:
+            if not ranges.strip():
+                continue
+            mask = np.zeros(len(freqs[s]), dtype=bool)
+            for r in [r.strip() for r in ranges.split(';') if r.strip()]:
+                match = re.match(r'^([\d.eE+-]+)\s*~\s*([\d.eE+-]+)\s*([a-zA-Z]*)$', r)
+                if match is None:
+                    raise ValueError('Cannot parse fitspec range ' + repr(r))
+                lo, hi, unit = float(match.group(1)), float(match.group(2)), match.group(3).lower()
+                if unit:
+                    lo, hi = sorted([lo*freq_units[unit], hi*freq_units[unit]])
+                    mask |= (freqs[s] >= lo) & (freqs[s] <= hi)
+                else:
+                    mask[int(lo):int(hi) + 1] = True
+            if not mask.any():
+                raise ValueError('fitspec {0!r} selects no channel of spw {1}'.format(part.strip(), s))
+            masks[s] = mask
+    return masks
+
+
+def design_matrix(nchan, fitorder):
+    # Polynomial basis over the channels, on [-1, 1] for conditioning
+    return np.polynomial.polynomial.polyvander(np.linspace(-1.0, 1.0, nchan), fitorder)
+
+
+def fit_block(data, flag, mask, basis):
+    """
+    Least-squares coefficients (ncorr, nterm, nrow) for data/flag of shape
+    (ncorr, nchan, nrow), using the unflagged channels of 'mask'. One
+    pseudo-inverse per distinct flag pattern; NaN where too few channels.
+    """
+    ncorr, nchan, nrow = data.shape
+    nterm = basis.shape[1]
+    cont = np.nonzero(mask)[0]
+    good = ~flag[:, cont, :].transpose(0, 2, 1).reshape(ncorr*nrow, len(cont))
+    values = data[:, cont, :].transpose(0, 2, 1).reshape(ncorr*nrow, len(cont))
+    coef = np.full((ncorr*nrow, nterm), np.nan + 0j, dtype=np.complex128)
+    patterns, inverse = np.unique(good, axis=0, return_inverse=True)
+    inverse = np.ravel(inverse)
+    for p, pattern in enumerate(patterns):
+        if pattern.sum() < nterm:
+            continue
+        rows = np.nonzero(inverse == p)[0]
+        pinv = np.linalg.pinv(basis[cont[pattern]])
+        coef[rows] = values[rows][:, pattern] @ pinv.T
+    return coef.reshape(ncorr, nrow, nterm).transpose(0, 2, 1)
+
+
+def _data_digest(sub, datacolumn, nsample=8):
+    # Identity of the data: a digest of evenly spaced rows of datacolumn (and their times)
+    nrow = sub.nrows()
+    h = hashlib.sha1()
+    for row in np.unique(np.linspace(0, nrow - 1, min(nsample, nrow)).astype(int)):
+        h.update(np.ascontiguousarray(sub.getcell(datacolumn, int(row))).tobytes())
+        h.update(repr(sub.getcell('TIME', int(row))).encode())
+    return h.hexdigest()
+
+
+def _flag_digest(sub, mask, block_rows):
+    # Digest of FLAG on the continuum channels, the only flags the fit depends on
+    h = hashlib.sha1()
+    cont = np.nonzero(mask)[0]
+    nrow = sub.nrows()
+    for r0 in range(0, nrow, block_rows):
+        flag = sub.getcol('FLAG', startrow=r0, nrow=min(block_rows, nrow - r0))
+        h.update(np.packbits(flag[:, cont, :]).tobytes())
+    return h.hexdigest()
+
+
+def _fit_key(vis, spw, fitorder, mask, datacolumn, nrow, digest):
+    h = hashlib.sha1()
+    h.update(repr((os.path.abspath(vis), spw, fitorder, datacolumn, nrow, digest)).encode())
+    h.update(np.packbits(mask).tobytes())
+    return h.hexdigest()[:16]
+
+
+def ensure_column(vis, column, like='DATA'):
+    # Add 'column' to the main table with the description of 'like', if missing
+    tb.open(vis, nomodify=False)
+    try:
+        if column in tb.colnames():
+            return False
+        desc = tb.getcoldesc(like)
+        desc.pop('comment', None)
+        # same kind of storage manager as 'like', under a new name
+        dminfo = [dm for dm in tb.getdminfo().values() if like in dm['COLUMNS']][0]
+        dminfo = {'TYPE': dminfo['TYPE'], 'NAME': column + '_DM', 'SPEC': dminfo['SPEC']}
+        tb.addcols({column: desc}, dminfo)
+        return True
+    finally:
+        tb.close()
+
+
+def contsub(vis, fitspec, fitorder=0, datacolumn='DATA', outcolumn='CORRECTED_DATA',
+            block_rows=20000, refit=False):
+    """
+    Subtract the continuum fitted on the fitspec channels of datacolumn and
+    write the result to outcolumn of the same MS. Rows/correlations with too
+    few unflagged continuum channels are copied unchanged. Returns the
+    number of spectral windows that were fitted (not loaded from the cache).
+    """
+    freqs = spw_frequencies(vis)
+    masks = parse_fitspec(fitspec, freqs)
+    cache_dir = vis.rstrip('/') + '.contsub_cache'
+    os.makedirs(cache_dir, exist_ok=True)
+    state_file = os.path.join(cache_dir, 'state.json')
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    if ensure_column(vis, outcolumn, like=datacolumn):
+        # a new, empty column: nothing has been subtracted into it yet
+        state = {}
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    try:
+        dd_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    finally:
+        tb.close()
+
+    tb.open(vis, nomodify=False)
+    try:
+        ddids = tb.getcol('DATA_DESC_ID')
+        fitted = 0
+        written = {}
+        for ddid in np.unique(ddids):
+            spw = int(dd_spw[ddid])
+            mask = masks[spw]
+            sub = tb.query('DATA_DESC_ID=={0}'.format(ddid))
+            try:
+                nrow = sub.nrows()
+                key = _fit_key(vis, spw, fitorder, mask, datacolumn, nrow,
+                               _data_digest(sub, datacolumn) + _flag_digest(sub, mask, block_rows))
+                written[str(ddid)] = key
+                if not refit and state.get(str(ddid)) == key:
+                    print('spw {0}: continuum already subtracted with these settings'.format(spw))
+                    continue
+                cache_file = os.path.join(cache_dir, 'ddid{0}_{1}.npy'.format(ddid, key))
+                coef_all = None
+                if not refit and os.path.exists(cache_file):
+                    coef_all = np.load(cache_file)
+                    print('spw {0}: loaded continuum fit {1}'.format(spw, cache_file))
+                basis = design_matrix(len(mask), fitorder)
+                new = coef_all is None
+                if new:
+                    ncorr = sub.getcell(datacolumn, 0).shape[0]
+                    coef_all = np.empty((ncorr, fitorder + 1, nrow), dtype=np.complex64)
+                for r0 in range(0, nrow, block_rows):
+                    n = min(block_rows, nrow - r0)
+                    data = sub.getcol(datacolumn, startrow=r0, nrow=n)
+                    if new:
+                        flag = sub.getcol('FLAG', startrow=r0, nrow=n)
+                        coef_all[:, :, r0:r0 + n] = fit_block(data, flag, mask, basis)
+                    coef = coef_all[:, :, r0:r0 + n]
+                    model = np.einsum('ct,xtr->xcr', basis, coef)
+                    out = np.where(np.isfinite(model), data - model, data)
+                    sub.putcol(outcolumn, out.astype(data.dtype), startrow=r0, nrow=n)
+                if new:
+                    np.save(cache_file, coef_all)
+                    fitted += 1
+                print('spw {0}: continuum (order {1}, {2} of {3} channels) subtracted from {4} rows'.format(
+                    spw, fitorder, int(mask.sum()), len(mask), nrow))
+            finally:
+                sub.close()
+    finally:
+        tb.close()
+
+    with open(state_file, 'w') as f:
+        json.dump(written, f, indent=1)
+    return fitted
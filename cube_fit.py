@@ -0,0 +1,231 @@
+"""
+Gaussian fitting of many spectra at once
+
+Instead of fitting one spectrum at a time (pyspeckit specfit), all the spectra
+of a block of pixels are fitted together with a vectorised Levenberg-Marquardt:
+the model, Jacobian and normal equations of every spectrum are computed as
+stacked arrays and solved with batched linear algebra, and spectra drop out
+of the iteration as they converge. Initial guesses come from the spectra
+themselves (peak, local moments), so nothing needs to be hard-coded.
+
+Parameters are (amplitude, centre, sigma) per component, with centre and
+sigma in channels; spectral_params() converts them to the spectral axis of
+the cube.
+
+    fit = fit_spectra(spectra, ncomp=3)                     # (nspec, nchan) array
+    maps = fit_cube('PN_Hb_5.spw_0.image.fits', ncomp=1, chans=(420, 630), min_peak=0.03)
+    maps['params'][1]          # map of the centre (channels) of the first component
+"""
+
+import os
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from cube_stats import load_cube, spectral_axis
+
+param_names = ['amp', 'centre', 'sigma']
+fwhm_factor = 2.0*np.sqrt(2.0*np.log(2.0))
+
+
+def _model_jacobian(x, params):
+    # Sum of Gaussians (n, m) and its Jacobian (n, 3k, m) for params (n, 3k)
+    n = params.shape[0]
+    amp, centre, sigma = params[:, 0::3, None], params[:, 1::3, None], params[:, 2::3, None]
+    d = x - centre
+    e = np.exp(-0.5*(d/sigma)**2)
+    model = (amp*e).sum(axis=1)
+    jac = np.stack([e, amp*e*d/sigma**2, amp*e*d**2/sigma**3], axis=2)
+    return model, jac.reshape(n, -1, len(x))
+
+
+def moment_guesses(spectra, ncomp=1, x=None):
+    """
+    Initial (amp, centre, sigma) for ncomp components of each spectrum: the
+    highest remaining peak, the half-maximum width around it and the intensity
+    weighted centre within that width; the component is then subtracted and
+    the next one is taken from the residual.
+    """
+    spectra = np.nan_to_num(np.asarray(spectra, dtype=np.float64))
+    n, m = spectra.shape
+    if x is None:
+        x = np.arange(m, dtype=np.float64)
+    idx = np.arange(m)
+    residual = spectra.copy()
+    guesses = np.zeros((n, 3*ncomp))
+    for k in range(ncomp):
+        peak = residual.argmax(axis=1)
+        amp = residual[np.arange(n), peak]
+        below = residual < 0.5*amp[:, None]
+        left = np.where(below & (idx < peak[:, None]), idx, -1).max(axis=1)
+        right = np.where(below & (idx > peak[:, None]), idx, m).min(axis=1)
+        inside = (idx > left[:, None]) & (idx < right[:, None])
+        weight = np.where(inside, np.clip(residual, 0, None), 0.0)
+        total = weight.sum(axis=1)
+        centre = np.where(total > 0, (weight*x).sum(axis=1)/np.where(total > 0, total, 1), x[peak])
+        sigma = np.maximum(right - left - 1, 1)/fwhm_factor
+        guesses[:, 3*k:3*k+3] = np.column_stack([amp, centre, sigma])
+        residual -= _model_jacobian(x, guesses[:, 3*k:3*k+3])[0]
+    return guesses
+
+
+def fit_spectra(spectra, ncomp=1, guesses=None, x=None, noise=None, maxiter=100, tol=1e-6):
+    """
+    Fit ncomp Gaussians to every row of 'spectra' (nspec, nchan) at once.
+    guesses: (nspec, 3*ncomp) or one set of 3*ncomp for all (default: moment_guesses)
+    noise: noise per spectrum (scalar or array); if None the uncertainties are
+        scaled by the reduced chi^2
+    NaN channels are ignored. Returns a dict with 'params' and 'errors'
+    (nspec, 3*ncomp), 'chi2', 'niter' and 'converged'.
+    """
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+    n, m = spectra.shape
+    if x is None:
+        x = np.arange(m, dtype=np.float64)
+    if guesses is None:
+        guesses = moment_guesses(spectra, ncomp, x)
+    params = np.array(np.broadcast_to(guesses, (n, 3*ncomp)), dtype=np.float64)
+    npar = params.shape[1]
+
+    weight = np.isfinite(spectra).astype(np.float64)
+    if noise is not None:
+        weight /= np.broadcast_to(np.asarray(noise, dtype=np.float64), (n,))[:, None]**2
+    y = np.where(weight > 0, spectra, 0.0)
+
+    def chi2_of(p, rows):
+        model = _model_jacobian(x, p)[0]
+        return (weight[rows]*(y[rows] - model)**2).sum(axis=1)
+
+    chi2 = chi2_of(params, slice(None))
+    lam = np.full(n, 1e-3)
+    niter = np.zeros(n, dtype=int)
+    active = np.ones(n, dtype=bool)
+    converged = np.zeros(n, dtype=bool)
+    eye = np.eye(npar)
+    for it in range(maxiter):
+        rows = np.nonzero(active)[0]
+        if len(rows) == 0:
+            break
+        model, jac = _model_jacobian(x, params[rows])
+        wj = jac*weight[rows, None, :]
+        hess = np.matmul(wj, jac.transpose(0, 2, 1))
+        grad = np.matmul(wj, (y[rows] - model)[:, :, None])[:, :, 0]
+        diag = np.einsum('npp->np', hess)
+        damped = hess + (lam[rows, None]*diag + 1e-12*diag.max(axis=1, keepdims=True) + 1e-300)[:, :, None]*eye
+        step = np.linalg.solve(damped, grad[:, :, None])[:, :, 0]
+
+        trial = params[rows] + step
+        trial[:, 2::3] = np.abs(trial[:, 2::3])
+        new_chi2 = chi2_of(trial, rows)
+        better = new_chi2 < chi2[rows]
+        done = better & (chi2[rows] - new_chi2 <= tol*np.maximum(new_chi2, 1e-300))
+        params[rows[better]] = trial[better]
+        chi2[rows[better]] = new_chi2[better]
+        lam[rows] = np.where(better, lam[rows]/10.0, lam[rows]*10.0)
+        niter[rows] += 1
+        # a damping this large means no step improves the fit any more: we are at the minimum
+        done |= lam[rows] > 1e10
+        converged[rows[done]] = True
+        active[rows[done]] = False
+
+    # uncertainties from the curvature matrix at the solution
+    model, jac = _model_jacobian(x, params)
+    hess = np.matmul(jac*weight[:, None, :], jac.transpose(0, 2, 1))
+    cov = np.linalg.pinv(hess)
+    if noise is None:
+        dof = np.maximum(weight.sum(axis=1) - npar, 1)
+        cov *= (chi2/dof)[:, None, None]
+    errors = np.sqrt(np.abs(np.einsum('npp->np', cov)))
+    return {'params': params, 'errors': errors, 'chi2': chi2, 'niter': niter, 'converged': converged}
+
+
+def _fit_block(spectra, ncomp, x, noise, maxiter):
+    # Worker: fit one block of spectra
+    return fit_spectra(spectra, ncomp, x=x, noise=noise, maxiter=maxiter)
+
+
+def fit_cube(source, ncomp=1, chans=None, mask=None, min_peak=None, noise=None,
+             block=1024, max_workers=1, mp_context='fork', maxiter=100):
+    """
+    Fit every pixel of a cube. Returns maps of shape (3*ncomp, ny, nx) of
+    'params' and 'errors' (NaN where not fitted), plus 'chi2', 'niter' and
+    'converged' maps; centres and sigmas are in channels of the full cube.
+    chans: (first, last) channel range used in the fit (inclusive)
+    mask: 2D boolean array of the pixels to fit
+    min_peak: only fit spectra whose peak (within chans) is above this value
+    block: number of spectra fitted together (and sent to a worker)
+    max_workers: number of processes (1: fit in this process); the workers only
+        need numpy, so they are forked by default, which also works from a script
+        without a __main__ guard
+    """
+    data, _ = load_cube(source)
+    nchan, ny, nx = data.shape
+    c0, c1 = (0, nchan - 1) if chans is None else chans
+    x = np.arange(c0, c1 + 1, dtype=np.float64)
+    npar = 3*ncomp
+    maps = {'params': np.full((npar, ny, nx), np.nan),
+            'errors': np.full((npar, ny, nx), np.nan),
+            'chi2': np.full((ny, nx), np.nan),
+            'niter': np.zeros((ny, nx), dtype=int),
+            'converged': np.zeros((ny, nx), dtype=bool)}
+
+    def blocks():
+        # blocks of rows (all channels of the range) with the spectra to fit
+        rows_per_read = max(1, block // nx)
+        for y0 in range(0, ny, rows_per_read):
+            y1 = min(y0 + rows_per_read, ny)
+            spectra = np.asarray(data[c0:c1 + 1, y0:y1, :], dtype=np.float64).reshape(len(x), -1).T
+            pix = np.arange(y0*nx, y1*nx)
+            keep = np.isfinite(spectra).any(axis=1)
+            if mask is not None:
+                keep &= np.asarray(mask).ravel()[pix]
+            if min_peak is not None:
+                keep &= np.fmax.reduce(spectra, axis=1) > min_peak
+            if keep.any():
+                yield pix[keep], spectra[keep]
+
+    def store(pix, fit):
+        yy, xx = np.unravel_index(pix, (ny, nx))
+        maps['params'][:, yy, xx] = fit['params'].T
+        maps['errors'][:, yy, xx] = fit['errors'].T
+        for key in ['chi2', 'niter', 'converged']:
+            maps[key][yy, xx] = fit[key]
+
+    nfit = 0
+    if max_workers == 1:
+        for pix, spectra in blocks():
+            store(pix, _fit_block(spectra, ncomp, x, noise, maxiter))
+            nfit += len(pix)
+    else:
+        ctx = multiprocessing.get_context(mp_context)
+        max_inflight = 2*(max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+            # keep a few blocks per worker in flight so that the cube is never all in memory
+            pending = []
+            for pix, spectra in blocks():
+                pending.append((pix, pool.submit(_fit_block, spectra, ncomp, x, noise, maxiter)))
+                nfit += len(pix)
+                while len(pending) > max_inflight:
+                    pix, future = pending.pop(0)
+                    store(pix, future.result())
+            for pix, future in pending:
+                store(pix, future.result())
+    print('Fitted {0} spectra, {1} converged'.format(nfit, maps['converged'].sum()))
+    return maps
+
+
+def spectral_params(params, header, nchan, errors=False, axis=None):
+    """
+    Convert (amp, centre, sigma) with centre/sigma in channels (first axis of
+    'params', any trailing shape) to the spectral axis of the cube (e.g. Hz),
+    or to 'axis' (the coordinate of each channel) if given.
+    errors=True for uncertainties: the centre is then only scaled, not shifted.
+    """
+    if axis is None:
+        axis = spectral_axis(header, nchan)
+    params = np.array(params, dtype=np.float64)
+    if errors:
+        params[1::3] = params[1::3]*abs(axis[-1] - axis[0])/max(nchan - 1, 1)
+    else:
+        params[1::3] = np.interp(params[1::3], np.arange(nchan), axis)
+    params[2::3] = params[2::3]*abs(axis[-1] - axis[0])/max(nchan - 1, 1)
+    return params
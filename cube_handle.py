@@ -0,0 +1,70 @@
+"""
+A cube opened once and shared by all the analysis steps
+
+Cube opens the FITS file once, memory-maps the data (degenerate axes dropped,
+indexed [channel, y, x]) and caches the header, WCS, spectral axis,
+velocities and per-channel statistics the first time they are asked for.
+It has .data and .header, so it can be given to every cube_* function
+instead of a file name, and channels/sub-cubes are views of the memory map:
+only the pixels actually used are read.
+
+    cube = Cube('PN_Hb_5.spw_0.image.fits')
+    cube.channel(522)                  # 2D view
+    cube.stats['rms']                  # computed once, on first use
+    region_spectra(cube, regions)
+"""
+
+from astropy.wcs import WCS
+from cube_stats import load_cube, cube_stats, spectral_axis
+from cube_moments import velocity_axis
+
+
+class Cube(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data, self.header = load_cube(filename)
+        self._cache = {}
+
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nchan(self):
+        return self.data.shape[0]
+
+    @property
+    def wcs(self):
+        return self._cached('wcs', lambda: WCS(self.header))
+
+    @property
+    def celestial(self):
+        return self.wcs.celestial
+
+    @property
+    def spectral_axis(self):
+        return self._cached('spectral_axis', lambda: spectral_axis(self.header, self.nchan))
+
+    @property
+    def velocity(self):
+        # (velocity of each channel, units), see cube_moments.velocity_axis
+        return self._cached('velocity', lambda: velocity_axis(self.header, self.nchan))
+
+    @property
+    def stats(self):
+        # Per-channel and full-cube statistics (one pass over the cube, the first time only)
+        return self._cached('stats', lambda: cube_stats(self))
+
+    def channel(self, chan):
+        return self.data[chan]
+
+    def subcube(self, chans=None, y=None, x=None):
+        # View of a channel range and/or pixel box, each given as (first, last+1)
+        chans, y, x = [slice(*r) if r is not None else slice(None) for r in (chans, y, x)]
+        return self.data[chans, y, x]
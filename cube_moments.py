@@ -0,0 +1,135 @@
+"""
+Moment maps from a single pass over a cube
+
+Moments 0 (integrated intensity), 1 (intensity weighted velocity), 2
+(intensity weighted dispersion) and 8 (maximum) are accumulated together
+while the memory-mapped cube is read in slabs of channels, with the same
+selections as immoments: a channel range, an includepix range and a region
+(file or regions objects). FITS files are only written when asked for.
+
+    moments = cube_moments('PN_Hb_5.spw_0.image.fits', chans='420~630',
+                           includepix=[0.03, 100], region='region.crtf')
+    moments[0], moments[1], moments[2], moments[8]
+
+The spectral axis is converted to radio velocity (km/s) with the rest
+frequency of the header (RESTFRQ/RESTFREQ); without one, moments 1 and 2 are
+in the units of the spectral axis.
+"""
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from cube_stats import load_cube, channel_slabs, spectral_axis
+from cube_spectra import read_regions
+
+c_kms = 299792.458
+
+# Suffixes used by immoments for each moment
+moment_names = {0: 'integrated', 1: 'weighted_coord', 2: 'weighted_dispersion_coord', 8: 'maximum'}
+
+
+def parse_chans(chans, nchan):
+    # Channel mask from a CASA-style selection, e.g. '420~630' or '10~50;300~400'
+    if chans is None or chans == '':
+        return np.ones(nchan, dtype=bool)
+    selected = np.zeros(nchan, dtype=bool)
+    for part in str(chans).replace(',', ';').split(';'):
+        lo, _, hi = part.partition('~')
+        selected[int(lo):int(hi or lo) + 1] = True
+    return selected
+
+
+def velocity_axis(header, nchan):
+    # Radio velocity (km/s) of each channel, and its units
+    axis = spectral_axis(header, nchan)
+    restfreq = header.get('RESTFRQ', header.get('RESTFREQ')) if header is not None else None
+    ctype = str(header.get('CTYPE3', '')) if header is not None else ''
+    if restfreq and ctype.startswith('FREQ'):
+        return c_kms*(1.0 - axis/restfreq), 'km/s'
+    return axis, header.get('CUNIT3', '') if header is not None else ''
+
+
+def region_mask(regions, shape, header=None):
+    # 2D boolean mask of the union of the regions
+    mask = np.zeros(shape, dtype=bool)
+    for region in read_regions(regions, header):
+        image = region.to_mask(mode='center').to_image(shape)
+        if image is not None:
+            mask |= image.astype(bool)
+    return mask
+
+
+def cube_moments(source, moments=(0, 1, 2, 8), chans=None, includepix=None, region=None,
+                 outfile=None, max_bytes=None):
+    """
+    Moment maps of a cube in one pass.
+    chans: channel selection ('420~630'); includepix: [min, max] of the pixels
+    used; region: region file or list of regions objects (pixels outside are
+    blanked). Returns a dict moment -> 2D map (NaN where no pixel was used),
+    plus 'velocity' (the spectral coordinate of each channel) and 'units'.
+    If outfile is given, writes outfile + '.<immoments name>.fits' per moment.
+    """
+    data, header = load_cube(source)
+    nchan, ny, nx = data.shape
+    # a cube_handle.Cube has the velocities cached already
+    velocity, units = source.velocity if hasattr(source, 'velocity') else velocity_axis(header, nchan)
+    selected = parse_chans(chans, nchan)
+    width = np.abs(np.gradient(velocity)) if nchan > 1 else np.ones(1)
+    # moments 1 and 2 relative to a reference velocity, to keep the sums well conditioned
+    vref = velocity[selected].mean()
+    dv = velocity - vref
+    spatial = region_mask(region, (ny, nx), header) if region is not None else None
+
+    s0 = np.zeros((ny, nx))     # sum of I
+    s0w = np.zeros((ny, nx))    # sum of I*channel width
+    s1 = np.zeros((ny, nx))     # sum of I*v
+    s2 = np.zeros((ny, nx))     # sum of I*v^2
+    peak = np.full((ny, nx), -np.inf)
+    npts = np.zeros((ny, nx), dtype=np.int64)
+
+    for c0, c1 in channel_slabs(data.shape, max_bytes=max_bytes):
+        chan = np.nonzero(selected[c0:c1])[0]
+        if len(chan) == 0:
+            continue
+        slab = np.asarray(data[c0 + chan[0]:c0 + chan[-1] + 1], dtype=np.float64)[chan - chan[0]]
+        use = np.isfinite(slab)
+        if includepix is not None:
+            use &= (slab >= includepix[0]) & (slab <= includepix[1])
+        slab = np.where(use, slab, 0.0)
+        v = dv[c0 + chan][:, None, None]
+        npts += use.sum(axis=0)
+        s0 += slab.sum(axis=0)
+        s0w += (slab*width[c0 + chan][:, None, None]).sum(axis=0)
+        s1 += (slab*v).sum(axis=0)
+        s2 += (slab*v*v).sum(axis=0)
+        peak = np.maximum(peak, np.where(use, slab, -np.inf).max(axis=0))
+
+    blank = npts == 0
+    if spatial is not None:
+        blank |= ~spatial
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mom1 = s1/s0
+        mom2 = np.sqrt(np.clip(s2/s0 - mom1**2, 0, None))
+    result = {0: s0w, 1: mom1 + vref, 2: mom2, 8: peak}
+    result = dict((m, np.where(blank, np.nan, result[m])) for m in moments)
+    result['velocity'] = velocity
+    result['units'] = units
+
+    if outfile is not None:
+        write_moments(result, moments, header, outfile)
+    return result
+
+
+def write_moments(result, moments, header, outfile):
+    # One 2D FITS image per moment, named as by immoments (+ '.fits')
+    celestial = WCS(header).celestial.to_header() if header is not None else fits.Header()
+    bunit = header.get('BUNIT', '') if header is not None else ''
+    units = {0: bunit + '.' + result['units'], 1: result['units'], 2: result['units'], 8: bunit}
+    for m in moments:
+        hdr = celestial.copy()
+        for key in ['BMAJ', 'BMIN', 'BPA', 'OBJECT']:
+            if header is not None and key in header:
+                hdr[key] = header[key]
+        hdr['BUNIT'] = units[m]
+        fits.PrimaryHDU(result[m].astype(np.float32), header=hdr).writeto(
+            outfile + '.' + moment_names[m] + '.fits', overwrite=True)
@@ -0,0 +1,99 @@
+"""
+Streaming statistics of (large) FITS cubes
+
+The cube is memory-mapped and read in slabs of channels, so only one slab is
+in memory at a time and cubes larger than RAM can be handled. A single pass
+gives per-channel and whole-cube min, max, mean, rms (as in imstat:
+sqrt(sum(x^2)/n)), number of valid pixels and number of NaNs.
+
+    stats = cube_stats('PN_Hb_5.spw_0.image.fits')
+    stats['rms'][522]         # rms of channel 522
+    stats['cube']['rms']      # rms of the full cube
+"""
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+# Default memory used by one slab of channels
+slab_bytes = 256*1024**2
+
+
+def load_cube(source):
+    """
+    Return (data, header) for a cube given as a FITS file name, an HDU (anything
+    with .data and .header) or an array. The data are memory-mapped when read
+    from a file, and degenerate axes (e.g. Stokes) are dropped so that the
+    result is indexed [channel, y, x].
+    """
+    if isinstance(source, str):
+        # the memory map stays valid after the file is closed
+        with fits.open(source, memmap=True) as hdul:
+            data, header = hdul[0].data, hdul[0].header
+    elif hasattr(source, 'data') and hasattr(source, 'header'):
+        data, header = source.data, source.header
+    else:
+        data, header = np.asarray(source), None
+    while data.ndim > 3:
+        if data.shape[0] != 1:
+            print('Keeping only the first plane of the leading axis of shape {0}'.format(data.shape))
+        data = data[0]
+    return data, header
+
+
+def spectral_axis(header, nchan):
+    # Spectral coordinate of each channel (in the units of the header)
+    return WCS(header).spectral.pixel_to_world_values(np.arange(nchan))
+
+
+def channel_slabs(shape, itemsize=8, max_bytes=None):
+    # Channel ranges (c0, c1) of at most max_bytes each (converted to float64)
+    if max_bytes is None:
+        max_bytes = slab_bytes
+    plane = int(np.prod(shape[1:]))*itemsize
+    step = max(1, int(max_bytes // plane))
+    return [(c0, min(c0 + step, shape[0])) for c0 in range(0, shape[0], step)]
+
+
+def cube_stats(source, max_bytes=None):
+    """
+    Per-channel and full-cube statistics in one pass over the cube.
+    Returns a dict of per-channel arrays (min, max, mean, rms, npts, nnan, sum,
+    sumsq) and 'cube', a dict with the same statistics for the whole cube.
+    NaNs (blanked pixels) are excluded; a fully blanked channel gets NaN stats.
+    """
+    data, _ = load_cube(source)
+    nchan = data.shape[0]
+    stats = dict((key, np.full(nchan, np.nan)) for key in ['min', 'max', 'sum', 'sumsq'])
+    stats['npts'] = np.zeros(nchan, dtype=np.int64)
+    stats['nnan'] = np.zeros(nchan, dtype=np.int64)
+
+    for c0, c1 in channel_slabs(data.shape, max_bytes=max_bytes):
+        slab = np.asarray(data[c0:c1], dtype=np.float64).reshape(c1 - c0, -1)
+        valid = np.isfinite(slab)
+        stats['nnan'][c0:c1] = np.isnan(slab).sum(axis=1)
+        # fmin/fmax ignore NaNs (and give NaN for an all-NaN channel without warnings)
+        stats['min'][c0:c1] = np.fmin.reduce(slab, axis=1)
+        stats['max'][c0:c1] = np.fmax.reduce(slab, axis=1)
+        slab[~valid] = 0.0
+        stats['sum'][c0:c1] = slab.sum(axis=1)
+        stats['sumsq'][c0:c1] = np.einsum('ij,ij->i', slab, slab)
+        stats['npts'][c0:c1] = valid.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['mean'] = stats['sum']/stats['npts']
+        stats['rms'] = np.sqrt(stats['sumsq']/stats['npts'])
+    stats['sum'][stats['npts'] == 0] = np.nan
+    stats['sumsq'][stats['npts'] == 0] = np.nan
+
+    npts = stats['npts'].sum()
+    total = {'min': np.nanmin(stats['min']) if npts else np.nan,
+             'max': np.nanmax(stats['max']) if npts else np.nan,
+             'sum': np.nansum(stats['sum']),
+             'sumsq': np.nansum(stats['sumsq']),
+             'npts': int(npts),
+             'nnan': int(stats['nnan'].sum())}
+    total['mean'] = total['sum']/npts if npts else np.nan
+    total['rms'] = np.sqrt(total['sumsq']/npts) if npts else np.nan
+    stats['cube'] = total
+    return stats
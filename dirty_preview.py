@@ -0,0 +1,139 @@
+"""
+Seconds-long dirty image check on a subset of the visibilities
+
+Instead of tclean over the whole MS, preview_dirty() reads a stratified
+sample of the rows (every k-th integration of every baseline, with a random
+start per baseline, so all baselines and the whole track are represented)
+and every chan_step-th channel of one spectral window, grids them with
+natural weights onto a uv grid (nearest cell) and FFTs to a Stokes I dirty
+image and PSF (no primary beam or w-term: a data check, not an image).
+It also estimates the naturally weighted continuum noise of the full data
+from the scatter of the sampled visibilities.
+
+    preview = preview_dirty('NGC3351_12m_co21.ms', cell_arcsec=0.5, imsize=256)
+    preview['image'], preview['psf'], preview['noise']
+"""
+
+import numpy as np
+from casatools import table
+from ms_index import ms_index
+
+tb = table()
+c = 299792458.0
+
+
+def stratified_rows(antenna1, antenna2, time, fraction, seed=None):
+    """
+    Row numbers of about 'fraction' of the cross-correlation rows: every
+    k-th time of each baseline, starting at a random offset per baseline.
+    """
+    rng = np.random.default_rng(seed)
+    k = max(1, int(round(1.0/fraction)))
+    cross = np.nonzero(antenna1 != antenna2)[0]
+    nant = int(max(antenna1.max(), antenna2.max())) + 1
+    baseline = antenna1[cross]*nant + antenna2[cross]
+    order = np.lexsort((time[cross], baseline))
+    bl = baseline[order]
+    # position of each row within its baseline's time sequence
+    starts = np.concatenate([[0], np.nonzero(np.diff(bl))[0] + 1])
+    rank = np.arange(len(bl)) - np.repeat(starts, np.diff(np.concatenate([starts, [len(bl)]])))
+    offset = rng.integers(0, k, size=nant*nant)
+    keep = (rank % k) == offset[bl]
+    return np.sort(cross[order[keep]])
+
+
+def grid_visibilities(u, v, vis, weight, imsize, cell_rad):
+    """
+    Natural-weighted dirty image and PSF (peak 1) from visibilities with
+    u, v in wavelengths. Each sample and its conjugate are put in the
+    nearest uv cell; samples outside the grid are dropped.
+    """
+    duv = 1.0/(imsize*cell_rad)
+    # -u: right ascension increases to the left of the image
+    iu = np.round(-u/duv).astype(np.int64)
+    iv = np.round(v/duv).astype(np.int64)
+    inside = (np.abs(iu) < imsize//2) & (np.abs(iv) < imsize//2) & (weight > 0)
+    iu, iv, vis, weight = iu[inside], iv[inside], vis[inside], weight[inside]
+    cells = np.concatenate([(iv % imsize)*imsize + iu % imsize, (-iv % imsize)*imsize + (-iu) % imsize])
+    wvis = np.concatenate([weight*vis, weight*np.conj(vis)])
+    w = np.concatenate([weight, weight])
+    npix = imsize*imsize
+    grid = (np.bincount(cells, wvis.real, npix) + 1j*np.bincount(cells, wvis.imag, npix)).reshape(imsize, imsize)
+    wgrid = np.bincount(cells, w, npix).reshape(imsize, imsize)
+    norm = npix/max(w.sum(), 1e-30)
+    image = np.fft.fftshift(np.fft.ifft2(grid).real)*norm
+    psf = np.fft.fftshift(np.fft.ifft2(wgrid).real)*norm
+    return image, psf
+
+
+def _robust_sigma(values):
+    # Standard deviation from the median absolute deviation
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return np.nan
+    return 1.4826*np.median(np.abs(values - np.median(values)))
+
+
+def preview_dirty(vis, cell_arcsec=0.5, imsize=256, fraction=0.05, spw=0, chan_step=None,
+                  max_chans=64, column='DATA', seed=None):
+    """
+    Dirty image and PSF from a sample of the rows and channels of one
+    spectral window. chan_step defaults to keeping at most max_chans channels.
+    Returns a dict with 'image', 'psf' (imsize x imsize, Jy/beam for the
+    image), 'noise' (estimated full-data continuum rms of the spw, Jy/beam),
+    'noise_per_channel', and the numbers of rows/channels used.
+    """
+    index = ms_index(vis)
+    nchan = index['spws'][spw]['nchan']
+    chan_step = chan_step or max(1, int(np.ceil(nchan/float(max_chans))))
+    ddids = [i for i, s in enumerate(index['data_descriptions']) if s == spw]
+
+    tb.open(vis)
+    try:
+        sub = tb.query('DATA_DESC_ID in [{0}]'.format(','.join(str(d) for d in ddids)))
+        nrow_spw = sub.nrows()
+        rows = stratified_rows(sub.getcol('ANTENNA1'), sub.getcol('ANTENNA2'), sub.getcol('TIME'),
+                               fraction, seed)
+        sel = sub.selectrows(rows.tolist())
+        try:
+            data = sel.getcolslice(column, blc=[0, 0], trc=[-1, -1], incr=[1, chan_step])
+            flag = sel.getcolslice('FLAG', blc=[0, 0], trc=[-1, -1], incr=[1, chan_step])
+            uvw = sel.getcol('UVW')
+            weight = sel.getcol('WEIGHT')
+            ncross = np.count_nonzero(sub.getcol('ANTENNA1') != sub.getcol('ANTENNA2'))
+        finally:
+            sel.close()
+            sub.close()
+    finally:
+        tb.close()
+
+    tb.open(vis + '/SPECTRAL_WINDOW')
+    try:
+        freq = np.ravel(tb.getcell('CHAN_FREQ', spw))[::chan_step]
+    finally:
+        tb.close()
+
+    # Stokes I from the parallel hands (first and last correlations)
+    npol = data.shape[0]
+    pols = [0, npol - 1] if npol > 1 else [0]
+    good = ~flag[pols]
+    stokes_w = weight[pols][:, None, :]*good          # (npol, nchan, nrow)
+    wsum = stokes_w.sum(axis=0)
+    visI = np.where(wsum > 0, (data[pols]*stokes_w).sum(axis=0)/np.maximum(wsum, 1e-30), 0.0)
+
+    u = uvw[0][None, :]*freq[:, None]/c
+    v = uvw[1][None, :]*freq[:, None]/c
+    image, psf = grid_visibilities(u.ravel(), v.ravel(), visI.ravel(), wsum.ravel(),
+                                   imsize, np.radians(cell_arcsec/3600.0))
+
+    # noise of one visibility (one correlation, one channel) from the scatter of the
+    # imaginary parts, scaled to all unflagged visibilities of the spw
+    sigma_vis = _robust_sigma(data[pols].imag[good])
+    nvis_sample = np.count_nonzero(good)
+    scale = (ncross/float(max(len(rows), 1)))*(nchan/float(len(freq)))
+    nvis_full = nvis_sample*scale
+    noise = sigma_vis/np.sqrt(max(nvis_full, 1))
+    return {'image': image, 'psf': psf, 'noise': noise,
+            'noise_per_channel': noise*np.sqrt(nchan),
+            'peak': float(image.max()), 'nrow': len(rows), 'nrow_total': nrow_spw,
+            'nchan': len(freq), 'chan_step': chan_step, 'sigma_vis': sigma_vis}
@@ -1,52 +1,64 @@
-from casatools import table
+from ms_index import choose_gridder, data_column
+from dirty_preview import preview_dirty
+from plot_pipeline import render_panels
 # input vis name here ###########
 vis = 'NGC3351_12m_co21.ms'
 #################################
 name = vis + '.dirty_test'
-column = 'data'  # or 'corrected' if you have CORRECTED_DATA column
+column = data_column(vis)  # 'corrected' if there is a CORRECTED_DATA column
+# True: dirty image + PSF from ~5% of the rows in seconds (numpy gridder), instead of
+# the tclean check; False: the tclean check only
+preview = True
 
-tb = table()
-tb.open(vis + '/FIELD')
-phase_dir = tb.getcol('PHASE_DIR')
-tb.close()
-
-# Flatten safely: each field can have multiple reference directions
-is_mosaic = len({tuple(phase_dir[:, i, 0]) for i in range(phase_dir.shape[1])}) > 1
-gridder = 'mosaic' if is_mosaic else 'standard'
+# 'mosaic' if the fields have more than one phase centre (cached in <vis>.index.json)
+gridder = choose_gridder(vis)
 print('Gridder selected:', gridder)
 
+# --- Preview: sampled rows and channels, gridded in numpy ---
+if preview:
+    p = preview_dirty(vis, cell_arcsec=0.5, imsize=256, fraction=0.05,
+                      column='CORRECTED_DATA' if column == 'corrected' else 'DATA')
+    print('Preview from {0} of {1} rows, {2} channels (step {3})'.format(
+        p['nrow'], p['nrow_total'], p['nchan'], p['chan_step']))
+    print('Peak {0:.4g} Jy/beam; estimated full-data noise {1:.3g} Jy/beam '
+          '({2:.3g} Jy/beam per channel)'.format(p['peak'], p['noise'], p['noise_per_channel']))
+    render_panels(name + '.preview.png', 150,
+                  [{'data': p['image'], 'title': 'Dirty image (sampled)', 'cbar_label': 'Jy/beam'},
+                   {'data': p['psf'], 'title': 'PSF (sampled)'}])
+
 # --- Quick dirty image test ---
-tclean(
-    vis=vis,
-    imagename=name,
-    specmode='cube',
-    restfreq='230.538GHz',
-    outframe='LSRK',
-    nchan=1,
-    cell='0.5arcsec',
-    imsize=[256, 256],
-    weighting='natural',
-    gridder=gridder,
-    niter=0,
-    datacolumn=column,
-    calcpsf=True,
-    calcres=True,
-    restoration=False,
-    pbcor=False,
-    interactive=False
-)
+if not preview:
+    tclean(
+        vis=vis,
+        imagename=name,
+        specmode='cube',
+        restfreq='230.538GHz',
+        outframe='LSRK',
+        nchan=1,
+        cell='0.5arcsec',
+        imsize=[256, 256],
+        weighting='natural',
+        gridder=gridder,
+        niter=0,
+        datacolumn=column,
+        calcpsf=True,
+        calcres=True,
+        restoration=False,
+        pbcor=False,
+        interactive=False
+    )
 
-# if continuum
+    # if continuum
 
-tclean(
-    vis=vis,  # your continuum MS
-    imagename=name,
-    field='',               # all fields
-    spw='',                 # all SPWs
-    specmode='mfs',         # continuum
-    niter=0,                # no cleaning, just check if data reads
-    imsize=[64,64],         # small image to save time
-    cell='1.0arcsec',       # coarse cell
-    weighting='natural',    # maximize sensitivity
-    interactive=False       # no GUI
-)
+    tclean(
+        vis=vis,  # your continuum MS
+        imagename=name,
+        field='',               # all fields
+        spw='',                 # all SPWs
+        specmode='mfs',         # continuum
+        niter=0,                # no cleaning, just check if data reads
+        imsize=[64,64],         # small image to save time
+        cell='1.0arcsec',       # coarse cell
+        weighting='natural',    # maximize sensitivity
+        interactive=False       # no GUI
+    )
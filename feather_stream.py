@@ -0,0 +1,347 @@
+"""
+Out-of-core feathering of a low-resolution cube into a high-resolution one
+
+Replaces the imsubimage -> immath -> imregrid -> feather chain of
+feather_PHANGS.py, which writes three full intermediate cubes. Here the
+high-resolution cube (template) is read in blocks of channels and, for each
+block, the low-resolution cube is
+    - read without degenerate (Stokes) axes (virtual dropdeg subimages),
+    - converted from K to Jy/beam if needed,
+    - interpolated to the high-resolution channels and pixels (linear, as
+      imregrid interpolation='linear'; the pixel/channel mapping between the
+      two cubes is computed once),
+and the two are combined in the Fourier domain as feather does:
+
+    F_out = F_high*(1 - W_low) + sdfactor*F_low*(Omega_high/Omega_low)
+
+with W_low the transform of the low-resolution beam, normalised to 1 at the
+origin. Only the output image is written. The block size follows a memory
+budget and the FFTs of a block use several threads.
+
+    feather_stream('NGC3351_12m_co21.image', 'NGC3351.fits', 'NGC3351_feather.image',
+                   memory_gb=8, fft_workers=8)
+
+feather_parallel splits the high-resolution channels into ranges, feathers
+each range in its own process (into a part image whose reference pixel
+already accounts for its first channel) and concatenates the parts along
+the spectral axis. With stencil_cache, the regridding weights are kept on
+disk (regrid_stencil) and reused by later runs on the same grids.
+
+Both cubes must have their spatial axes first and the spectral axis after
+them (as CASA and ALMA/PHANGS cubes do), in the same direction and spectral
+reference frames.
+"""
+
+import os
+import math
+import shutil
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import scipy.fft
+from scipy.ndimage import map_coordinates
+from casatools import image
+from regrid_stencil import stencil_geometry, apply_stencil
+
+c = 299792458.0
+k_B = 1.380649e-23
+angle_units = {'rad': 1.0, 'deg': math.pi/180, 'arcmin': math.pi/10800, "'": math.pi/10800,
+               'arcsec': math.pi/648000, '"': math.pi/648000}
+freq_units = {'Hz': 1.0, 'kHz': 1e3, 'MHz': 1e6, 'GHz': 1e9}
+
+
+def open_nodeg(name):
+    # Image tool on a virtual copy of 'name' without degenerate axes (nothing is written)
+    ia = image()
+    ia.open(name)
+    sub = ia.subimage(dropdeg=True)
+    ia.close()
+    return sub
+
+
+def _to_si(cs):
+    # Factors converting the world values of each axis to rad / Hz
+    return np.array([angle_units.get(u, freq_units.get(u, 1.0)) for u in cs.units()])
+
+
+def beam_area(beam):
+    # Solid angle (sr) of a Gaussian beam given as an ia.restoringbeam() record
+    def rad(q):
+        return q['value']*angle_units[q['unit']]
+    return math.pi/(4.0*math.log(2.0))*rad(beam['major'])*rad(beam['minor'])
+
+
+def single_beam(im):
+    # The restoring beam (the median plane beam for a multi-beam image)
+    beam = im.restoringbeam()
+    if 'beams' not in beam:
+        return beam
+    planes = [b['*0'] for b in beam['beams'].values()]
+    areas = [beam_area(b) for b in planes]
+    return planes[int(np.argsort(areas)[len(areas)//2])]
+
+
+def plane_beam_areas(im):
+    # Solid angle (sr) of the beam of every channel (the same for a single-beam image)
+    nchan = im.shape()[2]
+    beam = im.restoringbeam()
+    if 'beams' not in beam:
+        return np.full(nchan, beam_area(beam))
+    return np.array([beam_area(beam['beams']['*{0}'.format(i)]['*0']) for i in range(nchan)])
+
+
+def channel_frequencies(im):
+    # Frequency (Hz) of every channel of an image without degenerate axes
+    cs = im.coordsys()
+    nchan = im.shape()[2]
+    pix = np.zeros((3, nchan))
+    pix[0], pix[1] = cs.referencepixel()['numeric'][:2, None]
+    pix[2] = np.arange(nchan)
+    return cs.toworldmany(pix)['numeric'][2]*_to_si(cs)[2]
+
+
+def kelvin_factors(freq, areas):
+    # K -> Jy/beam factor of every channel, from arrays of frequencies (Hz) and beam areas (sr)
+    return 2.0*k_B*(np.asarray(freq)/c)**2*1e26*np.asarray(areas)
+
+
+def geometry(high, low):
+    """
+    Pixel mapping from the high-resolution grid to the low-resolution one.
+    Returns a dict with the fractional low-resolution (y, x) pixel of every
+    high-resolution pixel ('ly', 'lx', shape (ny, nx)), the fractional
+    low-resolution channel of every high-resolution channel ('lchan') and the
+    frequencies of the high-resolution channels ('freq').
+    """
+    hcs, lcs = high.coordsys(), low.coordsys()
+    hshape, lshape = high.shape(), low.shape()
+    nx, ny, nchan = hshape[0], hshape[1], hshape[2]
+    hsi, lsi = _to_si(hcs), _to_si(lcs)
+
+    # spatial: the mapping is the same for every channel
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    pix = np.zeros((3, nx*ny))
+    pix[0], pix[1] = xx.ravel(), yy.ravel()
+    pix[2] = hcs.referencepixel()['numeric'][2]
+    world = hcs.toworldmany(pix)['numeric']*hsi[:, None]
+    lworld = np.empty_like(world)
+    lworld[:2] = world[:2]/lsi[:2, None]
+    lworld[2] = lcs.referencevalue()['numeric'][2]
+    lpix = lcs.topixelmany(lworld)['numeric']
+
+    # spectral
+    pix = np.zeros((3, nchan))
+    pix[0], pix[1] = hcs.referencepixel()['numeric'][:2, None]
+    pix[2] = np.arange(nchan)
+    freq = hcs.toworldmany(pix)['numeric'][2]*hsi[2]
+    lworld = np.zeros((3, nchan))
+    lworld[:2] = lcs.referencevalue()['numeric'][:2, None]
+    lworld[2] = freq/lsi[2]
+    lchan = lcs.topixelmany(lworld)['numeric'][2]
+
+    return {'lx': lpix[0].reshape(ny, nx), 'ly': lpix[1].reshape(ny, nx),
+            'lchan': lchan, 'freq': freq, 'lshape': lshape}
+
+
+def beam_weight(shape, beam, pixel_rad):
+    """
+    Fourier transform of the (normalised) Gaussian beam on the rfft2 grid of
+    an image of shape (ny, nx) with square pixels of pixel_rad radians.
+    """
+    def rad(q):
+        return q['value']*angle_units[q['unit']]
+    fwhm_to_sigma = 1.0/(2.0*math.sqrt(2.0*math.log(2.0)))
+    smaj = rad(beam['major'])*fwhm_to_sigma/pixel_rad
+    smin = rad(beam['minor'])*fwhm_to_sigma/pixel_rad
+    pa = rad(beam['positionangle'])
+    ky = scipy.fft.fftfreq(shape[0])[:, None]
+    kx = scipy.fft.rfftfreq(shape[1])[None, :]
+    # major axis direction on the pixel grid: north through east, east towards -x
+    kmaj = -kx*math.sin(pa) + ky*math.cos(pa)
+    kmin = kx*math.cos(pa) + ky*math.sin(pa)
+    return np.exp(-2.0*math.pi**2*(smaj**2*kmaj**2 + smin**2*kmin**2))
+
+
+def _read_low_block(low, geo, hchans, scale):
+    """
+    Low-resolution data interpolated to the high-resolution channels hchans and
+    pixels, shape (nchan, ny, nx), in Jy/(low-resolution beam). 'scale' is the
+    K -> Jy/beam factor, a scalar or one per low-resolution channel (1 if
+    already in Jy/beam).
+    """
+    lchan = geo['lchan'][hchans]
+    nlow = geo['lshape'][2]
+    i0 = np.clip(np.floor(lchan).astype(int), 0, nlow - 1)
+    i1 = np.clip(i0 + 1, 0, nlow - 1)
+    w1 = np.clip(lchan - i0, 0.0, 1.0)
+    first, last = i0.min(), i1.max()
+    chunk = low.getchunk(blc=[0, 0, int(first)], trc=[-1, -1, int(last)])
+    mask = low.getchunk(blc=[0, 0, int(first)], trc=[-1, -1, int(last)], getmask=True)
+    scale = np.asarray(scale, dtype=np.float64)
+    if scale.ndim:
+        scale = scale[first:last + 1]
+    chunk = np.where(mask & np.isfinite(chunk), chunk, 0.0)*scale
+    # (x, y, chan) -> spectral interpolation, then the precomputed spatial mapping
+    planes = chunk[:, :, i0 - first]*(1.0 - w1) + chunk[:, :, i1 - first]*w1
+    outside = (lchan < -0.5) | (lchan > nlow - 0.5)
+    shape = geo['shape'] if 'matrix' in geo else geo['lx'].shape
+    out = np.empty((len(hchans),) + tuple(shape))
+    if 'matrix' not in geo:
+        coords = [geo['lx'].ravel(), geo['ly'].ravel()]
+    for i in range(len(hchans)):
+        if outside[i]:
+            out[i] = 0.0
+        elif 'matrix' in geo:
+            # cached stencil (regrid_stencil): one sparse mat-vec per channel
+            out[i] = apply_stencil(geo, planes[:, :, i].T)
+        else:
+            out[i] = map_coordinates(planes[:, :, i], coords, order=1, mode='constant',
+                                     cval=0.0).reshape(shape)
+    return out
+
+
+def feather_block(high_block, low_block, weight, ratio, sdfactor=1.0, fft_workers=None):
+    # Feather (nchan, ny, nx) blocks; 'ratio' is Omega_high/Omega_low
+    fh = scipy.fft.rfft2(high_block, workers=fft_workers)
+    fl = scipy.fft.rfft2(low_block, workers=fft_workers)
+    fh *= 1.0 - weight
+    fh += sdfactor*ratio*fl
+    return scipy.fft.irfft2(fh, s=high_block.shape[-2:], workers=fft_workers)
+
+
+def block_channels(shape, memory_gb):
+    # Channels per block for a memory budget: ~8 float64 planes per channel
+    # (high, low, FFTs and the output) plus the low-resolution planes read
+    plane = shape[0]*shape[1]*8*8
+    return max(1, int(memory_gb*1024**3 // plane))
+
+
+def feather_stream(highres, lowres, outfile, memory_gb=4.0, fft_workers=None, sdfactor=1.0,
+                   lowres_unit=None, restfreq=None, chans=None, overwrite=True, stencil_cache=None):
+    """
+    Feather lowres into highres, writing only 'outfile' (a CASA image with the
+    high-resolution grid, without degenerate axes).
+    lowres_unit: unit of the low-resolution cube (default: its header); if
+        'K' it is converted to Jy/beam channel by channel, with the frequency
+        and beam of each low-resolution plane (or at a single frequency restfreq)
+    chans: (first, last) high-resolution channels to process (default all)
+    memory_gb: memory budget for a block of channels; fft_workers: FFT threads
+    stencil_cache: directory of cached regrid stencils (regrid_stencil); the
+        pixel mapping is then computed only the first time for these grids
+    """
+    high = open_nodeg(highres)
+    low = open_nodeg(lowres)
+    try:
+        if stencil_cache:
+            geo = stencil_geometry(high, low, stencil_cache)
+        else:
+            geo = geometry(high, low)
+        nx, ny, nchan = high.shape()
+        hbeam, lbeam = single_beam(high), single_beam(low)
+        ratio = beam_area(hbeam)/beam_area(lbeam)
+
+        unit = lowres_unit or low.brightnessunit()
+        scale = 1.0
+        if unit == 'K':
+            freq = channel_frequencies(low) if restfreq is None else restfreq
+            scale = kelvin_factors(freq, plane_beam_areas(low))
+            print('Jy/beam per K = {0:.6g} - {1:.6g}'.format(scale.min(), scale.max()))
+
+        hcs = high.coordsys()
+        pixel_rad = abs(hcs.increment()['numeric'][1]*_to_si(hcs)[1])
+        # the FFTs are of (ny, nx) planes: the weight is built on that grid
+        weight = beam_weight((ny, nx), lbeam, pixel_rad)
+
+        c0, c1 = (0, nchan - 1) if chans is None else chans
+        if overwrite and os.path.exists(outfile):
+            shutil.rmtree(outfile)
+        out = image()
+        out.fromshape(outfile, [nx, ny, c1 - c0 + 1], csys=_channel_csys(hcs, c0), overwrite=overwrite)
+        try:
+            out.setbrightnessunit('Jy/beam')
+            out.setrestoringbeam(beam=hbeam)
+            step = block_channels((ny, nx), memory_gb)
+            for b0 in range(c0, c1 + 1, step):
+                b1 = min(b0 + step, c1 + 1)
+                hchans = np.arange(b0, b1)
+                hblock = high.getchunk(blc=[0, 0, b0], trc=[-1, -1, b1 - 1])
+                hmask = high.getchunk(blc=[0, 0, b0], trc=[-1, -1, b1 - 1], getmask=True)
+                hblock = np.where(hmask & np.isfinite(hblock), hblock, 0.0).transpose(2, 1, 0)
+                lblock = _read_low_block(low, geo, hchans, scale)
+                result = feather_block(hblock, lblock, weight, ratio, sdfactor, fft_workers)
+                out.putchunk(result.transpose(2, 1, 0).astype(np.float32), blc=[0, 0, b0 - c0])
+                print('Feathered channels {0}-{1} of {2}'.format(b0, b1 - 1, nchan))
+        finally:
+            out.close()
+    finally:
+        high.close()
+        low.close()
+    return outfile
+
+
+def _channel_csys(cs, c0):
+    # Coordinate system of a cube starting at channel c0 of 'cs'
+    rec = cs.torecord()
+    if c0:
+        cs = cs.copy()
+        refpix = cs.referencepixel()['numeric']
+        refpix[2] -= c0
+        cs.setreferencepixel(refpix)
+        rec = cs.torecord()
+    return rec
+
+
+def channel_ranges(nchan, nparts):
+    # Split nchan channels into nparts contiguous (first, last) ranges
+    edges = np.linspace(0, nchan, min(nparts, nchan) + 1).round().astype(int)
+    return [(int(a), int(b) - 1) for a, b in zip(edges[:-1], edges[1:])]
+
+
+def _feather_part(highres, lowres, partfile, chans, kwargs):
+    # Worker: CASA tools are per process
+    return feather_stream(highres, lowres, partfile, chans=chans, **kwargs)
+
+
+def feather_parallel(highres, lowres, outfile, max_workers=None, memory_gb=4.0, fft_workers=1,
+                     mp_context='spawn', keep_parts=False, **kwargs):
+    """
+    feather_stream over channel ranges in max_workers processes (default: the
+    number of cores), concatenated into 'outfile'. memory_gb is the budget of
+    each worker. Other keyword arguments are passed to feather_stream.
+    The workers are spawned (fresh CASA tools in each) and re-import the main
+    script: call this only from behind an if __name__ == '__main__' guard.
+    """
+    highres, lowres, outfile = [os.path.abspath(f) for f in (highres, lowres, outfile)]
+    max_workers = max_workers or os.cpu_count()
+    high = open_nodeg(highres)
+    nchan = high.shape()[2]
+    if kwargs.get('stencil_cache'):
+        # computed (or checked) once here, so the workers only load it
+        kwargs['stencil_cache'] = os.path.abspath(kwargs['stencil_cache'])
+        low = open_nodeg(lowres)
+        stencil_geometry(high, low, kwargs['stencil_cache'])
+        low.close()
+    high.close()
+    ranges = channel_ranges(nchan, max_workers)
+    parts = ['{0}.part{1:03d}'.format(outfile, i) for i in range(len(ranges))]
+    kwargs = dict(kwargs, memory_gb=memory_gb, fft_workers=fft_workers)
+
+    ctx = multiprocessing.get_context(mp_context)
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=ctx) as pool:
+        futures = [pool.submit(_feather_part, highres, lowres, part, chans, kwargs)
+                   for part, chans in zip(parts, ranges)]
+        for future, chans in zip(futures, ranges):
+            future.result()
+            print('Feathered part with channels {0}-{1}'.format(*chans))
+
+    if os.path.exists(outfile):
+        shutil.rmtree(outfile)
+    ia = image()
+    # each part already has the reference pixel of its first channel: no crpix3 fix-up
+    cat = ia.imageconcat(outfile=outfile, infiles=parts, axis=2, relax=True, overwrite=True)
+    cat.close()
+    ia.close()
+    if not keep_parts:
+        for part in parts:
+            shutil.rmtree(part, ignore_errors=True)
+    return outfile
@@ -0,0 +1,148 @@
+"""
+SNR statistics of gain tables
+
+The SNR column of every table is read once and sorted once; after that any
+number of thresholds or percentiles is answered with searchsorted and index
+lookups, without going back to the data.
+
+    tables = load_snr_tables({'int': 'ph1_checks/x.ph1_checks.solint_int.tb', ...})
+    summary = snr_summary(tables, thresholds=[3, 6, 10])
+    write_snr_summary(summary, 'ph1_checks/ph1_checks_SNR_summary.csv')
+
+fraction_below is the percentage of solutions with snr <= threshold, as the
+'P(<=6)' printed by the self-cal script.
+"""
+
+import csv
+import json
+import numpy as np
+from casatools import table
+
+tb = table()
+
+
+def load_snr_table(caltable):
+    # Read SNR, FLAG and ANTENNA1 once and keep them sorted for later queries
+    tb.open(caltable)
+    try:
+        snr = tb.getcol('SNR')
+        flag = tb.getcol('FLAG')
+        ant = tb.getcol('ANTENNA1')
+    finally:
+        tb.close()
+    tb.open(caltable+'/ANTENNA')
+    try:
+        antnames = list(tb.getcol('NAME'))
+    finally:
+        tb.close()
+
+    # SNR and FLAG have shape (npol, nchan, nrow); repeat the antenna for each value
+    ant = np.broadcast_to(ant, snr.shape).ravel()
+    snr = snr.ravel()
+    flag = flag.ravel()
+
+    # sort by antenna, then SNR: each antenna is a sorted segment of the array
+    by_ant = np.lexsort((snr, ant))
+    ants, starts = np.unique(ant[by_ant], return_index=True)
+    ends = np.append(starts[1:], len(by_ant))
+    return {'caltable': caltable,
+            'snr': np.sort(snr),
+            'flagged': int(flag.sum()),
+            'ant_snr': snr[by_ant],
+            'ant_flagged': np.add.reduceat(flag[by_ant], starts) if len(starts) else np.array([]),
+            'antennas': [(antnames[a] if a < len(antnames) else str(a), s, e)
+                         for a, s, e in zip(ants, starts, ends)]}
+
+
+def load_snr_tables(caltables):
+    # caltables: dict label -> caltable (e.g. solint -> path)
+    return dict((label, load_snr_table(path)) for label, path in caltables.items())
+
+
+def fraction_below(sorted_snr, thresholds):
+    # Percentage of values <= each threshold
+    n = len(sorted_snr)
+    if n == 0:
+        return np.full(len(thresholds), np.nan)
+    return 100.0*np.searchsorted(sorted_snr, thresholds, side='right')/n
+
+
+def sorted_percentiles(sorted_snr, percentiles):
+    # Same as np.percentile (linear interpolation) on an already sorted array
+    n = len(sorted_snr)
+    if n == 0:
+        return np.full(len(percentiles), np.nan)
+    pos = np.asarray(percentiles, dtype=float)/100.0*(n - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, n - 1)
+    return sorted_snr[lo] + (pos - lo)*(sorted_snr[hi] - sorted_snr[lo])
+
+
+def snr_histogram(sorted_snr, bins=50):
+    # Density histogram over the data range, from the sorted values
+    # (all zero over [0, 1] for a table without solutions)
+    if len(sorted_snr) == 0:
+        return np.zeros(bins), np.linspace(0.0, 1.0, bins + 1)
+    edges = np.linspace(sorted_snr[0], sorted_snr[-1], bins + 1)
+    counts = np.diff(np.searchsorted(sorted_snr, edges, side='left'))
+    counts[-1] += len(sorted_snr) - np.searchsorted(sorted_snr, edges[-1], side='left')
+    width = np.diff(edges)
+    density = counts/(len(sorted_snr)*np.where(width > 0, width, 1.0))
+    return density, edges
+
+
+def snr_summary(tables, thresholds=(6,), percentiles=(5, 25, 50, 75, 95), per_antenna=True):
+    """
+    Summary of the SNR distribution of each table:
+    number of solutions, flagged fraction, percentiles, percentage of
+    solutions with snr <= each threshold, and the same per antenna.
+    """
+    thresholds = list(thresholds)
+    percentiles = list(percentiles)
+    summary = {}
+    for label, t in tables.items():
+        n = len(t['snr'])
+        entry = {'caltable': t['caltable'],
+                 'n': n,
+                 'flagged_fraction': t['flagged']/n if n else np.nan,
+                 'percentiles': dict(zip(percentiles, sorted_percentiles(t['snr'], percentiles).tolist())),
+                 'fraction_below': dict(zip(thresholds, fraction_below(t['snr'], thresholds).tolist()))}
+        if per_antenna:
+            entry['antennas'] = {}
+            for (name, start, end), nflag in zip(t['antennas'], t['ant_flagged']):
+                seg = t['ant_snr'][start:end]
+                entry['antennas'][name] = {
+                    'n': int(end - start),
+                    'flagged_fraction': float(nflag)/(end - start),
+                    'fraction_below': dict(zip(thresholds, fraction_below(seg, thresholds).tolist()))}
+        summary[label] = entry
+    return summary
+
+
+def write_snr_summary(summary, filename):
+    # Export as JSON or CSV, depending on the extension
+    if filename.endswith('.json'):
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=1)
+        return
+
+    thresholds = []
+    percentiles = []
+    for entry in summary.values():
+        thresholds = list(entry['fraction_below'])
+        percentiles = list(entry['percentiles'])
+        break
+    header = (['table', 'antenna', 'n', 'flagged_fraction']
+              + ['P(<={0})'.format(t) for t in thresholds]
+              + ['p{0}'.format(p) for p in percentiles])
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for label, entry in summary.items():
+            writer.writerow([label, 'all', entry['n'], entry['flagged_fraction']]
+                            + [entry['fraction_below'][t] for t in thresholds]
+                            + [entry['percentiles'][p] for p in percentiles])
+            for name, ant in entry.get('antennas', {}).items():
+                writer.writerow([label, name, ant['n'], ant['flagged_fraction']]
+                                + [ant['fraction_below'][t] for t in thresholds]
+                                + [''] * len(percentiles))
@@ -0,0 +1,218 @@
+"""
+Region statistics for the self-calibration images
+
+Replaces the two imstat calls per image in get_im_stats. The pixel regions are
+compiled into boolean masks once per image shape and memoized; each image is
+then read once, only over the bounding box of the regions (getchunk for CASA
+images, a memory-mapped slice for FITS), and rms, peak and SNR are computed
+for all regions from that one read.
+
+Every measurement is kept in a history table (one row per self-cal cycle:
+init, ph1, ph2, ap1, ap2, ...), saved as CSV, so progress can be compared at
+any time without measuring the images again.
+
+    imstats = ImageStats(noise_region='ellipse[[1142pix,632pix],[253pix,708pix],0deg]',
+                         peak_region='ellipse[[1198pix,1313pix],[422pix,366pix],0deg]',
+                         history_file='7582_selfcal.ms_imstats.csv')
+    imstats.measure('7582_selfcal.ms_cont.ph1.clean.image', label='ph1')
+    imstats.print_history()
+"""
+
+import os
+import re
+import csv
+import functools
+import numpy as np
+
+_number = r'\s*([-+0-9.eE]+)\s*'
+_ellipse = re.compile(r'ellipse\s*\[\s*\[{0}pix\s*,{0}pix\s*\]\s*,\s*\[{0}pix\s*,{0}pix\s*\]\s*,{0}deg\s*\]'.format(_number))
+_circle = re.compile(r'circle\s*\[\s*\[{0}pix\s*,{0}pix\s*\]\s*,{0}pix\s*\]'.format(_number))
+_box = re.compile(r'box\s*\[\s*\[{0}pix\s*,{0}pix\s*\]\s*,\s*\[{0}pix\s*,{0}pix\s*\]\s*\]'.format(_number))
+
+
+def parse_region(region):
+    # Pixel-unit CRTF shapes as used in the scripts: ellipse, circle and box
+    region = region.strip()
+    m = _ellipse.fullmatch(region)
+    if m:
+        x, y, b1, b2, pa = map(float, m.groups())
+        return ('ellipse', x, y, b1, b2, pa)
+    m = _circle.fullmatch(region)
+    if m:
+        x, y, r = map(float, m.groups())
+        return ('ellipse', x, y, r, r, 0.0)
+    m = _box.fullmatch(region)
+    if m:
+        return ('box',) + tuple(map(float, m.groups()))
+    raise ValueError('Unsupported region (only pixel ellipse, circle and box): ' + region)
+
+
+@functools.lru_cache(maxsize=64)
+def region_mask(region, shape):
+    """
+    Compile a region for an image of shape (nx, ny).
+    Returns the bounding box as (xmin, xmax, ymin, ymax), inclusive, and the
+    boolean mask over that box, indexed [x, y] like CASA pixel arrays.
+    """
+    shape = tuple(shape)
+    shp = parse_region(region)
+    if shp[0] == 'box':
+        x1, y1, x2, y2 = shp[1:]
+        xmin, xmax = int(np.ceil(min(x1, x2))), int(np.floor(max(x1, x2)))
+        ymin, ymax = int(np.ceil(min(y1, y2))), int(np.floor(max(y1, y2)))
+    else:
+        _, xc, yc, b1, b2, pa = shp
+        r = max(b1, b2)
+        xmin, xmax = int(np.floor(xc - r)), int(np.ceil(xc + r))
+        ymin, ymax = int(np.floor(yc - r)), int(np.ceil(yc + r))
+    xmin, ymin = max(xmin, 0), max(ymin, 0)
+    xmax, ymax = min(xmax, shape[0] - 1), min(ymax, shape[1] - 1)
+    if xmin > xmax or ymin > ymax:
+        raise ValueError('Region does not overlap the image: ' + region)
+
+    x = np.arange(xmin, xmax + 1)[:, None]
+    y = np.arange(ymin, ymax + 1)[None, :]
+    if shp[0] == 'box':
+        mask = np.ones((len(x), y.shape[1]), dtype=bool)
+    else:
+        # b1 lies along the position angle, measured from north (+y) through east (-x)
+        theta = np.deg2rad(pa)
+        dx, dy = x - xc, y - yc
+        along = -dx*np.sin(theta) + dy*np.cos(theta)
+        across = dx*np.cos(theta) + dy*np.sin(theta)
+        mask = (along/b1)**2 + (across/b2)**2 <= 1.0
+    mask.setflags(write=False)
+    return (xmin, xmax, ymin, ymax), mask
+
+
+def _is_fits(im_name):
+    return im_name.lower().endswith(('.fits', '.fit', '.fts'))
+
+
+def image_shape(im_name):
+    # (nx, ny) of the image
+    if _is_fits(im_name):
+        from astropy.io import fits
+        header = fits.getheader(im_name)
+        return (header['NAXIS1'], header['NAXIS2'])
+    from casatools import image
+    ia = image()
+    ia.open(im_name)
+    try:
+        return tuple(int(n) for n in ia.shape()[:2])
+    finally:
+        ia.close()
+
+
+def read_box(im_name, box):
+    """
+    Read the first plane of an image over box = (xmin, xmax, ymin, ymax).
+    Returns pixels indexed [x, y] with masked pixels set to NaN.
+    """
+    xmin, xmax, ymin, ymax = box
+    if _is_fits(im_name):
+        from astropy.io import fits
+        with fits.open(im_name, memmap=True) as hdul:
+            data = hdul[0].data
+            # drop the leading (stokes, frequency) axes and take the first plane
+            while data.ndim > 2:
+                data = data[0]
+            pixels = np.array(data[ymin:ymax + 1, xmin:xmax + 1], dtype=float).T
+        return pixels
+
+    from casatools import image
+    ia = image()
+    ia.open(im_name)
+    try:
+        ndim = len(ia.shape())
+        blc = [xmin, ymin] + [0]*(ndim - 2)
+        trc = [xmax, ymax] + [0]*(ndim - 2)
+        pixels = ia.getchunk(blc=blc, trc=trc, dropdeg=True).astype(float)
+        pixmask = ia.getchunk(blc=blc, trc=trc, dropdeg=True, getmask=True)
+    finally:
+        ia.close()
+    pixels = pixels.reshape(xmax - xmin + 1, ymax - ymin + 1)
+    pixels[~pixmask.reshape(pixels.shape)] = np.nan
+    return pixels
+
+
+def _image_stamp(im_name):
+    # Cheap change detector: newest mtime and total size of the image files
+    if not os.path.isdir(im_name):
+        st = os.stat(im_name)
+        return (st.st_mtime_ns, st.st_size)
+    mtime, size = 0, 0
+    for entry in os.scandir(im_name):
+        if entry.is_file() and not entry.name.endswith('.lock'):
+            st = entry.stat()
+            mtime, size = max(mtime, st.st_mtime_ns), size + st.st_size
+    return (mtime, size)
+
+
+class ImageStats:
+    """
+    rms in noise_region, peak in peak_region and their ratio, for any number
+    of images, with a persistent history of the results.
+    """
+
+    fields = ['label', 'image', 'rms', 'peak', 'snr']
+
+    def __init__(self, noise_region, peak_region, history_file=None):
+        self.noise_region = noise_region
+        self.peak_region = peak_region
+        self.history_file = history_file
+        self.history = []
+        self._cache = {}
+        if history_file is not None and os.path.exists(history_file):
+            with open(history_file, newline='') as f:
+                for row in csv.DictReader(f):
+                    for key in ['rms', 'peak', 'snr']:
+                        row[key] = float(row[key])
+                    self.history.append(row)
+
+    def compute(self, im_name):
+        # rms of the noise region and max of the peak region from a single read
+        regions = [self.noise_region, self.peak_region]
+        shape = image_shape(im_name)
+        compiled = [region_mask(r, shape) for r in regions]
+        box = (min(b[0] for b, m in compiled), max(b[1] for b, m in compiled),
+               min(b[2] for b, m in compiled), max(b[3] for b, m in compiled))
+        pixels = read_box(im_name, box)
+
+        values = []
+        for (xmin, xmax, ymin, ymax), mask in compiled:
+            sub = pixels[xmin - box[0]:xmax - box[0] + 1, ymin - box[2]:ymax - box[2] + 1]
+            sel = sub[mask]
+            values.append(sel[np.isfinite(sel)])
+        # imstat rms is the root mean square, not the standard deviation
+        noise = float(np.sqrt(np.mean(values[0]**2)))
+        peak = float(values[1].max())
+        return {'rms': noise, 'peak': peak, 'snr': peak/noise}
+
+    def measure(self, im_name, label=None):
+        # Stats of one image, recorded in the history under 'label'
+        key = (os.path.abspath(im_name), _image_stamp(im_name))
+        if key not in self._cache:
+            self._cache[key] = self.compute(im_name)
+        stats = self._cache[key]
+
+        row = dict(label=label or os.path.basename(im_name), image=im_name, **stats)
+        labels = [r['label'] for r in self.history]
+        if row['label'] in labels:
+            self.history[labels.index(row['label'])] = row
+        else:
+            self.history.append(row)
+        if self.history_file is not None:
+            self.save_history(self.history_file)
+        return stats
+
+    def save_history(self, filename):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.fields)
+            writer.writeheader()
+            writer.writerows(self.history)
+
+    def print_history(self):
+        print('{0:>8} {1:>10} {2:>10} {3:>8}'.format('cycle', 'rms', 'peak', 'snr'))
+        for row in self.history:
+            print('{0:>8} {1:10.3g} {2:10.3g} {3:8.0f}'.format(row['label'], row['rms'], row['peak'], row['snr']))
@@ -13,8 +13,8 @@
 #-- https://almascience.nrao.edu/almadata/sciver/VYCMaBand7/
 #-- Preparation steps applied the original dataset can be found commented below.
 
-#-- The script is organized in STEPS. Search for the variable "step_title" that holds all the steps
-#-- executed by the script. To execute the full script, use the CASA command 'execfile'. If you 
+#-- The script is organized in STEPS. Search for the variable "steps" that holds all the steps
+#-- executed by the script, together with the files and MS columns each of them reads and writes. To execute the full script, use the CASA command 'execfile'. If you 
 #-- would only like to run certain steps, define the variable 'mysteps' and then execute the script
 #-- with 'execfile', eg, to execute steps 0 & 1 only, run in the CASA terminal:
 #-- mysteps=[0,1]
@@ -23,6 +23,9 @@
 #-- In this script self-calibration of continuum is performed in several cycles, and it is applied 
 #-- to all channels/spw.
 
+#-- Steps whose inputs and parameters have not changed since the last run are skipped (the hashes
+#-- are kept in '<visname>.steps.json'), so re-running after a mistake only repeats what is needed.
+
 
 """
 # PREPARATION ALREADY DONE ON THE ORIGINAL SV DATASET
@@ -68,10 +71,13 @@ flagdata(vis=vis,
 
 import os
 import sys
-import matplotlib
-import matplotlib.pyplot as plt
-from scipy import stats
 import numpy as np
+from stepgraph import run_steps, column
+from selfcal_plots import plot_gaincal_snr_dist
+from solint_sweep import run_solint_sweep
+from image_stats import ImageStats
+from selfcal_loop import selfcal_steps
+from model_manager import ensure_model, model_is_current, sampled_model_check
 
 
 #============================================================================
@@ -97,47 +103,60 @@ contchans='0:166~194;304~475,1:50~172;216~356;428~436'
 cell='0.018arcsec'
 imsize=2304
 
+#-- Number of gaincal processes run at the same time when exploring solution intervals
+sweep_workers=7
+
+#-- Clean mask used for all the conservative cleans
+cleanmask='7582_cont_cleanmask.mask'
+
+#-- Self-calibration schedule: (calmode, solint[, gaintype][, overrides]) for each round
+#-- Phase-only rounds first, then amplitude & phase; the last round makes the final image.
+#-- The overrides are tclean parameters, plus 'sweep': True to explore the solution intervals
+#-- (with the previous rounds applied) before the round and 'applymode' for its applycal
+#-- ('calonly' by default; the final round also flags the data of failed solutions)
+selfcal_schedule = [('p', 'inf'),
+                    ('p', '60s', {'sweep': True}),
+                    ('ap', '120s', {'niter': 300}),
+                    ('ap', '60s', 'T', {'niter': 300, 'deconvolver': 'multiscale', 'scales': [0,4,8,12],
+                                        'applymode': 'calflag'})]
+
+#-- Stop self-calibrating when a round improves the SNR by less than this fraction
+min_improvement=0.02
+
+#-- Regions for the image statistics: noise (without source signal) and peak (including the target)
+noise_region='ellipse[[1142pix,632pix],[253pix,708pix],0deg]'
+peak_region='ellipse[[1198pix,1313pix],[422pix,366pix],0deg]'
+
+#-- Batch mode: selfcal_batch.py runs this script once per target, in the target's working
+#-- directory, with SELFCAL_CONFIG/SELFCAL_TARGET pointing at its entry in a configuration file
+#-- (see selfcal_targets.toml). The parameters there replace the ones above.
+if os.environ.get('SELFCAL_CONFIG'):
+    from selfcal_config import target_parameters
+    target = target_parameters(os.environ['SELFCAL_CONFIG'], os.environ['SELFCAL_TARGET'])
+    print('Running target {0} with {1}'.format(os.environ['SELFCAL_TARGET'], target))
+    for _name, _value in target.items():
+        globals()[_name] = _value
+    plot_prefix = visname+ '_spw'
+    vis = visname
+
 #===========================================================================
 # FUNCTIONS
 #===========================================================================
 
 # Useful functions for our purposes are defined here
  
-def get_im_stats(im_name):
+# Image statistics: rms in a region representative of the image RMS (large enough and without source
+# signal), peak in a region including our target. The region masks are built once and each image is
+# read once; results for every cycle are kept in '<visname>_imstats.csv'
+imstats = ImageStats(noise_region=noise_region,
+                     peak_region=peak_region,
+                     history_file=visname+'_imstats.csv')
+
+def get_im_stats(im_name, label=None):
     # Calculate image statistics
-    noise=imstat(imagename=im_name,region='ellipse[[1142pix,632pix],[253pix,708pix],0deg]')['rms'][0] #region representative of the image RMS, large enough and without source signal
-    peak=imstat(imagename=im_name,region='ellipse[[1198pix,1313pix],[422pix,366pix],0deg]')['max'][0] #region including our target
-    print('rms {0:.3f}, peak {1:.3f}, snr {2:.0f}'.format(noise, peak, peak/noise))
-
-
-def plot_gaincal_table(caltable):
-    # make plots for antenna triplets that will be saved in png files
-    for ant in range(3):
-        plotms(vis=caltable,xaxis='time',yaxis='phase',iteraxis='antenna',gridrows=4, gridcols=2,coloraxis='spw', 
-            xaxisfont = 7, yaxisfont = 7, highres =  True, 
-            antenna=str(ant*8)+'~'+str(ant*8+7), 
-            showgui = False, plotfile=caltable+'_ant'+str(ant*8)+'-'+str(ant*8+7)+'.png')
-
-def plot_gaincal_snr_dist(path, visname, selfcal_cycle, solints):
-    # Make plot of SNR of gaintables for a list of solution intervals
-    # path: path to caltables; plot will be saved in that path too
-    # solints: list of solution intervals (list of strings)
-    print("Percentile of score for snr=6, i.e. percentage of solutions with snr <=6:")
-    for ss in solints:
-        tb.open(path+'/'+visname+'.'+selfcal_cycle+'.solint_'+ss+'.tb')
-        snr = tb.getcol( 'SNR' ).ravel()
-        tb.close()
-      
-        if(matplotlib.__version__>="2.0"):
-            plt.hist( snr, bins=50, density=True, histtype='step', label=ss )
-        else:
-            plt.hist( snr, bins=50, normed=True, histtype='step', label=ss )
-
-        print( 'P(<=6) = {0}  ({1})'.format( stats.percentileofscore( snr, 6 ), ss ) )
-
-    plt.legend( loc='upper right' )
-    plt.xlabel( 'SNR' )
-    plt.savefig(path+'/'+selfcal_cycle+'_SNR_hist_solint_all.png')
+    s = imstats.measure(im_name, label)
+    print('rms {0:.3f}, peak {1:.3f}, snr {2:.0f}'.format(s['rms'], s['peak'], s['snr']))
+    return s
 
 
 
@@ -145,58 +164,26 @@ def plot_gaincal_snr_dist(path, visname, selfcal_cycle, solints):
 # STEPS
 #===========================================================================
 
-# List of steps executed by this script
-thesteps=[]
-step_title = {0:  'List the data set and plot antennas and visibility spectrum',
-              1:  'Make dirty image of continuum',
-	      ### INITIAL MODEL 
-              2:  'Make an initial, conservative cleaning',
-              3:  'Check and save model',
-              ### FIRST ROUND OF SELF-CALIBRATION - PHASE
-              4:  'Calculate gain solution table - phase-only, solution interval = scan-length',
-              5:  'Explore different solution intervals', 
-              6:  '[ADVANCED] Calculate SNR of the different solution intervals', 
-              7:  'Apply calibration table',
-              8:  'Make second, conservative cleaning and save model',
-              ### SECOND ROUND OF SELF-CALIBRATION - PHASE
-              9:  'Explore different solution intervals',
-              10: '[ADVANCED] Calculate SNR of the different solution intervals',
-              11: 'Calculate gain solution table - phase-only, solution interval = 60s applying round 1 table on-the-fly',
-              12: 'Apply calibration tables',
-              13: 'Make image of continuum and save model',
-              ### THIRD ROUND OF SELF-CALIBRATION - AMPLITUDE & PHASE
-              14: 'Calculate gain solution table - amplitude and phase, long solution interval',
-              15: 'Apply calibration tables',
-              16: 'Make image of continuum and save model',
-              ### FOURTH ROUND OF SELF-CALIBRATION - AMPLITUDE & PHASE
-              17: 'Calculate gain solution table - amplitude and phase, short solution interval',
-              18: 'Apply calibration table',
-              ### FINAL CONTINUUM IMAGE
-              19: 'Make image of continuum and save model', 
-	     }
- 
-# The Python variable 'mysteps' will control which steps are executed when you start the script using
-#   execfile('[This script].py')
-# e.g. to execute only steps 2, 3, and 4 of the script define first 'mysteps' and then execute the script:
-#   mysteps = [2,3,4]
-#   execfile('script.py')
-# Setting mysteps = [] will make it execute all steps.
+# Each step is a function below, and the 'steps' dictionary at the end declares what
+# every step reads and writes (see stepgraph.py). A step whose parameters and inputs have
+# not changed since the last run, and whose outputs are still on disk, is skipped, so
+# re-running the script from step N only repeats the work that is actually out of date.
 
-try:
-  print('List of steps to be executed ...', mysteps)
-  thesteps = mysteps
-except:
-  print('global variable mysteps not set.')
-if (thesteps==[]):
-  thesteps = list(range(0,len(step_title)))
-  print('Executing all steps: ', thesteps)
+# Helpers to name the products of each step
+def clean_products(imagename):
+    return [imagename+'.image', imagename+'.model']
 
-#---------
-mystep = 0 
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
+def check_tables(selfcal_cycle, solints):
+    return [selfcal_cycle+'/'+visname+'.'+selfcal_cycle+'.solint_'+ss+'.tb' for ss in solints]
 
+solint_all = ['int', '20s', '40s', '60s', '80s', '160s', 'inf']
+
+data_col = column(vis, 'DATA')
+model_col = column(vis, 'MODEL_DATA')
+corrected_col = column(vis, 'CORRECTED_DATA')
+
+#---------
+def step0():
   #print listobs
   os.system('rm '+visname+'_listobs.txt')
   listobs(vis=vis, listfile=visname+'_listobs.txt', verbose=True)
@@ -220,15 +207,10 @@ if(mystep in thesteps):
              highres = True,
              plotfile=visname+'_spw'+s+'_vis-spectrum.png')
   
- 
-
-#---------
-mystep = 1 
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
 
 
+#---------
+def step1():
   ## Make a first dirty imaging of the continuum to get a sense of the structure of the object
   imagename = visname + '_cont.dirty'
   os.system('rm -rf '+imagename+'.*')
@@ -249,11 +231,7 @@ if(mystep in thesteps):
 
 ### INITIAL MODEL
 #---------
-mystep = 2
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
+def step2():
   #Delete existing models and calibration tables to make sure we have a neat start:
   #delmod(vis=vis, scr=True)
   #clearcal(vis=vis)
@@ -269,95 +247,58 @@ if(mystep in thesteps):
         cell=cell,
         imsize=imsize,
         niter = 200,
-        interactive=False, usemask='user', mask='7582_cont_cleanmask.mask')
+        interactive=False, usemask='user', mask=cleanmask)
   #Get image statistics for comparison 
-  get_im_stats(imagename+'.image')
+  get_im_stats(imagename+'.image', 'init')
 
 
 #---------
-mystep = 3
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
+def step3():
   #model name
   modelname=visname+'_cont0.init.clean.model'
 
-  # check that model has saved
-  plotms(vis=vis, xaxis='UVwave', yaxis='amp', ydatacolumn='model',showgui=False,plotfile=modelname+'.png')
+  # Nothing to do if this model is already in MODEL_DATA (see model_manager.py)
+  if model_is_current(vis, modelname):
+      print('MODEL_DATA already holds '+modelname)
+      return
+
+  # check whether a model has saved, reading a few hundred rows only
+  sampled_model_check(vis, plotfile=modelname+'.png')
 
   # force model to save
-  ft(vis=vis,model=modelname,usescratch=True)
+  ensure_model(vis, modelname)
 
   # check that model has saved after ft
-  plotms(vis=vis, xaxis='UVwave', yaxis='amp', ydatacolumn='model',showgui=False,plotfile=modelname+'_ft.png')
-
+  sampled_model_check(vis, plotfile=modelname+'_ft.png')
 
+def ft_model(imagename):
+  # Used when a later step needs MODEL_DATA back from an earlier clean:
+  # the model image is still on disk, so only the ft() has to be repeated
+  return lambda: ensure_model(vis, imagename+'.model')
 
-### FIRST ROUND OF SELF-CALIBRATION - PHASE
-#---------
-mystep = 4
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # calculate gain table for solint='inf' = scan length
-  solint='inf'
-  caltable=visname+'_cont.ph1.solint_'+solint+'.tb'
-  os.system('rm -rf '+caltable)
-  gaincal(vis = vis,
-          field= field,
-          refant=refantenna,
-          caltable=caltable,
-          spw=contchans,
-          calmode='p',
-          solint=solint,
-          gaintype='G',
-          minsnr=3)
-
-
-  # view gain table for all antennas
-  plotms(vis=caltable,xaxis='time',yaxis='phase',iteraxis='antenna',gridrows=3, gridcols=3,coloraxis='spw')
 
 
+### SELF-CALIBRATION
 #---------
-mystep = 5
-if(mystep in thesteps):
-    casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-    print('Step ', mystep, step_title[mystep])
-
+def step4():
     ### COMMANDS FOR EXPLORING THE SOLUTION INTERVAL
     # # We recommend investigating the phases with various solution intervals to get a sense of the interval on which the solutions vary
 
-    # The following loop calculates gaincal solutions for a list of intervals and makes corresponding plots
+    # The following sweep calculates gaincal solutions for a list of intervals and makes corresponding plots,
+    # running one gaincal per solution interval in parallel (at most sweep_workers at a time)
     # The output is saved in a separate folder  
+    # To explore a later round, pass the tables of the previous rounds with gaintable=[...], spwmap=[[0,1],...]
     selfcal_cycle = 'ph1_checks'
-    solint_all = ['int', '20s', '40s', '60s', '80s', '160s', 'inf'] 
-    for solint in solint_all:
-        print('Solint:', solint)
-        caltable = visname+'.'+selfcal_cycle+'.solint_'+solint+'.tb'
-        gaincal(vis=vis,caltable=caltable,solint=solint,refant=refantenna,spw=contchans,calmode='p',gaintype='G',minsnr=3)
-
-        # make plots for antenna triplets that will be saved in png files
-        plot_gaincal_table(caltable)
-    
-    os.system('rm -r '+selfcal_cycle)
-    if not os.path.exists(selfcal_cycle):
-        os.makedirs(selfcal_cycle)
-    os.system('mv *.'+selfcal_cycle+'*tb* '+selfcal_cycle+'/')
+    run_solint_sweep(vis, selfcal_cycle, solint_all, max_workers=sweep_workers,
+                     refant=refantenna,spw=contchans,calmode='p',gaintype='G',minsnr=3)
     print("Check output of this step in folder: "+selfcal_cycle)
 
 #---------
-mystep = 6
-if(mystep in thesteps):
-    casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-    print('Step ', mystep, step_title[mystep])
-
+def step5():
     # [ADVANCED]
     # Calculate the distribution of SNR of the gaincal tables for different solution intervals
     # using the tables generated in the previous step; plots are moved to the same output folder as in the step above
     selfcal_cycle = 'ph1_checks'
-    solint_all = ['int', '20s', '40s', '60s', '80s', '160s', 'inf']
     
     try:
         path = selfcal_cycle + '/'
@@ -368,348 +309,92 @@ if(mystep in thesteps):
 
 
 #---------
-mystep = 7
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
- 
-  # apply the solutions to the MS  
-  caltable=visname+'_cont.ph1.solint_inf.tb'
-  applycal(vis = vis,
-           field= field,
-           spw='0,1',
-           spwmap=[0,1],
-           gaintable=caltable,
-           calwt = False,
-           applymode='calonly',
-           flagbackup = False)
+# The self-calibration rounds themselves (gaincal, applycal, tclean, image statistics, ft) are
+# generated from 'selfcal_schedule' by selfcal_loop.py and numbered from step 6 on. Each round
+# applies the tables of all previous rounds; the loop stops as soon as a round does not improve
+# the SNR by at least 'min_improvement', leaving the MS calibrated as for the best image.
+# A round with 'sweep': True is preceded by the same two steps as steps 4 and 5, applying the
+# tables of the previous rounds (e.g. 'ph2_checks' before the second phase-only round).
 
 
 
-#---------
-mystep = 8
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-
-  # make a second, conservative clean
-  imagename = visname + '_cont.ph1.clean'
-  os.system('rm -rf '+imagename+'.*')
-  tclean(vis = vis,
-        imagename = imagename,
-        field = field,
-        spw=contchans,
-        specmode='mfs',
-        cell=cell,
-        imsize=imsize,
-        niter=200,
-        interactive=False, usemask='user', mask='7582_cont_cleanmask.mask')
-  #Get image statistics for comparison 
-  get_im_stats(imagename+'.image')
-
-
-  #force model to save
-  modelname=imagename+'.model'
-  ft(vis=vis,model=modelname,usescratch=True)
-
-
-
-### SECOND ROUND OF SELF-CALIBRATION - PHASE
-#---------
-mystep = 9
-if(mystep in thesteps):
-    casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-    print('Step ', mystep, step_title[mystep])
-
-    ### COMMANDS FOR EXPLORING THE SOLUTION INTERVAL
-    # # We recommend investigating the phases with various solution intervals to get a sense of the interval on which the solutions vary
-
-    # The following loop calculates gaincal solutions for a list of intervals and makes corresponding plots
-    # The output is saved in a separate folder  
-    selfcal_cycle = 'ph2_checks'
-    solint_all = ['int', '20s', '40s', '60s', '80s', '160s', 'inf']
-    for solint in solint_all:
-        print('Solint:', solint)
-        solint_1='inf'
-        caltable = visname+'.'+selfcal_cycle+'.solint_'+solint+'.tb'
-        gaincal(vis=vis,caltable=caltable,solint=solint,refant=refantenna,spw=contchans,
-            gaintable = [visname + '_cont.ph1.solint_'+solint_1+'.tb'], spwmap=[0,1], calmode='p',gaintype='G',minsnr=3)
-
-        # make plots for antenna triplets that will be saved in png files
-        plot_gaincal_table(caltable)
-
-    os.system('rm -r '+selfcal_cycle)
-    if not os.path.exists(selfcal_cycle):
-        os.makedirs(selfcal_cycle)
-    os.system('mv *.'+selfcal_cycle+'*tb* '+selfcal_cycle+'/')
-    print("Check output of this step in folder: "+selfcal_cycle)
-
-
-
-#---------
-mystep = 10
-if(mystep in thesteps):
-    casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-    print('Step ', mystep, step_title[mystep])
-
-    # [ADVANCED]
-    # Calculate the distribution of SNR of the gaincal tables for different solution intervals
-    # using the tables generated in the previous step; plots are moved to the same output folder as in the step above
-    selfcal_cycle = 'ph2_checks'
-    solint_all = ['int', '20s', '40s', '60s', '80s', '160s', 'inf']
-   
-    try:
-        path = selfcal_cycle + '/'
-        plot_gaincal_snr_dist(path, visname, selfcal_cycle, solint_all)
-        print("Check output of this step in folder: "+selfcal_cycle)
-  
-    except:
-        print("You need to run the previous step for the same list of solution intervals")
-
-
-
-#---------
-mystep = 11
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # calculate gain table for solint='60s' while applying the table from round 1 'on the fly'
-  solint_1='inf'
-  solint='60s'
-  caltable = visname + '_cont.ph2.solint_'+solint+'.tb'
-  os.system('rm -rf '+caltable)
-  gaincal(vis = vis,
-          field= field,
-          refant=refantenna,
-          caltable=caltable,
-          spw=contchans,
-          gaintable = [visname + '_cont.ph1.solint_'+solint_1+'.tb'],
-          spwmap=[0,1],
-          calmode='p',
-          solint=solint,
-          gaintype='G',
-          minsnr=3)
-
-
-  # view gain table for all antennas
-  plotms(vis=caltable,xaxis='time',yaxis='phase',iteraxis='antenna',gridrows=3, gridcols=3,coloraxis='spw')
-
-
+#===========================================================================
+# STEP GRAPH
+#===========================================================================
 
-#---------
-mystep = 12
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
+# Parameters shared by the imaging and calibration steps; a change to any of them
+# makes the steps that use it out of date
+image_params = dict(field=field, spw=contchans, cell=cell, imsize=imsize, mask=cleanmask)
+cal_params = dict(field=field, spw=contchans, refant=refantenna, minsnr=3)
+
+tclean_params = dict(field=field, spw=contchans, specmode='mfs', cell=cell, imsize=imsize,
+                     niter=200, interactive=False, usemask='user', mask=cleanmask)
+
+steps = {
+    0:  dict(title='List the data set and plot antennas and visibility spectrum',
+             run=step0, inputs=[data_col],
+             outputs=[visname+'_listobs.txt', visname+'_plotants.png']),
+    1:  dict(title='Make dirty image of continuum',
+             run=step1, inputs=[data_col, corrected_col],
+             outputs=[visname+'_cont.dirty.image'],
+             params=dict(image_params, niter=0)),
+    ### INITIAL MODEL
+    2:  dict(title='Make an initial, conservative cleaning',
+             run=step2, inputs=[data_col, corrected_col, cleanmask],
+             outputs=clean_products(visname+'_cont0.init.clean'),
+             params=dict(image_params, niter=200)),
+    3:  dict(title='Check and save model',
+             run=step3, inputs=[visname+'_cont0.init.clean.model'],
+             outputs=[model_col],
+             restore=ft_model(visname+'_cont0.init.clean')),
+    ### SELF-CALIBRATION
+    4:  dict(title='Explore different solution intervals',
+             run=step4, inputs=[data_col, model_col],
+             outputs=check_tables('ph1_checks', solint_all),
+             params=dict(cal_params, field='', calmode='p', solints=solint_all)),
+    5:  dict(title='[ADVANCED] Calculate SNR of the different solution intervals',
+             run=step5, inputs=check_tables('ph1_checks', solint_all),
+             outputs=['ph1_checks/ph1_checks_SNR_hist_solint_all.png']),
+}
+steps.update(selfcal_steps(vis, selfcal_schedule, imstats,
+                           cal_params=cal_params,
+                           apply_params=dict(field=field, spw='0,1', applymode='calonly'),
+                           tclean_params=tclean_params,
+                           initial_label='init', initial_image=visname+'_cont0.init.clean',
+                           extra_inputs=[cleanmask],
+                           spwmap=[0,1], min_improvement=min_improvement,
+                           first_step=6, sweep_solints=solint_all, sweep_workers=sweep_workers))
  
-  # apply the cumulative solutions to the MS 
-  solint_1='inf'
-  solint_2='60s' 
-  applycal(vis = vis,
-           field= field,
-           spw='0,1',
-           gaintable=[visname+'_cont.ph1.solint_'+solint_1+'.tb', visname+'_cont.ph2.solint_'+solint_2+'.tb'],
-           spwmap=[[0,1],[0,1]],
-           calwt = False,
-           applymode='calonly',
-           flagbackup = False)
-
-
-
-#---------
-mystep = 13
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # If you would like to compare what the second round of phase self-cal accomplished compared to the first
-  # make a third, conservative clean
-  imagename = visname + '_cont.ph2.clean'
-  os.system('rm -rf '+imagename+'.*')
-  tclean(vis = vis,
-      imagename=imagename,
-      field=field,
-      spw=contchans,
-      specmode='mfs',
-      cell=cell,
-      imsize=imsize,
-      niter=200,
-      interactive=False, usemask='user', mask='7582_cont_cleanmask.mask')
-  # get image statistics for comparison
-  get_im_stats(imagename+'.image')
-
-
-  #force model to save
-  modelname=imagename+'.model'
-  ft(vis=vis,model=modelname,usescratch=True)
-
-
-### THIRD ROUND OF SELF-CALIBRATION - AMPLITUDE & PHASE
-#---------
-mystep = 14
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # long solution interval, applying previous solutions on the fly
-  solint='120s'
-  caltable = visname + '_cont.ap1.solint_'+solint+'.tb'
-  # apply the cumulative solutions to the MS 
-  solint_1='inf'
-  solint_2='60s'
-  os.system('rm -rf '+caltable)
-  gaincal(vis = vis,
-          field= field,
-          refant=refantenna,
-          caltable=caltable,
-          gaintable = [visname + '_cont.ph1.solint_'+solint_1+'.tb', visname + '_cont.ph2.solint_'+solint_2+'.tb' ], 
-          spwmap=[[0,1],[0,1]],
-          spw=contchans,
-          calmode='ap',
-          solint=solint,
-          gaintype='G',
-          minsnr=3)
-
-
-  # view gain table for all antennas
-  plotms(vis=caltable,xaxis='time',yaxis='phase',iteraxis='antenna',gridrows=3, gridcols=3,coloraxis='spw')
-
-
-
-
-
-#---------
-mystep = 15
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # apply the cumulative solutions to the MS 
-  solint_1='inf'
-  solint_2='60s'
-  solint_3='120s'
-  applycal(vis = vis,
-           field= field,
-           spw='0,1',
-           spwmap=[[0,1],[0,1],[0,1]],
-           gaintable=[visname+'_cont.ph1.solint_'+solint_1+'.tb', visname+'_cont.ph2.solint_'+solint_2+'.tb', visname+'_cont.ap1.solint_'+solint_3+'.tb'],
-           calwt = False,
-           applymode='calonly',
-           flagbackup = False)
-
-
-
-#---------
-mystep = 16
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # make yet another, conservative clean
-  imagename = visname + '_cont.ap1.clean'
-  os.system('rm -rf '+imagename+'.*')
-  tclean(vis = vis,
-      imagename=imagename,
-      field=field,
-      spw=contchans,
-      specmode='mfs',
-      cell=cell,
-      imsize=imsize,
-      niter=300,
-      interactive=False, usemask='user', mask='7582_cont_cleanmask.mask')
-  # get image statistics for comparison
-  get_im_stats(imagename+'.image')
-
-
-  #force model to save
-  modelname=imagename+'.model'
-  ft(vis=vis,model=modelname,usescratch=True)
-
-
-
-### FOURTH ROUND OF SELF-CALIBRATION - AMPLITUDE & PHASE
-#---------
-mystep = 17
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # calculate gain table for solint='60s' while applying previous solutions 'on the fly'
-  solint='60s'
-  caltable = visname + '_cont.ap2.solint_'+solint+'.tb'
-  solint_1='inf'
-  solint_2='60s'
-  solint_3='120s'
-  os.system('rm -rf '+caltable)
-  gaincal(vis = vis,
-          field= field,
-          refant=refantenna,
-          caltable=caltable,
-          spwmap=[[0,1],[0,1],[0,1]],
-          gaintable=[visname+'_cont.ph1.solint_'+solint_1+'.tb', visname+'_cont.ph2.solint_'+solint_2+'.tb', visname+'_cont.ap1.solint_'+solint_3+'.tb'],
-          spw=contchans,
-          calmode='ap',
-          solint=solint,
-          gaintype='T',    # notice gaintype option
-          minsnr=3)
-
-
-  # view gain table for all antennas
-  plotms(vis=caltable,xaxis='time',yaxis='phase',iteraxis='antenna',gridrows=3, gridcols=3,coloraxis='spw')
-
-
+# The Python variable 'mysteps' will control which steps are executed when you start the script using
+#   execfile('[This script].py')
+# e.g. to execute only steps 2, 3, and 4 of the script define first 'mysteps' and then execute the script:
+#   mysteps = [2,3,4]
+#   execfile('script.py')
+# Setting mysteps = [] will make it execute all steps.
+# Steps that are up to date are skipped; to re-run them anyway list them in 'forcesteps':
+#   forcesteps = [8]
 
-#---------
-mystep = 18
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  # apply the cumulative solutions to the MS
-  solint_1='inf'
-  solint_2='60s'
-  solint_3='120s' 
-  solint_4='60s'
-  applycal(vis = vis,
-           field= field,
-           spw='0,1',
-           spwmap=[[0,1],[0,1],[0,1],[0,1]],
-           gaintable=[visname+'_cont.ph1.solint_'+solint_1+'.tb', visname+'_cont.ph2.solint_'+solint_2+'.tb', 
-           visname+'_cont.ap1.solint_'+solint_3+'.tb', visname+'_cont.ap2.solint_'+solint_4+'.tb'],
-           calwt = False,
-           flagbackup = False, applymode='calfalg')
-
-
-
-### FINAL CONTINUUM IMAGE
-#---------
-mystep = 19
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
+thesteps=[]
+try:
+  print('List of steps to be executed ...', mysteps)
+  thesteps = mysteps
+except:
+  print('global variable mysteps not set.')
+if (thesteps==[]):
+  thesteps = sorted(steps)
+  print('Executing all steps: ', thesteps)
 
-  imagename = visname + '_cont.ap2.clean'
-  os.system('rm -rf '+imagename+'.*')
-  tclean(vis = vis,
-      imagename=imagename,
-      field=field,
-      spw=contchans,
-      specmode='mfs',
-      cell=cell,
-      imsize=2304,
-      niter=300,
-      deconvolver = 'multiscale', 
-      scales=[0,4,8,12],
-      interactive=False, usemask='user', mask='7582_cont_cleanmask.mask')
-  # get image statistics for comparison
-  get_im_stats(imagename+'.image')
+try:
+  force = forcesteps
+except NameError:
+  force = []
 
+def log_step(message):
+  casalog.post(message,'INFO')
+  print(message)
 
-  #force model to save
-  modelname=imagename+'.model'
-  ft(vis=vis,model=modelname,usescratch=True)
+run_steps(steps, thesteps, visname+'.steps.json', force=force, log=log_step)
+imstats.print_history()
 
 
 
@@ -718,4 +403,3 @@ if(mystep in thesteps):
 #---------------------------------------------------------------------------------
 #----- End of script.
 #----------------------------------------------------------------------------------
-
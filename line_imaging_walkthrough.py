@@ -1,4 +1,7 @@
 import os
+from ms_index import choose_gridder, data_column
+from line_sharding import sharded_tclean
+from contsub_engine import contsub
 
 # File and target configuration
 vis_file = 'uid___A002_Xb945f7_X1b14.ms.split.cal'
@@ -8,7 +11,8 @@ target_spw = '0'
 
 # Define paths
 split_vis = f"{vis_file}.target"
-contsub_vis = f"{vis_file}.target.contsub"
+# continuum-subtracted data go into CORRECTED_DATA of the split MS (DATA is kept)
+contsub_vis = split_vis
 image_basename = 'ngc7582'
 
 """
@@ -34,6 +38,11 @@ The below numbers are just placeholders and will need to be updated based on the
 LINE_CHUNKS = [
     {'start': 186, 'width': 1, 'nchan': 113}
 ]
+# Image each chunk in this many parallel channel shards (restored with one common beam),
+# e.g. os.cpu_count(); 1 to run a single tclean. Needs integer 'start'/'width' and
+# INTERACTIVE = False. Sharded cubes are weighted with 'briggs' instead of 'briggsbwtaper':
+# the taper is computed from the bandwidth being imaged, so it would differ per shard
+SHARDS = 1
 
 IMSIZE = 1152
 
@@ -46,7 +55,7 @@ tclean_params = {
     'imsize': [size, size],
     'cell': ['0.04arcsec'],
     'phasecenter': 'ICRS 23:18:23.60 -42.22.14.00000', 
-    'gridder':'mosaic',
+    'gridder':'mosaic', # replaced below by the choice for contsub_vis
     'deconvolver': 'multiscale',
     'robust': ROBUST,
     'pbcor': True,
@@ -56,7 +65,7 @@ tclean_params = {
     'specmode': 'cube',
     'spw': '0',
     'threshold': THRESHOLD,
-    'weighting': 'briggsbwtaper',
+    'weighting': 'briggs' if SHARDS > 1 and not INTERACTIVE else 'briggsbwtaper',
     'restoringbeam': 'common',
     'minbeamfrac': 0.3, # default is 0.3 reduce when automasking is not working well
     'noisethreshold': 5.0 # default is 5.0 reduce when automasking is not working well
@@ -73,10 +82,7 @@ I just left it in for completeness.
 if not os.path.isdir(split_vis):
     print(f"Splitting {vis_file} to {split_vis}")
     
-    tb.open(vis_file)
-    colnames = tb.colnames()
-    tb.close()
-    column = 'corrected' if 'CORRECTED_DATA' in colnames else 'data'
+    column = data_column(vis_file)
     print(f"Using {column.upper()} column for split")
 
     split(vis=vis_file,
@@ -88,14 +94,15 @@ if not os.path.isdir(split_vis):
 
 ## 2. Subtract continuum from the split MS
 
-if not os.path.exists(contsub_vis):
-    print(f"Performing continuum subtraction")
-    
-    uvcontsub(vis=split_vis,
-            outputvis=contsub_vis,
-            fitspec=CONT_CHANNELS,
-            fitorder=0,
-            datacolumn='data')
+# The fit of each spw is cached (<split_vis>.contsub_cache), so changing FITORDER
+# or the ranges of one spw only refits that spw; unchanged settings are skipped
+FITORDER = 0
+print(f"Performing continuum subtraction")
+contsub(split_vis, CONT_CHANNELS, fitorder=FITORDER)
+
+# 'mosaic' only if the target has more than one phase centre (cached in <contsub_vis>.index.json)
+tclean_params['gridder'] = choose_gridder(contsub_vis)
+print(f"Gridder selected: {tclean_params['gridder']}")
 
 ## 3. Make dirty cube of full spectral window
 
@@ -113,10 +120,7 @@ if not os.path.isdir(f"{dirty_line_name}.image"):
         'interactive': False
     })
     
-    tb.open(contsub_vis)
-    colnames = tb.colnames()
-    tb.close()
-    column = 'corrected' if 'CORRECTED_DATA' in colnames else 'data'
+    column = data_column(contsub_vis)
     print(f"Using {column.upper()} column for tclean")
     
     tclean(vis=contsub_vis,
@@ -141,14 +145,16 @@ for chunk_idx, chunk in enumerate(LINE_CHUNKS):
             'nchan': chunk['nchan']
         })
         
-        tb.open(contsub_vis)
-        colnames = tb.colnames()
-        tb.close()
-        column = 'corrected' if 'CORRECTED_DATA' in colnames else 'data'
+        column = data_column(contsub_vis)
         print(f"Using {column.upper()} column for tclean")
         
-        tclean(vis=contsub_vis,
-               imagename=line_name,
-               selectdata=True,
-               datacolumn=column,
-               **chunk_params)
\ No newline at end of file
+        if SHARDS > 1 and not INTERACTIVE:
+            sharded_tclean(contsub_vis, line_name,
+                           dict(chunk_params, selectdata=True, datacolumn=column),
+                           nshards=SHARDS)
+        else:
+            tclean(vis=contsub_vis,
+                   imagename=line_name,
+                   selectdata=True,
+                   datacolumn=column,
+                   **chunk_params)
\ No newline at end of file
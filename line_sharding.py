@@ -0,0 +1,153 @@
+"""
+Line cubes imaged in parallel channel shards
+
+A chunk of LINE_CHUNKS ({'start', 'width', 'nchan'}) is split into shards
+of consecutive output channels, each cleaned by its own CASA worker
+process without restoration. The common beam of all the shards' PSFs is
+then computed, every shard is restored (and primary-beam corrected) with
+that one beam, and the products are concatenated along frequency, so the
+cube has a single beam as with restoringbeam='common' on the whole chunk.
+weighting='briggsbwtaper' is not sharded: its taper depends on the
+fractional bandwidth of the cube being imaged, so every shard would get a
+different one.
+
+    sharded_tclean(contsub_vis, 'ngc7582.spw0.chunk0', chunk_params, nshards=16)
+"""
+
+import os
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# tclean products concatenated (when every shard has them)
+products = ['.image', '.image.pbcor', '.residual', '.model', '.psf', '.pb', '.mask', '.sumwt']
+
+
+def shard_ranges(nchan, nshards):
+    # Split nchan output channels into (first, nchan) shards of near-equal size
+    nshards = max(1, min(nshards, nchan))
+    edges = [int(round(i*nchan/float(nshards))) for i in range(nshards + 1)]
+    return [(a, b - a) for a, b in zip(edges[:-1], edges[1:])]
+
+
+def shard_name(imagename, i):
+    return '{0}.shard{1:03d}'.format(imagename, i)
+
+
+def _clean_shard(vis, imagename, params):
+    # Runs in a worker process; CASA is imported here so every worker gets its own tools
+    from casatasks import tclean, casalog
+    casalog.setlogfile(imagename + '.log')
+    tclean(vis=vis, imagename=imagename, **params)
+    return imagename
+
+
+def _restore_shard(vis, imagename, params, beam):
+    from casatasks import tclean, casalog
+    casalog.setlogfile(imagename + '.log')
+    # restart from the shard's model and residual: restoration (and pbcor) only
+    restore = dict(params, niter=0, calcpsf=False, calcres=False, restoration=True,
+                   restoringbeam=beam, usemask='user', mask='', restart=True)
+    tclean(vis=vis, imagename=imagename, **restore)
+    return imagename
+
+
+def common_beam(images):
+    """
+    Smallest beam enclosing the per-plane beams of all 'images' (as
+    ia.commonbeam), returned as a tclean restoringbeam list.
+    """
+    from casatools import image
+    ia = image()
+    cat = ia.imageconcat(outfile='', infiles=images, axis=_spectral_axis(images[0]), relax=True)
+    try:
+        beam = cat.commonbeam()
+    finally:
+        cat.close()
+        ia.close()
+    return ['{0}{1}'.format(beam['major']['value'], beam['major']['unit']),
+            '{0}{1}'.format(beam['minor']['value'], beam['minor']['unit']),
+            '{0}{1}'.format(beam['pa']['value'], beam['pa']['unit'])]
+
+
+def _spectral_axis(imagename):
+    from casatools import image
+    ia = image()
+    ia.open(imagename)
+    try:
+        return int(ia.coordsys().findcoordinate('spectral')['pixel'][0])
+    finally:
+        ia.close()
+
+
+def concat_shards(shards, imagename, keep_shards=False):
+    # Concatenate each product of the shards along frequency into imagename + product
+    from casatools import image
+    axis = _spectral_axis(shards[0] + '.image' if os.path.exists(shards[0] + '.image')
+                          else shards[0] + '.psf')
+    for product in products:
+        parts = [shard + product for shard in shards]
+        if not all(os.path.exists(p) for p in parts):
+            continue
+        outfile = imagename + product
+        if os.path.exists(outfile):
+            shutil.rmtree(outfile)
+        ia = image()
+        cat = ia.imageconcat(outfile=outfile, infiles=parts, axis=axis, relax=True, overwrite=True)
+        cat.close()
+        ia.close()
+    if not keep_shards:
+        for shard in shards:
+            for product in products + ['.weight', '.workdirectory']:
+                shutil.rmtree(shard + product, ignore_errors=True)
+            if os.path.exists(shard + '.log'):
+                os.remove(shard + '.log')
+
+
+def sharded_tclean(vis, imagename, params, nshards=None, max_workers=None, mp_context='fork',
+                   keep_shards=False):
+    """
+    tclean a cube (params as for tclean, with integer channel 'start',
+    'width' and 'nchan') in nshards parallel channel ranges (default: one per
+    core, limited by nchan), restored with one common beam.
+    weighting='briggsbwtaper' raises ValueError: the taper is computed from
+    the bandwidth of each shard, not of the whole cube (use 'briggs', or one
+    tclean). mp_context: 'fork' by default; spawned workers re-import the
+    main script, which would re-run an unguarded one such as
+    line_imaging_walkthrough.py.
+    """
+    if params.get('weighting') == 'briggsbwtaper':
+        raise ValueError("weighting='briggsbwtaper' would taper each shard differently; "
+                         "use 'briggs' or a single tclean")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    nshards = nshards or max_workers
+    start, width = int(params.get('start', 0)), int(params.get('width', 1))
+    ranges = shard_ranges(int(params['nchan']), nshards)
+
+    # Absolute paths, in case a worker does not share the working directory (spawn)
+    vis = os.path.abspath(vis)
+    imagename = os.path.abspath(imagename)
+    shards = [shard_name(imagename, i) for i in range(len(ranges))]
+    pbcor = params.get('pbcor', False)
+    # interactive cleaning cannot run in several processes at once
+    shard_params = [dict(params, start=start + first*width, nchan=n, restoration=False,
+                         pbcor=False, interactive=False, restoringbeam='')
+                    for first, n in ranges]
+
+    ctx = multiprocessing.get_context(mp_context)
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(ranges)), mp_context=ctx) as pool:
+        futures = [pool.submit(_clean_shard, vis, shard, p) for shard, p in zip(shards, shard_params)]
+        for future, (first, n) in zip(futures, ranges):
+            future.result()
+            print('Cleaned channels {0}-{1}'.format(first, first + n - 1))
+
+        beam = common_beam([shard + '.psf' for shard in shards])
+        print('Common beam:', beam)
+        futures = [pool.submit(_restore_shard, vis, shard, dict(p, pbcor=pbcor), beam)
+                   for shard, p in zip(shards, shard_params)]
+        for future in futures:
+            future.result()
+
+    concat_shards(shards, imagename, keep_shards)
+    return imagename
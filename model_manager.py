@@ -0,0 +1,135 @@
+"""
+Keep track of what is in MODEL_DATA
+
+ft(usescratch=True) rewrites the whole MODEL_DATA column. The model manager
+remembers which model image (and its content hash) was last written into the
+MS, in '<vis>.model_state.json', and skips ft() when asked to write the same
+model again. Models written by other means (e.g. tclean with
+savemodel='modelcolumn') can be registered with record_model().
+
+sampled_model_check() replaces the full-MS plotms passes used to confirm that
+the model is there: it reads a few hundred evenly spaced rows only.
+
+    ensure_model(vis, '7582_selfcal.ms_cont.ph1.clean.model')
+    sampled_model_check(vis, plotfile='model_check.png')
+"""
+
+import os
+import json
+import numpy as np
+from casatools import table
+from stepgraph import fingerprint
+
+tb = table()
+
+
+def _state_file(vis):
+    # Beside the MS itself, not a link to it, so every job using the MS shares one state
+    return os.path.realpath(vis.rstrip('/')) + '.model_state.json'
+
+
+def _ms_identity(vis):
+    # Changes if the MS is replaced (e.g. split again) or rows are added
+    tb.open(vis)
+    try:
+        nrow = tb.nrows()
+        has_model = 'MODEL_DATA' in tb.colnames()
+    finally:
+        tb.close()
+    return {'inode': os.stat(vis).st_ino, 'nrow': nrow}, has_model
+
+
+def load_state(vis):
+    if os.path.exists(_state_file(vis)):
+        with open(_state_file(vis)) as f:
+            return json.load(f)
+    return {'files': {}}
+
+
+def record_model(vis, model):
+    # Register that MODEL_DATA now holds the FT of 'model'
+    state = load_state(vis)
+    state['model'] = os.path.abspath(model)
+    state['hash'] = fingerprint(model, state['files'])
+    state['ms'], _ = _ms_identity(vis)
+    with open(_state_file(vis), 'w') as f:
+        json.dump(state, f, indent=1)
+
+
+def invalidate_model(vis):
+    # Call after anything that changes MODEL_DATA behind our back (delmod, setjy, ...)
+    if os.path.exists(_state_file(vis)):
+        os.remove(_state_file(vis))
+
+
+def model_is_current(vis, model):
+    state = load_state(vis)
+    if state.get('model') != os.path.abspath(model):
+        return False
+    ms, has_model = _ms_identity(vis)
+    if not has_model or state.get('ms') != ms:
+        return False
+    return state.get('hash') == fingerprint(model, state['files'])
+
+
+def ensure_model(vis, model, **ft_kw):
+    """
+    Make sure MODEL_DATA holds the FT of 'model', running ft() only if needed.
+    Returns True if ft() was run.
+    """
+    from casatasks import ft
+    if model_is_current(vis, model):
+        print('MODEL_DATA already holds {0}, skipping ft'.format(model))
+        return False
+    ft(vis=vis, model=model, usescratch=True, **ft_kw)
+    record_model(vis, model)
+    return True
+
+
+def sampled_model_check(vis, nrows=300, plotfile=None):
+    """
+    Read MODEL_DATA for nrows evenly spaced rows and check that it is not empty.
+    Optionally plot amplitude against uv distance for those rows.
+    Returns a dict with the number of rows read, the fraction of non-zero model
+    visibilities and their median amplitude.
+    """
+    tb.open(vis)
+    try:
+        if 'MODEL_DATA' not in tb.colnames():
+            print('No MODEL_DATA column in ' + vis)
+            return {'nrows': 0, 'nonzero_fraction': 0.0, 'median_amp': 0.0}
+        rows = np.unique(np.linspace(0, tb.nrows() - 1, min(nrows, tb.nrows())).astype(int))
+        sub = tb.selectrows(rows.tolist())
+        try:
+            ddids = sub.getcol('DATA_DESC_ID')
+            uvw = sub.getcol('UVW')
+            # rows of different spws may have different shapes, so read them one by one
+            amp = np.array([np.abs(sub.getcell('MODEL_DATA', i)).mean() for i in range(sub.nrows())])
+        finally:
+            sub.close()
+    finally:
+        tb.close()
+
+    result = {'nrows': len(rows),
+              'nonzero_fraction': float(np.mean(amp > 0)),
+              'median_amp': float(np.median(amp))}
+    print('MODEL_DATA check on {nrows} rows: non-zero fraction {nonzero_fraction:.2f}, '
+          'median amplitude {median_amp:.3g} Jy'.format(**result))
+    if result['nonzero_fraction'] == 0:
+        print('Warning: MODEL_DATA is empty in the sampled rows')
+
+    if plotfile is not None:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(6, 4))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        uvdist = np.hypot(uvw[0], uvw[1])
+        for d in np.unique(ddids):
+            sel = ddids == d
+            ax.plot(uvdist[sel], amp[sel], '.', markersize=3, label='ddid '+str(d))
+        ax.set_xlabel('uv distance (m)')
+        ax.set_ylabel('Model amplitude (Jy)')
+        ax.legend(fontsize=7)
+        fig.savefig(plotfile, dpi=100, bbox_inches='tight')
+    return result
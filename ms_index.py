@@ -0,0 +1,168 @@
+"""
+Cached summary of a measurement set's metadata
+
+ms_index() reads the FIELD, SPECTRAL_WINDOW, DATA_DESCRIPTION and ANTENNA
+subtables and the main table's column list with one bulk getcol per column,
+and saves the summary beside the MS ('<vis>.index.json'). The cache is keyed
+on the modification times of those tables, so it is rebuilt only when the
+MS changes. Mosaics are detected with np.unique on the field phase centres.
+
+    index = ms_index('NGC3351_12m_co21.ms')
+    index['is_mosaic'], index['spws'][0]['nchan']
+    choose_gridder('NGC3351_12m_co21.ms')     # 'mosaic' or 'standard'
+
+ms_columns() opens the main table once per MS and remembers, in this
+process, which columns it has with their cell shapes and approximate sizes,
+until the table's modification time changes; data_column() uses it to pick
+'corrected' or 'data'.
+
+    data_column('NGC3351_12m_co21.ms')        # 'corrected' if CORRECTED_DATA exists
+"""
+
+import os
+import json
+import numpy as np
+from casatools import table
+
+tb = table()
+
+subtables = ['FIELD', 'SPECTRAL_WINDOW', 'DATA_DESCRIPTION', 'ANTENNA']
+# phase centres closer than this (rad, ~0.01 arcsec) are the same pointing
+pointing_tolerance = 5e-8
+# bytes per value of the casacore column types
+value_bytes = {'boolean': 1, 'int': 4, 'float': 4, 'double': 8, 'complex': 8, 'dcomplex': 16}
+
+# ms_columns() results per MS path: (mtime of table.dat, columns)
+_columns = {}
+
+
+def _index_file(vis):
+    return vis.rstrip('/') + '.index.json'
+
+
+def table_mtimes(vis):
+    # Modification times of the main table and the indexed subtables
+    mtimes = {}
+    for name in [''] + subtables:
+        path = os.path.join(vis, name, 'table.dat')
+        mtimes[name or 'MAIN'] = os.stat(path).st_mtime if os.path.exists(path) else None
+    return mtimes
+
+
+def _getcols(vis, subtable, columns, varcols=()):
+    # Whole columns in one call each; varcols may have a different shape per row
+    # (e.g. CHAN_FREQ) and come back as a list of arrays, one per row
+    tb.open(os.path.join(vis, subtable))
+    try:
+        cols = dict((col, tb.getcol(col)) for col in columns if col in tb.colnames())
+        for col in varcols:
+            var = tb.getvarcol(col)
+            cols[col] = [np.ravel(var['r{0}'.format(i + 1)]) for i in range(len(var))]
+        return cols
+    finally:
+        tb.close()
+
+
+def unique_pointings(phase_dir, tolerance=pointing_tolerance):
+    # Number of distinct phase centres; phase_dir as in FIELD (2, npoly, nfield)
+    directions = np.asarray(phase_dir)[:, 0, :].T
+    if len(directions) == 0:
+        return 0
+    return len(np.unique(np.round(directions/tolerance).astype(np.int64), axis=0))
+
+
+def build_index(vis):
+    field = _getcols(vis, 'FIELD', ['NAME', 'PHASE_DIR'])
+    spw = _getcols(vis, 'SPECTRAL_WINDOW', ['NUM_CHAN', 'REF_FREQUENCY', 'TOTAL_BANDWIDTH', 'NAME'],
+                   varcols=['CHAN_FREQ'])
+    ddesc = _getcols(vis, 'DATA_DESCRIPTION', ['SPECTRAL_WINDOW_ID', 'POLARIZATION_ID'])
+    antenna = _getcols(vis, 'ANTENNA', ['NAME', 'DISH_DIAMETER'])
+    tb.open(vis)
+    try:
+        columns = list(tb.colnames())
+        nrow = tb.nrows()
+    finally:
+        tb.close()
+
+    npointing = unique_pointings(field['PHASE_DIR'])
+    spws = []
+    for i, nchan in enumerate(spw['NUM_CHAN']):
+        freqs = spw['CHAN_FREQ'][i]
+        spws.append({'name': str(spw['NAME'][i]) if 'NAME' in spw else '',
+                     'nchan': int(nchan),
+                     'ref_frequency': float(spw['REF_FREQUENCY'][i]),
+                     'first_frequency': float(freqs[0]),
+                     'last_frequency': float(freqs[-1]),
+                     'total_bandwidth': float(spw['TOTAL_BANDWIDTH'][i])})
+    return {'mtimes': table_mtimes(vis),
+            'nrow': int(nrow),
+            'columns': columns,
+            'fields': [str(name) for name in field['NAME']],
+            'phase_dir': np.asarray(field['PHASE_DIR'])[:, 0, :].T.tolist(),
+            'npointing': int(npointing),
+            'is_mosaic': bool(npointing > 1),
+            'spws': spws,
+            'data_descriptions': [int(s) for s in ddesc['SPECTRAL_WINDOW_ID']],
+            'antennas': [str(name) for name in antenna['NAME']],
+            'dish_diameters': [float(d) for d in antenna['DISH_DIAMETER']]}
+
+
+def ms_index(vis, refresh=False):
+    """
+    Metadata summary of 'vis', from '<vis>.index.json' unless the MS has
+    changed since it was written (or refresh=True).
+    """
+    filename = _index_file(vis)
+    if not refresh and os.path.exists(filename):
+        with open(filename) as f:
+            index = json.load(f)
+        if index.get('mtimes') == table_mtimes(vis):
+            return index
+    index = build_index(vis)
+    with open(filename, 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def choose_gridder(vis):
+    # 'mosaic' if the MS has more than one phase centre
+    return 'mosaic' if ms_index(vis)['is_mosaic'] else 'standard'
+
+
+def ms_columns(vis):
+    """
+    Columns of the main table of 'vis': name -> {'shape': cell shape (first
+    row for variable-shape columns, [] for scalars), 'type', 'bytes': approximate
+    size of the whole column}. Read once and kept until the table changes.
+    """
+    key = os.path.abspath(vis)
+    mtime = os.stat(os.path.join(vis, 'table.dat')).st_mtime
+    if key in _columns and _columns[key][0] == mtime:
+        return _columns[key][1]
+    columns = {}
+    tb.open(vis)
+    try:
+        nrow = tb.nrows()
+        for col in tb.colnames():
+            desc = tb.getcoldesc(col)
+            shape = []
+            if desc.get('ndim', 0) != 0:
+                shape = [int(n) for n in desc.get('shape', [])]
+                if not shape and nrow > 0 and tb.iscelldefined(col, 0):
+                    shape = [int(n) for n in tb.getcolshapestring(col, 0, 1)[0].strip('[]').split(',')]
+            vtype = desc.get('valueType', '')
+            columns[col] = {'shape': shape, 'type': vtype,
+                            'bytes': int(nrow*np.prod(shape)*value_bytes.get(vtype, 8))}
+    finally:
+        tb.close()
+    _columns[key] = (mtime, columns)
+    return columns
+
+
+def has_column(vis, column):
+    return column in ms_columns(vis)
+
+
+def data_column(vis):
+    # The datacolumn to use for split/tclean: 'corrected' if CORRECTED_DATA exists
+    return 'corrected' if has_column(vis, 'CORRECTED_DATA') else 'data'
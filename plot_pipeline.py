@@ -0,0 +1,197 @@
+"""
+Parallel, incremental rendering of the quicklook figures
+
+Figures are described by a render function of this module and its inputs
+(arrays, headers, titles, ...). PlotPipeline hashes the inputs and style of
+each figure and only renders it when that hash differs from the one recorded
+for the PNG on disk, so re-running after changing one parameter only redraws
+the figures that depend on it. Renders run in a process pool with the Agg
+backend (matplotlib Figure + FigureCanvasAgg, no pyplot state), overlapping
+with the rest of the script. preview=True renders quickly at low DPI into
+'<name>_preview.png'.
+
+    with PlotPipeline('plots') as plots:
+        plots.submit('single_channel.png', render_image, data=chan, title='Channel 522')
+        plots.submit('mean_spectrum.png', render_spectrum, x=freqs, y=mean)
+"""
+
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def _digest(value, h):
+    # Feed a (nested) render argument into the hash
+    if isinstance(value, np.ndarray):
+        h.update(str((value.shape, value.dtype.str)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            h.update(str(key).encode())
+            _digest(value[key], h)
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for item in value:
+            _digest(item, h)
+        h.update(b']')
+    elif hasattr(value, 'tostring') and hasattr(value, 'cards'):
+        # FITS header
+        h.update(value.tostring().encode())
+    else:
+        h.update(repr(value).encode())
+
+
+def plot_hash(func, kwargs):
+    h = hashlib.sha1(func.__name__.encode())
+    _digest(kwargs, h)
+    return h.hexdigest()
+
+
+def _new_figure(figsize):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _draw_image(fig, nrows, ncols, index, data, title='', cmap='inferno', cbar_label=None,
+                header=None, xlabel=None, ylabel=None, format_unit=None, lines=(), aspect=None):
+    if header is not None:
+        from astropy.wcs import WCS
+        ax = fig.add_subplot(nrows, ncols, index, projection=WCS(header))
+        if format_unit is not None:
+            ax.coords[1].set_format_unit(format_unit)
+        if xlabel:
+            ax.coords[0].set_axislabel(xlabel)
+        if ylabel:
+            ax.coords[1].set_axislabel(ylabel)
+    else:
+        ax = fig.add_subplot(nrows, ncols, index)
+        if xlabel:
+            ax.set_xlabel(xlabel)
+        if ylabel:
+            ax.set_ylabel(ylabel)
+    im = ax.imshow(data, origin='lower', cmap=cmap, aspect=aspect)
+    for (x, y) in lines:
+        ax.plot(x, y, color='white', linestyle='--')
+    ax.set_title(title)
+    fig.colorbar(im, ax=ax, label=cbar_label, fraction=0.046, pad=0.04)
+    return ax
+
+
+def render_image(filename, dpi, figsize=(8, 7), **panel):
+    # One image with a colour bar; see _draw_image for the panel options
+    fig = _new_figure(figsize)
+    _draw_image(fig, 1, 1, 1, **panel)
+    fig.savefig(filename, bbox_inches='tight', dpi=dpi)
+
+
+def render_panels(filename, dpi, panels, ncols=None, figsize=(12, 6)):
+    # Several images side by side (or in rows of ncols)
+    ncols = ncols or len(panels)
+    nrows = (len(panels) + ncols - 1)//ncols
+    fig = _new_figure(figsize)
+    for i, panel in enumerate(panels):
+        _draw_image(fig, nrows, ncols, i + 1, **panel)
+    fig.savefig(filename, bbox_inches='tight', dpi=dpi)
+
+
+def render_spectrum(filename, dpi, x, y, model=None, components=(), xlabel='Frequency (Hz)',
+                    ylabel='Intensity (Jy/beam)', title='', figsize=(8, 7)):
+    # A spectrum, optionally with a fitted model and its components
+    fig = _new_figure(figsize)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(x, y, color='k', drawstyle='steps-mid', linewidth=0.8)
+    for comp in components:
+        ax.plot(x, comp, color='tab:blue', linewidth=0.8, linestyle='--')
+    if model is not None:
+        ax.plot(x, model, color='tab:red', linewidth=1.2)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    fig.savefig(filename, bbox_inches='tight', dpi=dpi)
+
+
+def _render(func, filename, dpi, kwargs):
+    # Worker
+    func(filename, dpi, **kwargs)
+    return filename
+
+
+class PlotPipeline(object):
+    """
+    Render figures in a process pool, skipping those whose inputs are unchanged.
+    output_dir: where the PNGs (and the '.plot_hashes.json' record) go
+    preview: render at preview_dpi into '<name>_preview.png' instead of at dpi
+    max_workers: processes used for rendering (1: render in this process)
+    """
+
+    def __init__(self, output_dir, dpi=300, preview=False, preview_dpi=72, max_workers=None,
+                 mp_context='fork'):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.dpi = preview_dpi if preview else dpi
+        self.preview = preview
+        self.hash_file = os.path.join(output_dir, '.plot_hashes.json')
+        self.hashes = {}
+        if os.path.exists(self.hash_file):
+            with open(self.hash_file) as f:
+                self.hashes = json.load(f)
+        self.max_workers = max_workers
+        self.pool = None
+        if max_workers != 1:
+            self.pool = ProcessPoolExecutor(max_workers=max_workers,
+                                            mp_context=multiprocessing.get_context(mp_context))
+        self.pending = {}
+        self.skipped = []
+        self.rendered = 0
+
+    def path(self, name):
+        if self.preview:
+            name = name.replace('.png', '_preview.png')
+        return os.path.join(self.output_dir, name)
+
+    def submit(self, name, func, **kwargs):
+        # Queue the figure 'name' (a PNG file name); returns False if it is up to date
+        filename = self.path(name)
+        key = plot_hash(func, dict(kwargs, dpi=self.dpi))
+        if self.hashes.get(filename) == key and os.path.exists(filename):
+            self.skipped.append(name)
+            return False
+        if self.pool is None:
+            _render(func, filename, self.dpi, kwargs)
+            self.hashes[filename] = key
+            self.rendered += 1
+        else:
+            self.pending[filename] = (key, self.pool.submit(_render, func, filename, self.dpi, kwargs))
+        return True
+
+    def close(self):
+        # Wait for the renders and record the hashes of those that succeeded
+        failed = []
+        for filename, (key, future) in self.pending.items():
+            try:
+                future.result()
+                self.hashes[filename] = key
+                self.rendered += 1
+            except Exception as e:
+                self.hashes.pop(filename, None)
+                failed.append(filename)
+                print('Failed to render {0}: {1}'.format(filename, e))
+        if self.pool is not None:
+            self.pool.shutdown()
+        with open(self.hash_file, 'w') as f:
+            json.dump(self.hashes, f, indent=1)
+        print('Plots: {0} rendered, {1} unchanged, {2} failed'.format(
+            self.rendered, len(self.skipped), len(failed)))
+        self.pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,101 @@
+"""
+Bilinear regridding stencils cached on disk
+
+The mapping of every pixel of a template (high-resolution) grid onto a
+source (low-resolution) grid only depends on the two coordinate systems and
+shapes. stencil_geometry computes it once (feather_stream.geometry), turns
+the spatial part into a sparse matrix (four weights per template pixel,
+the same as map_coordinates order=1, mode='constant') and
+saves it, with the channel mapping, under a key hashed from the coordinate
+records. Later runs on the same geometry load the file and skip all the
+coordinate work; each channel is then regridded as one sparse mat-vec.
+
+    geo = stencil_geometry(high, low, cache_dir='regrid_cache')
+    plane_on_high_grid = apply_stencil(geo, low_plane)     # low_plane: (ny, nx)
+"""
+
+import os
+import hashlib
+import numpy as np
+import scipy.sparse
+
+
+def _digest(value, h):
+    # Feed a (nested) coordinate system record into the hash
+    if isinstance(value, dict):
+        for key in sorted(value):
+            h.update(str(key).encode())
+            _digest(value[key], h)
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        h.update(repr(np.asarray(value).tolist()).encode())
+    else:
+        h.update(repr(value).encode())
+
+
+def geometry_key(high, low):
+    # Hash of the coordinate systems and shapes of the two images
+    h = hashlib.sha1()
+    for im in (high, low):
+        _digest(im.coordsys().torecord(), h)
+        _digest(list(im.shape()), h)
+    return h.hexdigest()
+
+
+def bilinear_stencil(lx, ly, lshape):
+    """
+    Sparse (ny*nx, lny*lnx) matrix interpolating a source plane, flattened in
+    (y, x) order, at the fractional source pixels lx, ly of shape (ny, nx).
+    Neighbours outside the source count as zero.
+    """
+    lnx, lny = lshape[0], lshape[1]
+    x, y = lx.ravel(), ly.ravel()
+    x0, y0 = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+    fx, fy = x - x0, y - y0
+    # as map_coordinates mode='constant': zero outside the source pixel centres
+    valid = (x >= 0) & (x <= lnx - 1) & (y >= 0) & (y <= lny - 1)
+    rows, cols, weights = [], [], []
+    for dx, dy, w in [(0, 0, (1 - fx)*(1 - fy)), (1, 0, fx*(1 - fy)),
+                      (0, 1, (1 - fx)*fy), (1, 1, fx*fy)]:
+        xi, yi = x0 + dx, y0 + dy
+        inside = valid & (xi < lnx) & (yi < lny) & (w != 0)
+        rows.append(np.nonzero(inside)[0])
+        cols.append(yi[inside]*lnx + xi[inside])
+        weights.append(w[inside])
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(x.size, lnx*lny))
+
+
+def stencil_geometry(high, low, cache_dir='regrid_cache'):
+    """
+    feather_stream.geometry() plus the sparse spatial stencil ('matrix'),
+    loaded from cache_dir when this pair of grids has been seen before.
+    """
+    from feather_stream import geometry
+    key = geometry_key(high, low)
+    filename = os.path.join(cache_dir, 'stencil_{0}.npz'.format(key))
+    if os.path.exists(filename):
+        with np.load(filename) as f:
+            matrix = scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                             shape=tuple(f['mshape']))
+            print('Loaded regrid stencil', filename)
+            return {'matrix': matrix, 'shape': tuple(f['shape']), 'lchan': f['lchan'],
+                    'freq': f['freq'], 'lshape': f['lshape']}
+
+    geo = geometry(high, low)
+    matrix = bilinear_stencil(geo['lx'], geo['ly'], geo['lshape'])
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = filename + '.tmp.npz'
+    np.savez(tmp, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+             mshape=matrix.shape, shape=geo['lx'].shape, lchan=geo['lchan'],
+             freq=geo['freq'], lshape=geo['lshape'])
+    # atomic, so parallel runs never read a partial file
+    os.replace(tmp, filename)
+    print('Saved regrid stencil', filename)
+    return {'matrix': matrix, 'shape': geo['lx'].shape, 'lchan': geo['lchan'],
+            'freq': geo['freq'], 'lshape': geo['lshape']}
+
+
+def apply_stencil(geo, plane):
+    # Regrid a source plane indexed [y, x] onto the template grid
+    return (geo['matrix'] @ np.ascontiguousarray(plane).ravel()).reshape(geo['shape'])
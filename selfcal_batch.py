@@ -0,0 +1,112 @@
+"""
+Batch runner for self-calibrating many targets
+
+Each target of a configuration file (see selfcal_config.py) is self-calibrated
+by its own CASA process running itrain-selfcal.py, in its own working directory
+(the MS and clean mask are linked there) with its own CASA log. Jobs are
+started as long as the number of running jobs stays below max_jobs and their
+estimated memory (from imsize and the number of channels) fits in memory_gb;
+a job larger than the whole budget still runs, on its own. Targets that
+share an MS (e.g. different fields of one MS) never run at the same time:
+self-calibration rewrites its MODEL_DATA and CORRECTED_DATA.
+
+From a shell:
+
+    python selfcal_batch.py selfcal_targets.toml --max-jobs 8 --memory-gb 200
+
+or from Python:
+
+    run_batch('selfcal_targets.toml', max_jobs=8, memory_gb=200)
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+from selfcal_config import load_targets, estimate_memory_gb
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+default_script = os.path.join(repo_dir, 'itrain-selfcal.py')
+
+
+def _link(path, workdir):
+    # Make 'path' available in the working directory under its own name
+    link = os.path.join(workdir, os.path.basename(path))
+    if not os.path.lexists(link):
+        os.symlink(path, link)
+
+
+def prepare_workdir(params):
+    os.makedirs(params['workdir'], exist_ok=True)
+    _link(params['vis'], params['workdir'])
+    _link(params['cleanmask'], params['workdir'])
+
+
+def start_job(name, params, config_file, script, casa_cmd):
+    prepare_workdir(params)
+    logfile = os.path.join(params['workdir'], 'casa_' + name + '.log')
+    env = dict(os.environ)
+    env['SELFCAL_CONFIG'] = os.path.abspath(config_file)
+    env['SELFCAL_TARGET'] = name
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    cmd = casa_cmd.split() + ['--nologger', '--nogui', '--agg', '--logfile', logfile, '-c', script]
+    with open(os.path.join(params['workdir'], 'casa_' + name + '.out'), 'w') as out:
+        return subprocess.Popen(cmd, cwd=params['workdir'], env=env, stdout=out, stderr=subprocess.STDOUT)
+
+
+def run_batch(config_file, targets=None, max_jobs=None, memory_gb=None,
+              script=default_script, casa_cmd='casa', poll=10):
+    """
+    Self-calibrate the targets (default: all) of config_file.
+    max_jobs: maximum number of CASA processes at once (default: number of cores)
+    memory_gb: memory budget shared by the running jobs (default: no limit)
+    Jobs on the same MS (after resolving links) run one after the other.
+    Returns a dict target -> CASA exit code.
+    """
+    all_targets = load_targets(config_file)
+    queue = [name for name in (targets or all_targets)]
+    if max_jobs is None:
+        max_jobs = os.cpu_count() or 1
+    memory = dict((name, estimate_memory_gb(all_targets[name]['imsize'], all_targets[name]['nchan']))
+                  for name in queue)
+    ms = dict((name, os.path.realpath(all_targets[name]['vis'])) for name in queue)
+
+    running = {}
+    status = {}
+    while queue or running:
+        # start whatever fits
+        for name in list(queue):
+            if len(running) >= max_jobs:
+                break
+            used = sum(memory[n] for n in running)
+            if running and memory_gb is not None and used + memory[name] > memory_gb:
+                continue
+            if any(ms[n] == ms[name] for n in running):
+                continue
+            print('Starting {0} ({1:.1f} GB estimated)'.format(name, memory[name]))
+            running[name] = start_job(name, all_targets[name], config_file, script, casa_cmd)
+            queue.remove(name)
+
+        time.sleep(poll)
+        for name, proc in list(running.items()):
+            if proc.poll() is not None:
+                status[name] = proc.returncode
+                print('Finished {0}: {1}'.format(name, 'ok' if proc.returncode == 0 else
+                                                 'failed (exit code {0})'.format(proc.returncode)))
+                del running[name]
+
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Self-calibrate many targets in parallel')
+    parser.add_argument('config', help='TOML or YAML target configuration')
+    parser.add_argument('--targets', nargs='*', help='subset of targets to run')
+    parser.add_argument('--max-jobs', type=int, default=None)
+    parser.add_argument('--memory-gb', type=float, default=None)
+    parser.add_argument('--casa', default='casa', help='command used to start CASA')
+    args = parser.parse_args()
+    status = run_batch(args.config, targets=args.targets, max_jobs=args.max_jobs,
+                       memory_gb=args.memory_gb, casa_cmd=args.casa)
+    sys.exit(0 if all(code == 0 for code in status.values()) else 1)
@@ -0,0 +1,81 @@
+"""
+Per-target configuration for the self-calibration workflow
+
+A configuration file (TOML or YAML) holds a 'defaults' table and one table per
+target, with the same names as the parameters of itrain-selfcal.py:
+
+    [defaults]
+    refantenna = 'DV14'
+    cell = '0.018arcsec'
+    imsize = 2304
+
+    [targets.NGC7582]
+    vis = '7582_selfcal.ms'
+    field = 'NGC7582'
+    contchans = '0:166~194;304~475,1:50~172;216~356;428~436'
+    cleanmask = '7582_cont_cleanmask.mask'
+
+Paths (vis, cleanmask, workdir) are relative to the configuration file.
+Parameters that are not given (e.g. selfcal_schedule) keep their values in
+itrain-selfcal.py.
+See selfcal_targets.toml for a complete example.
+"""
+
+import os
+
+# Parameters a target must define, directly or through the defaults
+required = ['vis', 'field', 'refantenna', 'contchans', 'cell', 'imsize', 'cleanmask']
+path_keys = ['vis', 'cleanmask', 'workdir']
+
+# Rough tclean memory model: ~8 float images plus padded complex FFT grids per
+# pixel and channel, on top of the memory of a CASA process
+bytes_per_pixel = 55
+casa_overhead_gb = 2.0
+
+
+def read_config(config_file):
+    if config_file.endswith(('.yaml', '.yml')):
+        import yaml
+        with open(config_file) as f:
+            return yaml.safe_load(f)
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    with open(config_file, 'rb') as f:
+        return tomllib.load(f)
+
+
+def load_targets(config_file):
+    # Dictionary target name -> parameters (defaults merged, paths made absolute)
+    config = read_config(config_file)
+    defaults = config.get('defaults', {})
+    base = os.path.dirname(os.path.abspath(config_file))
+    targets = {}
+    for name, params in config.get('targets', {}).items():
+        merged = dict(defaults, **params)
+        missing = [key for key in required if key not in merged]
+        if missing:
+            raise ValueError('Target {0} in {1} is missing: {2}'.format(name, config_file, ', '.join(missing)))
+        merged.setdefault('workdir', 'selfcal_' + name)
+        merged.setdefault('nchan', 1)
+        for key in path_keys:
+            merged[key] = os.path.normpath(os.path.join(base, merged[key]))
+        targets[name] = merged
+    return targets
+
+
+def target_parameters(config_file, name):
+    # Parameters for one target, as used inside its working directory: the MS and
+    # the clean mask are linked there by selfcal_batch.py, so only their names are kept
+    params = dict(load_targets(config_file)[name])
+    params['visname'] = os.path.basename(params.pop('vis'))
+    params['cleanmask'] = os.path.basename(params['cleanmask'])
+    return params
+
+
+def estimate_memory_gb(imsize, nchan=1):
+    # Peak memory of one self-cal job, dominated by tclean
+    if not isinstance(imsize, (list, tuple)):
+        imsize = [imsize, imsize]
+    return casa_overhead_gb + imsize[0]*imsize[1]*nchan*bytes_per_pixel/1024.0**3
@@ -0,0 +1,228 @@
+"""
+Self-calibration loop driver
+
+Every self-cal round follows the same pattern: gaincal (applying the tables of
+the previous rounds on the fly), applycal of the cumulative table chain,
+tclean, image statistics and ft of the new model (skipped by model_manager
+when that model is already in MODEL_DATA). Instead of writing each round
+by hand, describe them with a schedule:
+
+    schedule = [('p', 'inf'), ('p', '60s'), ('ap', '120s'), ('ap', '60s', 'T')]
+
+Each entry is (calmode, solint[, gaintype][, overrides]), e.g.
+('ap', '60s', 'T', {'deconvolver': 'multiscale', 'scales': [0, 4, 8, 12]}).
+The overrides are tclean parameters, except two keys of the round itself:
+'applymode' (applycal mode of this round, e.g. 'calflag' for the final one)
+and 'sweep': True to explore the solution intervals (parallel gaincal sweep
+into '<label>_checks' with the round's gaintable chain, then the SNR
+distribution) in two steps before the round.
+The caltable and image names follow the usual convention
+(<vis>_cont.ph1.solint_inf.tb, <vis>_cont.ph1.clean, ...) and the gaintable
+and spwmap chains are built from the previous rounds.
+
+The loop stops early when the SNR does not improve by at least min_improvement
+(fractional) with respect to the previous image. The rejected round is undone
+in the MS: the previous chain is re-applied and its model kept in (or, after
+the clearcal that undoes a first round, put back into) MODEL_DATA, so the MS
+matches the best image.
+
+Use selfcal_steps() to get the rounds as steps for stepgraph.run_steps, or
+run_selfcal() to run them directly.
+"""
+
+import os
+import glob
+import shutil
+from casatasks import gaincal, applycal, tclean, clearcal
+from stepgraph import column
+from model_manager import ensure_model, invalidate_model
+from solint_sweep import run_solint_sweep, sweep_caltable
+
+label_prefix = {'p': 'ph', 'ap': 'ap', 'a': 'amp'}
+
+
+def selfcal_schedule(vis, schedule):
+    # Expand the schedule into rounds with their table, image and gaintable chain
+    rounds = []
+    counts = {}
+    chain = []
+    for entry in schedule:
+        entry = list(entry)
+        overrides = dict(entry.pop()) if isinstance(entry[-1], dict) else {}
+        applymode = overrides.pop('applymode', None)
+        sweep = overrides.pop('sweep', False)
+        calmode, solint = entry[0], entry[1]
+        gaintype = entry[2] if len(entry) > 2 else 'G'
+        counts[calmode] = counts.get(calmode, 0) + 1
+        label = label_prefix.get(calmode, calmode) + str(counts[calmode])
+        caltable = vis + '_cont.' + label + '.solint_' + solint + '.tb'
+        rounds.append({'label': label,
+                       'calmode': calmode,
+                       'solint': solint,
+                       'gaintype': gaintype,
+                       'caltable': caltable,
+                       'gaintable': list(chain),
+                       'imagename': vis + '_cont.' + label + '.clean',
+                       'tclean': overrides,
+                       'apply': {'applymode': applymode} if applymode else {},
+                       'sweep': sweep})
+        chain.append(caltable)
+    return rounds
+
+
+def _apply(vis, gaintable, spwmap, apply_params):
+    if not gaintable:
+        # nothing to apply: reset CORRECTED_DATA to DATA. clearcal also re-initialises
+        # MODEL_DATA when it exists, so the recorded model is no longer there
+        clearcal(vis=vis, addmodel=False)
+        invalidate_model(vis)
+        return
+    applycal(vis=vis, gaintable=gaintable, spwmap=[spwmap]*len(gaintable),
+             calwt=False, flagbackup=False, **apply_params)
+
+
+def _clean(vis, imagename, tclean_params):
+    for old in glob.glob(imagename + '.*'):
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        else:
+            os.remove(old)
+    tclean(vis=vis, imagename=imagename, **tclean_params)
+
+
+def run_round(vis, rnd, previous, imstats, cal_params, apply_params, tclean_params,
+              spwmap=[], min_improvement=0.02):
+    """
+    One self-cal round. 'previous' is the previous round (or None) and its image
+    label must already be in imstats.history. Returns a dict with the SNR and,
+    if the round did not improve the image, stop=True.
+    """
+    if os.path.exists(rnd['caltable']):
+        shutil.rmtree(rnd['caltable'])
+    gaincal(vis=vis, caltable=rnd['caltable'], gaintable=rnd['gaintable'],
+            spwmap=[spwmap]*len(rnd['gaintable']), calmode=rnd['calmode'],
+            solint=rnd['solint'], gaintype=rnd['gaintype'], **cal_params)
+    _apply(vis, rnd['gaintable'] + [rnd['caltable']], spwmap, dict(apply_params, **rnd['apply']))
+    _clean(vis, rnd['imagename'], dict(tclean_params, **rnd['tclean']))
+
+    stats = imstats.measure(rnd['imagename'] + '.image', rnd['label'])
+    print('{0}: rms {1:.3f}, peak {2:.3f}, snr {3:.0f}'.format(rnd['label'], stats['rms'], stats['peak'], stats['snr']))
+    result = {'label': rnd['label'], 'snr': stats['snr']}
+
+    prev_snr = None
+    if previous is not None:
+        prev_snr = next((r['snr'] for r in imstats.history if r['label'] == previous['label']), None)
+    if prev_snr is not None and stats['snr'] < prev_snr*(1.0 + min_improvement):
+        # not worth it: go back to the previous calibration and model
+        _apply(vis, rnd['gaintable'], spwmap, dict(apply_params, **previous.get('apply', {})))
+        if 'imagename' in previous:
+            # a no-op unless clearcal has just wiped MODEL_DATA
+            ensure_model(vis, previous['imagename'] + '.model')
+        result.update(stop=True, reason='SNR {0:.0f} -> {1:.0f}, keeping {2}'.format(
+            prev_snr, stats['snr'], previous['label']))
+        return result
+
+    ensure_model(vis, rnd['imagename'] + '.model')
+    return result
+
+
+def _restore_round(vis, rnd, spwmap, apply_params):
+    # Bring CORRECTED_DATA and MODEL_DATA back to the state after this round
+    def restore():
+        _apply(vis, rnd['gaintable'] + [rnd['caltable']], spwmap, dict(apply_params, **rnd['apply']))
+        ensure_model(vis, rnd['imagename'] + '.model')
+    return restore
+
+
+def sweep_steps(vis, rnd, cal_params, spwmap=[], solints=(), max_workers=None):
+    # Two steps exploring the solution intervals of a round: the parallel gaincal sweep
+    # (with the round's gaintable chain applied) and the SNR distribution of its tables
+    from selfcal_plots import plot_gaincal_snr_dist
+    selfcal_cycle = rnd['label'] + '_checks'
+    tables = [sweep_caltable(vis, selfcal_cycle, ss) for ss in solints]
+
+    def sweep():
+        run_solint_sweep(vis, selfcal_cycle, list(solints), max_workers=max_workers,
+                         gaintable=rnd['gaintable'], spwmap=[spwmap]*len(rnd['gaintable']),
+                         calmode=rnd['calmode'], gaintype=rnd['gaintype'], **cal_params)
+        print('Check output of this step in folder: ' + selfcal_cycle)
+
+    def snr():
+        plot_gaincal_snr_dist(selfcal_cycle + '/', os.path.basename(vis), selfcal_cycle, list(solints))
+        print('Check output of this step in folder: ' + selfcal_cycle)
+
+    return [dict(title='Explore solution intervals before round {0}'.format(rnd['label']),
+                 run=sweep,
+                 inputs=[column(vis, 'DATA'), column(vis, 'MODEL_DATA')] + rnd['gaintable'],
+                 outputs=tables,
+                 params=dict(cal=cal_params, calmode=rnd['calmode'], gaintype=rnd['gaintype'],
+                             solints=list(solints), spwmap=spwmap)),
+            dict(title='[ADVANCED] SNR of the solution intervals before round {0}'.format(rnd['label']),
+                 run=snr, inputs=tables,
+                 outputs=[selfcal_cycle + '/' + selfcal_cycle + '_SNR_hist_solint_all.png'])]
+
+
+def _initial(label, imagename):
+    # Stands for the image before the first round
+    initial = {'label': label}
+    if imagename:
+        initial['imagename'] = imagename
+    return initial
+
+
+def selfcal_steps(vis, schedule, imstats, cal_params, apply_params, tclean_params,
+                  initial_label, extra_inputs=(), spwmap=[], min_improvement=0.02, first_step=0,
+                  sweep_solints=(), sweep_workers=None, initial_image=None):
+    """
+    The schedule as a dict of stepgraph steps numbered from first_step.
+    initial_label: imstats label of the image the model in MODEL_DATA comes from
+    initial_image: that image's name (without '.model'), to put its model back if
+        the first round is rejected
+    extra_inputs: files every round depends on (e.g. the clean mask)
+    sweep_solints, sweep_workers: solution intervals and parallel gaincals of the
+        sweeps of rounds with 'sweep': True
+    """
+    rounds = selfcal_schedule(vis, schedule)
+    steps = {}
+    previous = _initial(initial_label, initial_image)
+    n = first_step
+    for rnd in rounds:
+        if rnd['sweep']:
+            for step in sweep_steps(vis, rnd, cal_params, spwmap, sweep_solints, sweep_workers):
+                steps[n] = step
+                n += 1
+
+        def run(rnd=rnd, previous=previous):
+            return run_round(vis, rnd, previous, imstats, cal_params, apply_params, tclean_params,
+                             spwmap=spwmap, min_improvement=min_improvement)
+        steps[n] = dict(
+            title='Self-calibration round {0}: calmode={1}, solint={2}, gaintype={3}'.format(
+                rnd['label'], rnd['calmode'], rnd['solint'], rnd['gaintype']),
+            run=run,
+            inputs=[column(vis, 'DATA'), column(vis, 'MODEL_DATA')] + rnd['gaintable'] + list(extra_inputs),
+            outputs=[rnd['caltable'], rnd['imagename'] + '.image', rnd['imagename'] + '.model',
+                     column(vis, 'CORRECTED_DATA'), column(vis, 'MODEL_DATA')],
+            params=dict(cal=cal_params, apply=dict(apply_params, **rnd['apply']),
+                        tclean=dict(tclean_params, **rnd['tclean']),
+                        calmode=rnd['calmode'], solint=rnd['solint'], gaintype=rnd['gaintype'],
+                        spwmap=spwmap, min_improvement=min_improvement),
+            restore=_restore_round(vis, rnd, spwmap, apply_params))
+        n += 1
+        previous = rnd
+    return steps
+
+
+def run_selfcal(vis, schedule, imstats, cal_params, apply_params, tclean_params,
+                initial_label, spwmap=[], min_improvement=0.02, initial_image=None):
+    # Run the whole schedule without the step engine; returns the per-round results
+    results = []
+    previous = _initial(initial_label, initial_image)
+    for rnd in selfcal_schedule(vis, schedule):
+        result = run_round(vis, rnd, previous, imstats, cal_params, apply_params, tclean_params,
+                           spwmap=spwmap, min_improvement=min_improvement)
+        results.append(result)
+        if result.get('stop'):
+            print('Stopping self-calibration: ' + result['reason'])
+            break
+        previous = rnd
+    return results
@@ -0,0 +1,141 @@
+"""
+Plotting helpers for the self-calibration scripts
+
+These used to live in itrain-selfcal.py; they are kept in a module so that the
+solution-interval sweep workers (solint_sweep.py) can import them.
+
+plot_gaincal_table draws the gain phases with matplotlib by default: each
+caltable is read with one getcol per column and all antenna panels are rendered
+in-process with the Agg backend, which takes well under a second per table.
+backend='plotms' gives the original plotms plots.
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from casatools import table
+from gaincal_stats import load_snr_tables, snr_summary, snr_histogram, write_snr_summary
+
+tb = table()
+
+
+def plot_gaincal_table(caltable, backend='agg'):
+    # make plots for antenna groups of 8 that will be saved in png files
+    if backend == 'plotms':
+        plot_gaincal_table_plotms(caltable)
+    else:
+        plot_gaincal_table_agg(caltable)
+
+
+def plot_gaincal_table_plotms(caltable):
+    from casaplotms import plotms
+    for ant in range(3):
+        plotms(vis=caltable,xaxis='time',yaxis='phase',iteraxis='antenna',gridrows=4, gridcols=2,coloraxis='spw',
+            xaxisfont = 7, yaxisfont = 7, highres =  True,
+            antenna=str(ant*8)+'~'+str(ant*8+7),
+            showgui = False, plotfile=caltable+'_ant'+str(ant*8)+'-'+str(ant*8+7)+'.png')
+
+
+def read_gaincal_phases(caltable):
+    # Bulk read of a gain table; returns time [s], antenna, spw, phase [deg] and flags
+    # phase and flag have shape (npol, nchan, nrow)
+    tb.open(caltable)
+    try:
+        time = tb.getcol('TIME')
+        ant = tb.getcol('ANTENNA1')
+        spw = tb.getcol('SPECTRAL_WINDOW_ID')
+        cparam = tb.getcol('CPARAM')
+        flag = tb.getcol('FLAG')
+    finally:
+        tb.close()
+    tb.open(caltable+'/ANTENNA')
+    try:
+        antnames = list(tb.getcol('NAME'))
+    finally:
+        tb.close()
+    phase = np.angle(cparam, deg=True)
+    return time, ant, spw, phase, flag, antnames
+
+
+def plot_gaincal_table_agg(caltable, gridrows=4, gridcols=2, dpi=100):
+    time, ant, spw, phase, flag, antnames = read_gaincal_phases(caltable)
+    phase = np.where(flag, np.nan, phase)
+    hours = (time - 86400.0*np.floor(time.min()/86400.0))/3600.0
+
+    spws = np.unique(spw)
+    spw_colour = dict((s, 'C'+str(i % 10)) for i, s in enumerate(spws))
+    markers = ['o', 'x', '+', 's']
+
+    # group rows by antenna once instead of selecting per panel
+    order = np.argsort(ant, kind='stable')
+    ants, starts = np.unique(ant[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    rows = dict(zip(ants, zip(starts, ends)))
+
+    # one figure with shared axes, reused for every group of antennas:
+    # building and laying out the axes costs more than drawing the points
+    npanel = gridrows*gridcols
+    nant = len(antnames)
+    fig = Figure(figsize=(8, 10))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(gridrows, gridcols, sharex=True, sharey=True, squeeze=False).ravel()
+    fig.subplots_adjust(left=0.08, right=0.98, bottom=0.06, top=0.93, hspace=0.3, wspace=0.08)
+    axes[0].set_ylim(-180, 180)
+    axes[0].set_yticks([-180, -90, 0, 90, 180])
+    axes[0].set_xlim(hours.min() - 0.05, hours.max() + 0.05)
+    for i, ax in enumerate(axes):
+        ax.tick_params(labelsize=7)
+        if i >= npanel - gridcols:
+            ax.set_xlabel('Time (UT hours)', fontsize=7)
+        if i % gridcols == 0:
+            ax.set_ylabel('Phase (deg)', fontsize=7)
+    fig.suptitle(caltable, fontsize=8)
+
+    for first in range(0, nant, npanel):
+        for i, ax in enumerate(axes):
+            for line in list(ax.lines):
+                line.remove()
+            if ax.get_legend() is not None:
+                ax.get_legend().remove()
+            a = first + i
+            ax.set_title(antnames[a] if a < nant else '', fontsize=8)
+            if a not in rows:
+                continue
+            sel = order[rows[a][0]:rows[a][1]]
+            for s in spws:
+                sel_spw = sel[spw[sel] == s]
+                for p in range(phase.shape[0]):
+                    y = phase[p][:, sel_spw]
+                    x = np.broadcast_to(hours[sel_spw], y.shape)
+                    ax.plot(x.ravel(), y.ravel(), linestyle='none',
+                            marker=markers[p % len(markers)], markersize=3,
+                            color=spw_colour[s], label='spw '+str(s) if p == 0 else None)
+        axes[0].legend(fontsize=6, loc='upper right')
+        fig.savefig(caltable+'_ant'+str(first)+'-'+str(first+npanel-1)+'.png', dpi=dpi)
+
+
+def plot_gaincal_snr_dist(path, visname, selfcal_cycle, solints, thresholds=(6,)):
+    # Make plot of SNR of gaintables for a list of solution intervals
+    # path: path to caltables; plot will be saved in that path too
+    # solints: list of solution intervals (list of strings)
+    # thresholds: SNR values to report P(<=snr) for; the full summary (percentiles,
+    # flagged fraction, per-antenna breakdown) is also written as CSV and JSON
+    caltables = dict((ss, path+'/'+visname+'.'+selfcal_cycle+'.solint_'+ss+'.tb') for ss in solints)
+    tables = load_snr_tables(caltables)
+    summary = snr_summary(tables, thresholds=thresholds)
+
+    print("Percentile of score for snr={0}, i.e. percentage of solutions with snr <={0}:".format(thresholds[0]))
+    for ss in solints:
+        density, edges = snr_histogram(tables[ss]['snr'], bins=50)
+        plt.hist( edges[:-1], bins=edges, weights=density, histtype='step', label=ss )
+
+        print( 'P(<={0}) = {1}  ({2})'.format( thresholds[0], summary[ss]['fraction_below'][thresholds[0]], ss ) )
+
+    plt.legend( loc='upper right' )
+    plt.xlabel( 'SNR' )
+    plt.savefig(path+'/'+selfcal_cycle+'_SNR_hist_solint_all.png')
+
+    write_snr_summary(summary, path+'/'+selfcal_cycle+'_SNR_summary.csv')
+    write_snr_summary(summary, path+'/'+selfcal_cycle+'_SNR_summary.json')
+    return summary
@@ -0,0 +1,73 @@
+"""
+Parallel solution-interval sweep for the self-calibration checks
+
+Runs gaincal for every solution interval at the same time, one CASA worker
+process per solint, writing each caltable and its plots straight into the
+checks folder (e.g. 'ph1_checks'). The sweep then takes about as long as the
+slowest solint instead of the sum of all of them.
+
+    run_solint_sweep(vis, 'ph1_checks', ['int', '20s', 'inf'], max_workers=4,
+                     refant='DV14', spw=contchans, calmode='p', gaintype='G', minsnr=3)
+"""
+
+import os
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def sweep_caltable(vis, selfcal_cycle, solint):
+    # Same naming as the original sweep, but inside the checks folder
+    return os.path.join(selfcal_cycle, os.path.basename(vis)+'.'+selfcal_cycle+'.solint_'+solint+'.tb')
+
+
+def _solve_solint(vis, caltable, solint, plot, gaincal_kw):
+    # Runs in a worker process; each worker imports the tasks and writes its own log
+    from casatasks import gaincal, casalog
+    casalog.setlogfile(caltable + '.log')
+    gaincal(vis=vis, caltable=caltable, solint=solint, **gaincal_kw)
+    if plot:
+        from selfcal_plots import plot_gaincal_table
+        plot_gaincal_table(caltable)
+    return caltable
+
+
+def run_solint_sweep(vis, selfcal_cycle, solints, max_workers=None, plot=True,
+                     mp_context='fork', **gaincal_kw):
+    """
+    Solve for all solints in parallel and return the list of caltables.
+
+    selfcal_cycle: output folder and caltable tag, e.g. 'ph1_checks'
+    max_workers: maximum number of gaincal processes running at once
+                 (default: one per solint, limited to the number of cores)
+    gaincal_kw: any other gaincal parameters (refant, spw, calmode, gaintable, ...)
+    mp_context: 'fork' by default; spawned workers re-import the main script, which
+                would re-run an unguarded pipeline such as itrain-selfcal.py
+    """
+    if os.path.exists(selfcal_cycle):
+        shutil.rmtree(selfcal_cycle)
+    os.makedirs(selfcal_cycle)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(solints)))
+
+    # Absolute paths, in case the workers run elsewhere (or are spawned)
+    vis = os.path.abspath(vis)
+    gaincal_kw = dict(gaincal_kw)
+    if 'gaintable' in gaincal_kw:
+        gaintable = gaincal_kw['gaintable']
+        if isinstance(gaintable, str):
+            gaintable = [gaintable]
+        gaincal_kw['gaintable'] = [os.path.abspath(t) for t in gaintable]
+
+    caltables = [os.path.abspath(sweep_caltable(vis, selfcal_cycle, ss)) for ss in solints]
+    ctx = multiprocessing.get_context(mp_context)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+        futures = {pool.submit(_solve_solint, vis, caltable, ss, plot, gaincal_kw): ss
+                   for caltable, ss in zip(caltables, solints)}
+        for future, ss in futures.items():
+            future.result()
+            print('Solint:', ss, 'done')
+
+    return caltables
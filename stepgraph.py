@@ -0,0 +1,219 @@
+"""
+Dependency-aware step runner for the self-calibration scripts
+
+Each step is a dictionary declaring what it reads and writes:
+
+    steps = {8: dict(title='Make second, conservative cleaning and save model',
+                     run=step8,
+                     inputs=[column(vis, 'CORRECTED_DATA'), 'cleanmask.mask'],
+                     outputs=[imagename + '.image', imagename + '.model',
+                              column(vis, 'MODEL_DATA')],
+                     params=dict(niter=200, cell=cell, imsize=imsize),
+                     restore=ft_model)}
+
+Inputs and outputs are either paths (files, CASA tables or image directories)
+or measurement set columns written as column(vis, 'MODEL_DATA'). Paths are
+content-hashed, columns are tracked by the key of the step that last wrote
+them. A step is skipped when the hash of its parameters and inputs matches the
+one stored in the manifest and its outputs are still on disk, unchanged.
+
+Columns live inside the MS and are overwritten by later steps, so before a
+step actually runs the engine makes sure every column it reads holds the value
+the pipeline expects at that point. If not, the step that produced it is
+replayed through its 'restore' callable (e.g. an ft() of the saved model
+instead of a full tclean), or through 'run' if no cheaper restore is given.
+
+Whatever 'run' returns is kept in the manifest. A step can end the pipeline
+early by returning a dictionary with 'stop': True (e.g. a self-cal round that
+did not improve the image); the stop is remembered, so a re-run skips that
+step and stops at the same place.
+"""
+
+import os
+import json
+import hashlib
+
+# Files larger than this are fingerprinted from size and mtime only
+max_content_bytes = 256 * 1024**2
+
+
+def column(vis, colname):
+    # Name of a measurement set column as used in step inputs/outputs
+    return vis + '::' + colname
+
+
+def is_column(name):
+    return '::' in name
+
+
+def load_manifest(manifest_file):
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+    for key in ['steps', 'columns', 'files']:
+        manifest.setdefault(key, {})
+    return manifest
+
+
+def save_manifest(manifest, manifest_file):
+    tmp = manifest_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_file)
+
+
+def _file_digest(path, st, cache):
+    # Hash file contents, reusing the cached digest if size and mtime are unchanged
+    stamp = [st.st_size, st.st_mtime_ns]
+    cached = cache.get(path)
+    if cached is not None and cached[:2] == stamp:
+        return cached[2]
+    if st.st_size > max_content_bytes:
+        digest = 'stat:{0}:{1}'.format(*stamp)
+    else:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+    cache[path] = stamp + [digest]
+    return digest
+
+
+def fingerprint(path, cache=None):
+    # Content hash of a file or of a whole CASA table/image directory.
+    # Returns None if the path does not exist.
+    if cache is None:
+        cache = {}
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return _file_digest(path, os.stat(path), cache)
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.lock'):
+                # CASA touches table.lock on every open, even read-only
+                continue
+            full = os.path.join(root, name)
+            h.update(os.path.relpath(full, path).encode())
+            h.update(_file_digest(full, os.stat(full), cache).encode())
+    return h.hexdigest()
+
+
+def step_key(step, input_hashes):
+    record = {'params': step.get('params', {}), 'inputs': input_hashes}
+    blob = json.dumps(record, sort_keys=True, default=repr)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def _input_hashes(step, logical, manifest):
+    hashes = {}
+    for name in step.get('inputs', []):
+        if is_column(name):
+            # Columns nobody in the pipeline wrote (e.g. DATA) are treated as fixed
+            hashes[name] = logical.get(name, 'source')
+        else:
+            hashes[name] = fingerprint(name, manifest['files'])
+    return hashes
+
+
+def _outputs_intact(step, record, manifest):
+    for name in step.get('outputs', []):
+        if is_column(name):
+            continue
+        stored = record['outputs'].get(name)
+        if stored is None or fingerprint(name, manifest['files']) != stored:
+            return False
+    return True
+
+
+def _record_outputs(step, key, manifest):
+    outputs = {}
+    for name in step.get('outputs', []):
+        if not is_column(name):
+            outputs[name] = fingerprint(name, manifest['files'])
+    return {'key': key, 'outputs': outputs}
+
+
+def run_steps(steps, thesteps, manifest_file, force=(), log=print):
+    """
+    Run the selected steps in order, skipping those that are up to date.
+
+    steps: dict of step number -> step dictionary (see module docstring)
+    thesteps: list of step numbers selected by the user
+    manifest_file: JSON file holding the hashes of previous runs
+    force: step numbers to run even if they look up to date
+    """
+    manifest = load_manifest(manifest_file)
+    # logical: value each column should hold at this point in the pipeline
+    # producer: step that produced that value
+    logical = {}
+    producer = {}
+
+    for num in sorted(steps):
+        step = steps[num]
+        record = manifest['steps'].get(str(num))
+        input_hashes = _input_hashes(step, logical, manifest)
+        key = step_key(step, input_hashes)
+
+        if num not in thesteps:
+            # Not selected: assume whatever it produced last time still stands
+            if record is not None:
+                for name in step.get('outputs', []):
+                    if is_column(name):
+                        logical[name] = record['key']
+                        producer[name] = num
+            continue
+
+        uptodate = (num not in force and record is not None and record['key'] == key
+                    and _outputs_intact(step, record, manifest))
+        if uptodate:
+            log('Step {0} {1}: up to date, skipping'.format(num, step['title']))
+            result = record.get('result')
+        else:
+            _materialise(step, logical, producer, steps, manifest, log)
+            log('Step {0} {1}'.format(num, step['title']))
+            result = step['run']()
+            for name in step.get('outputs', []):
+                if is_column(name):
+                    manifest['columns'][name] = key
+            manifest['steps'][str(num)] = _record_outputs(step, key, manifest)
+            manifest['steps'][str(num)]['result'] = result
+            save_manifest(manifest, manifest_file)
+
+        for name in step.get('outputs', []):
+            if is_column(name):
+                logical[name] = key
+                producer[name] = num
+
+        if isinstance(result, dict) and result.get('stop'):
+            log('Step {0} ended the pipeline: {1}'.format(num, result.get('reason', '')))
+            break
+
+    save_manifest(manifest, manifest_file)
+    return manifest
+
+
+def _materialise(step, logical, producer, steps, manifest, log):
+    # Make the MS columns read by this step hold the values the pipeline expects
+    for name in step.get('inputs', []):
+        if not is_column(name):
+            continue
+        actual = manifest['columns'].get(name)
+        if name not in logical:
+            if actual is not None:
+                log('Warning: {0} was written by a later step and is read as is'.format(name))
+            continue
+        if actual == logical[name]:
+            continue
+        source = steps[producer[name]]
+        restore = source.get('restore', source['run'])
+        log('Restoring {0} from step {1} {2}'.format(name, producer[name], source['title']))
+        restore()
+        for out in source.get('outputs', []):
+            if is_column(out) and out in logical and producer.get(out) == producer[name]:
+                manifest['columns'][out] = logical[out]
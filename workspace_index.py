@@ -0,0 +1,233 @@
+"""
+Index of a working directory full of CASA images
+
+One os.scandir pass lists the directory; the kind of each entry (CASA image,
+MS, FITS, other) and, on demand, the image metadata (shape, axes, beam,
+units) are cached in a small SQLite file ('.workspace_index.sqlite') and
+only recomputed for entries whose modification time changed (for the
+metadata of a CASA table, the newest mtime of its files: writing pixels
+does not touch the directory itself). Pre-flight checks and fuzzy matching are then database
+queries, and old products are deleted in the background: they are first
+renamed out of the way (so the same names can be written straight away)
+and removed by a thread.
+
+    ws = WorkspaceIndex('.')
+    ws.find('NGC3351.fits')          # exact entry or None
+    ws.search('NGC3351')             # names containing it (case-insensitive)
+    ws.metadata('NGC3351_12m_co21.image')
+    ws.remove(['old_feather.image'])
+    ws.close()                       # waits for the deletions
+"""
+
+import os
+import json
+import shutil
+import sqlite3
+import threading
+
+schema = """
+create table if not exists entries (name text primary key, kind text, mtime real, size integer);
+create table if not exists metadata (name text primary key, mtime real, shape text, axes text,
+                                     beam text, unit text);
+"""
+
+
+def _table_type(path):
+    # 'Type = ...' line of a CASA table's table.info
+    try:
+        with open(os.path.join(path, 'table.info')) as f:
+            return f.readline().partition('=')[2].strip()
+    except OSError:
+        return ''
+
+
+def entry_kind(entry):
+    # Classify an os.DirEntry
+    if entry.is_dir():
+        table_type = _table_type(entry.path)
+        if table_type == 'Image':
+            return 'image'
+        if table_type == 'Measurement Set':
+            return 'ms'
+        return 'dir'
+    if entry.name.lower().endswith(('.fits', '.fits.gz', '.fit')):
+        return 'fits'
+    return 'file'
+
+
+def entry_mtime(path):
+    # (mtime, size) of a path; for a directory the newest mtime of its own and of
+    # its files' (table.dat, table.f0, ... change without the directory changing).
+    # One scandir per call: used by metadata(), not by scan()
+    st = os.stat(path) if os.path.exists(path) else os.lstat(path)
+    mtime = st.st_mtime
+    if os.path.isdir(path):
+        with os.scandir(path) as it:
+            for inner in it:
+                if inner.is_file() and not inner.name.endswith('.lock'):
+                    mtime = max(mtime, inner.stat().st_mtime)
+    return mtime, st.st_size
+
+
+def read_metadata(path, kind):
+    # Shape, axis names, beam and brightness unit of a CASA image or FITS file
+    if kind == 'image':
+        from casatools import image
+        ia = image()
+        ia.open(path)
+        try:
+            beam = ia.restoringbeam()
+            if 'beams' in beam:
+                beam = {'nbeams': len(beam['beams'])}
+            return {'shape': [int(n) for n in ia.shape()], 'axes': list(ia.coordsys().names()),
+                    'beam': beam, 'unit': ia.brightnessunit()}
+        finally:
+            ia.close()
+    if kind == 'fits':
+        from astropy.io import fits
+        header = fits.getheader(path)
+        naxis = header.get('NAXIS', 0)
+        beam = {}
+        if 'BMAJ' in header:
+            beam = {'major': {'value': header['BMAJ']*3600.0, 'unit': 'arcsec'},
+                    'minor': {'value': header.get('BMIN', header['BMAJ'])*3600.0, 'unit': 'arcsec'},
+                    'positionangle': {'value': header.get('BPA', 0.0), 'unit': 'deg'}}
+        return {'shape': [header['NAXIS{0}'.format(i)] for i in range(1, naxis + 1)],
+                'axes': [header.get('CTYPE{0}'.format(i), '') for i in range(1, naxis + 1)],
+                'beam': beam, 'unit': header.get('BUNIT', '')}
+    return None
+
+
+class WorkspaceIndex(object):
+    """
+    Cached listing of 'directory' (scanned on creation; call scan() again to
+    refresh). Deletions started by remove() run in background threads until
+    close().
+    """
+
+    def __init__(self, directory='.', db_file='.workspace_index.sqlite'):
+        self.directory = os.path.abspath(directory)
+        self.db = sqlite3.connect(os.path.join(self.directory, db_file), check_same_thread=False)
+        self.db.executescript(schema)
+        self.deletions = []
+        self.scan()
+
+    def scan(self):
+        # One scandir pass; only new or modified entries are classified again
+        known = dict(self.db.execute('select name, mtime from entries'))
+        seen, changed = set(), []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                seen.add(entry.name)
+                st = entry.stat(follow_symlinks=True) if os.path.exists(entry.path) else entry.stat(follow_symlinks=False)
+                if known.get(entry.name) != st.st_mtime:
+                    changed.append((entry.name, entry_kind(entry), st.st_mtime, st.st_size))
+        gone = [(name,) for name in known if name not in seen]
+        with self.db:
+            self.db.executemany('insert or replace into entries values (?, ?, ?, ?)', changed)
+            self.db.executemany('delete from entries where name = ?', gone)
+            self.db.executemany('delete from metadata where name = ?', gone)
+        return len(seen), len(changed)
+
+    def find(self, name):
+        # (kind, mtime) of an exact entry, or None
+        return self.db.execute('select kind, mtime from entries where name = ?',
+                               (os.path.basename(name.rstrip('/')),)).fetchone()
+
+    def exists(self, name):
+        return self.find(name) is not None
+
+    def search(self, pattern, kind=None, limit=50):
+        # Names containing 'pattern' (case-insensitive), e.g. for a misspelt input
+        query = "select name from entries where name like ? escape '\\'"
+        args = ['%' + pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%']
+        if kind is not None:
+            query += ' and kind = ?'
+            args.append(kind)
+        query += ' order by name limit ?'
+        args.append(limit)
+        return [row[0] for row in self.db.execute(query, args)]
+
+    def listing(self, kind=None, limit=None):
+        query = 'select name, kind from entries'
+        args = []
+        if kind is not None:
+            query += ' where kind = ?'
+            args.append(kind)
+        query += ' order by name'
+        if limit is not None:
+            query += ' limit ?'
+            args.append(limit)
+        return self.db.execute(query, args).fetchall()
+
+    def metadata(self, name):
+        # Image metadata, read once per modification of the entry (checked now,
+        # not at the last scan)
+        name = os.path.basename(name.rstrip('/'))
+        row = self.find(name)
+        if row is None:
+            return None
+        kind = row[0]
+        path = os.path.join(self.directory, name)
+        if not os.path.lexists(path):
+            return None
+        mtime = entry_mtime(path)[0]
+        cached = self.db.execute('select mtime, shape, axes, beam, unit from metadata where name = ?',
+                                 (name,)).fetchone()
+        if cached is not None and cached[0] == mtime:
+            return {'kind': kind, 'shape': json.loads(cached[1]), 'axes': json.loads(cached[2]),
+                    'beam': json.loads(cached[3]), 'unit': cached[4]}
+        meta = read_metadata(path, kind)
+        if meta is None:
+            return {'kind': kind}
+        with self.db:
+            self.db.execute('insert or replace into metadata values (?, ?, ?, ?, ?, ?)',
+                            (name, mtime, json.dumps(meta['shape']), json.dumps(meta['axes']),
+                             json.dumps(meta['beam']), meta['unit']))
+        return dict(meta, kind=kind)
+
+    def remove(self, names):
+        """
+        Delete entries in the background. Each is renamed to a hidden name
+        first, so it is gone from the directory (and the index) immediately.
+        Returns the names that were present.
+        """
+        moved, removed = [], []
+        for name in names:
+            name = os.path.basename(name.rstrip('/'))
+            if not self.exists(name):
+                continue
+            path = os.path.join(self.directory, name)
+            trash = os.path.join(self.directory, '.deleting.{0}.{1}'.format(os.getpid(), name))
+            try:
+                os.rename(path, trash)
+            except OSError as e:
+                print('Could not remove {0}: {1}'.format(name, e))
+                continue
+            moved.append(trash)
+            removed.append(name)
+        with self.db:
+            self.db.executemany('delete from entries where name = ?', [(n,) for n in removed])
+            self.db.executemany('delete from metadata where name = ?', [(n,) for n in removed])
+        if moved:
+            thread = threading.Thread(target=_delete, args=(moved,), daemon=True)
+            thread.start()
+            self.deletions.append(thread)
+        return removed
+
+    def close(self):
+        # Wait for the background deletions
+        for thread in self.deletions:
+            thread.join()
+        self.deletions = []
+        self.db.close()
+
+
+def _delete(paths):
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)